@@ -286,7 +286,8 @@ class Sketch(object):
         return timeline_obj
 
     def explore(self, query_string=None, query_dsl=None, query_filter=None,
-                view=None):
+                view=None, include=None, cursor=None, return_fields=None,
+                sample=None):
         """Explore the sketch.
 
         Args:
@@ -294,6 +295,16 @@ class Sketch(object):
             query_dsl: Elasticsearch query DSL as JSON string.
             query_filter: Filter for the query as JSON string.
             view: View object instance (optional).
+            include: List of extra results to get in the same request
+                (optional). Any of heatmap, histogram, timeline_counts and
+                count. The results are added to the meta dictionary.
+            cursor: The next_cursor from the meta dictionary of a previous
+                result, to get the next page of events (optional).
+            return_fields: List of event fields to return (optional). Default
+                is the fields shown in the Timesketch UI.
+            sample: Fraction of the events to sample, or True to sample a
+                number of events that is quick to search (optional). Counts
+                in the result are then estimates.
 
         Returns:
             Dictionary with query results.
@@ -317,6 +328,12 @@ class Sketch(object):
             query_filter = json.loads(view.query_filter)
             query_dsl = json.loads(view.query_dsl)
 
+        if return_fields:
+            query_filter = dict(query_filter, fields=return_fields)
+
+        if sample:
+            query_filter = dict(query_filter, sample=sample)
+
         resource_url = u'{0:s}/sketches/{1:d}/explore/'.format(
             self.api.api_root, self.id)
 
@@ -324,7 +341,10 @@ class Sketch(object):
             u'query': query_string,
             u'filter': query_filter,
             u'dsl': query_dsl,
+            u'include': include or [],
         }
+        if cursor:
+            form_data[u'cursor'] = cursor
         response = self.api.session.post(resource_url, json=form_data)
         return response.json()
 
@@ -1,3 +1,9 @@
+if (ctx._source.timesketch_label == null) {
+    ctx._source.timesketch_label = []
+}
 if( ! ctx._source.timesketch_label.contains (timesketch_label)) {
     ctx._source.timesketch_label += timesketch_label
-}
\ No newline at end of file
+}
+ctx._source.timesketch_label_keys = ctx._source.timesketch_label.collect {
+    it.sketch_id.toString() + ':' + it.name
+}.unique()
@@ -1,5 +1,11 @@
+if (ctx._source.timesketch_label == null) {
+    ctx._source.timesketch_label = []
+}
 if(ctx._source.timesketch_label.contains (timesketch_label)) {
     ctx._source.timesketch_label.remove(timesketch_label)
 } else {
     ctx._source.timesketch_label += timesketch_label
-}
\ No newline at end of file
+}
+ctx._source.timesketch_label_keys = ctx._source.timesketch_label.collect {
+    it.sketch_id.toString() + ':' + it.name
+}.unique()
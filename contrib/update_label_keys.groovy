@@ -0,0 +1,6 @@
+if (ctx._source.timesketch_label == null) {
+    ctx._source.timesketch_label = []
+}
+ctx._source.timesketch_label_keys = ctx._source.timesketch_label.collect {
+    it.sketch_id.toString() + ':' + it.name
+}.unique()
@@ -27,6 +27,7 @@ from timesketch.api.v1.resources import AggregationResource
 from timesketch.api.v1.resources import ExploreResource
 from timesketch.api.v1.resources import EventResource
 from timesketch.api.v1.resources import EventAnnotationResource
+from timesketch.api.v1.resources import EventBatchResource
 from timesketch.api.v1.resources import GraphResource
 from timesketch.api.v1.resources import SketchResource
 from timesketch.api.v1.resources import SketchListResource
@@ -42,7 +43,9 @@ from timesketch.api.v1.resources import QueryResource
 from timesketch.api.v1.resources import CountEventsResource
 from timesketch.api.v1.resources import TimelineResource
 from timesketch.api.v1.resources import TimelineListResource
+from timesketch.lib.datastores.sqlite import create_schema
 from timesketch.lib.errors import ApiHTTPError
+from timesketch.lib.metrics import init_metrics
 from timesketch.models import configure_engine
 from timesketch.models import init_db
 from timesketch.models.sketch import Sketch
@@ -102,6 +105,10 @@ def create_app(config=None):
     configure_engine(app.config[u'SQLALCHEMY_DATABASE_URI'])
     db = init_db()
 
+    # Setup the SQLite datastore, if it is used instead of Elasticsearch.
+    if app.config.get(u'DATASTORE') == u'sqlite':
+        create_schema(app.config[u'SQLITE_DATASTORE_PATH'])
+
     # Alembic migration support:
     # http://alembic.zzzcomputing.com/en/latest/
     migrate = Migrate()
@@ -123,6 +130,8 @@ def create_app(config=None):
         AggregationResource, u'/sketches/<int:sketch_id>/aggregation/')
     api_v1.add_resource(ExploreResource, u'/sketches/<int:sketch_id>/explore/')
     api_v1.add_resource(EventResource, u'/sketches/<int:sketch_id>/event/')
+    api_v1.add_resource(
+        EventBatchResource, u'/sketches/<int:sketch_id>/event/batch/')
     api_v1.add_resource(
         EventAnnotationResource, u'/sketches/<int:sketch_id>/event/annotate/')
     api_v1.add_resource(ViewListResource, u'/sketches/<int:sketch_id>/views/')
@@ -185,6 +194,9 @@ def create_app(config=None):
     # Setup CSRF protection for the whole application
     CSRFProtect(app)
 
+    # Time each request and export metrics on /metrics.
+    init_metrics(app)
+
     return app
 
 
@@ -29,6 +29,7 @@ POST /sketches/:sketch_id/views/
 
 import datetime
 import json
+import logging
 import os
 import uuid
 
@@ -44,28 +45,54 @@ from flask_restful import reqparse
 from flask_restful import Resource
 from sqlalchemy import desc
 from sqlalchemy import not_
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import subqueryload
 
+from timesketch.lib.aggregators import DEFAULT_TERMS_SIZE
+from timesketch.lib.aggregators import MAX_TERMS_SIZE
+from timesketch.lib.aggregators import field_stats
 from timesketch.lib.aggregators import heatmap
+from timesketch.lib.aggregators import heatmap_aggregation
+from timesketch.lib.aggregators import heatmap_result
 from timesketch.lib.aggregators import histogram
+from timesketch.lib.aggregators import histogram_aggregation
+from timesketch.lib.aggregators import histogram_interval
+from timesketch.lib.aggregators import histogram_result
+from timesketch.lib.aggregators import sample_estimate
+from timesketch.lib.aggregators import scale_sample
+from timesketch.lib.aggregators import get_buckets
+from timesketch.lib.cache import get_query_cache
 from timesketch.lib.definitions import HTTP_STATUS_CODE_OK
 from timesketch.lib.definitions import HTTP_STATUS_CODE_CREATED
 from timesketch.lib.definitions import HTTP_STATUS_CODE_BAD_REQUEST
 from timesketch.lib.definitions import HTTP_STATUS_CODE_FORBIDDEN
 from timesketch.lib.definitions import HTTP_STATUS_CODE_NOT_FOUND
+from timesketch.lib.definitions import SEARCHINDEX_FAILED_STATUS
+from timesketch.lib.definitions import SEARCHINDEX_PROCESSING_STATUSES
+from timesketch.lib.definitions import MAX_EVENT_BATCH_SIZE
 from timesketch.lib.datastores.elastic import ElasticsearchDataStore
 from timesketch.lib.datastores.neo4j import Neo4jDataStore
+from timesketch.lib.datastores.sqlite import SqliteDataStore
 from timesketch.lib.errors import ApiHTTPError
 from timesketch.lib.forms import AddTimelineForm
 from timesketch.lib.forms import AggregationForm
 from timesketch.lib.forms import SaveViewForm
 from timesketch.lib.forms import NameDescriptionForm
 from timesketch.lib.forms import EventAnnotationForm
+from timesketch.lib.forms import EventBatchForm
 from timesketch.lib.forms import ExploreForm
 from timesketch.lib.forms import UploadFileForm
 from timesketch.lib.forms import StoryForm
 from timesketch.lib.forms import GraphExploreForm
+from timesketch.lib.metrics import PHASE_PROCESS
+from timesketch.lib.metrics import PHASE_SERIALIZE
+from timesketch.lib.metrics import timed
+from timesketch.lib.utils import get_filter_time_range
+from timesketch.lib.utils import get_sample_rate
 from timesketch.lib.utils import get_validated_indices
 from timesketch.models import db_session
+from timesketch.models.querylog import DEFAULT_MAX_ENTRIES
+from timesketch.models.querylog import SlowQuery
 from timesketch.models.sketch import Event
 from timesketch.models.sketch import SearchIndex
 from timesketch.models.sketch import Sketch
@@ -75,6 +102,10 @@ from timesketch.models.sketch import SearchTemplate
 from timesketch.models.story import Story
 
 
+logger = logging.getLogger(u'timesketch.api')
+logger.addHandler(logging.NullHandler())
+
+
 class ResourceMixin(object):
     """Mixin for API resources."""
     # Schemas for database model resources
@@ -90,6 +121,10 @@ class ResourceMixin(object):
         u'id': fields.Integer,
         u'name': fields.String,
         u'index_name': fields.String,
+        u'event_count': fields.Integer,
+        u'min_datetime': fields.DateTime,
+        u'max_datetime': fields.DateTime,
+        u'size_in_bytes': fields.Integer,
         u'status': fields.Nested(status_fields),
         u'deleted': fields.Boolean,
         u'created_at': fields.DateTime,
@@ -187,10 +222,34 @@ class ResourceMixin(object):
 
         Returns:
             Instance of timesketch.lib.datastores.elastic.ElasticSearchDatastore
+            or timesketch.lib.datastores.sqlite.SqliteDataStore, depending
+            on the DATASTORE setting.
         """
+        if current_app.config.get(u'DATASTORE') == u'sqlite':
+            return SqliteDataStore(
+                current_app.config[u'SQLITE_DATASTORE_PATH'])
         return ElasticsearchDataStore(
             host=current_app.config[u'ELASTIC_HOST'],
-            port=current_app.config[u'ELASTIC_PORT'])
+            port=current_app.config[u'ELASTIC_PORT'],
+            slow_query_callback=self._record_slow_query)
+
+    @staticmethod
+    def _record_slow_query(**kwargs):
+        """Record a slow datastore call for the current user.
+
+        Args:
+            kwargs: Arguments for SlowQuery(), except the user
+        """
+        user_id = None
+        if current_user.is_authenticated:
+            user_id = current_user.id
+        try:
+            SlowQuery.record(
+                max_entries=current_app.config.get(
+                    u'ELASTIC_SLOW_QUERY_LOG_SIZE', DEFAULT_MAX_ENTRIES),
+                user_id=user_id, **kwargs)
+        except SQLAlchemyError as e:
+            logger.warning(u'Unable to record slow query: %s', e)
 
     @property
     def graph_datastore(self):
@@ -206,6 +265,60 @@ class ResourceMixin(object):
             password=current_app.config[u'NEO4J_PASSWORD']
         )
 
+    def count_events(self, sketch):
+        """Count the events in all timelines of a sketch.
+
+        The counts are read from the database. Indices imported before the
+        counts were recorded get their stats from the datastore once, they
+        are saved with a single commit.
+
+        Args:
+            sketch: A sketch (instance of timesketch.models.sketch.Sketch)
+
+        Returns:
+            Number of events in timelines that are ready to be searched.
+        """
+        searchindices = SearchIndex.query.join(Timeline).filter(
+            Timeline.sketch_id == sketch.id).options(
+                subqueryload(SearchIndex.status)).all()
+        count = 0
+        updated = False
+        for searchindex in searchindices:
+            # Exclude any timeline that is processing, i.e. not ready yet,
+            # or that failed to import.
+            status = searchindex.get_status.status
+            if (status in SEARCHINDEX_PROCESSING_STATUSES or
+                    status == SEARCHINDEX_FAILED_STATUS):
+                continue
+            if searchindex.event_count is None:
+                searchindex.set_stats(
+                    self.datastore.index_stats(searchindex.index_name))
+                updated = True
+            count += searchindex.event_count or 0
+        if updated:
+            db_session.commit()
+        return count
+
+    @staticmethod
+    def sample_filter(query_filter, indices):
+        """Resolve the sample option of a query filter into a sample rate.
+
+        Args:
+            query_filter: Dictionary containing filters to apply
+            indices: List of indices to query
+
+        Returns:
+            Copy of the filter with the sample rate, or None, in sample.
+
+        Raises:
+            ValueError: If the sample in the filter is not valid.
+        """
+        event_count = None
+        if query_filter.get(u'sample') is True:
+            event_count = SearchIndex.count_events(indices)
+        sample_rate = get_sample_rate(query_filter, event_count)
+        return dict(query_filter, sample=sample_rate)
+
     def to_json(
             self, model, model_fields=None, meta=None,
             status_code=HTTP_STATUS_CODE_OK):
@@ -228,15 +341,18 @@ class ResourceMixin(object):
             u'objects': []
         }
 
-        if model:
-            if not model_fields:
-                try:
-                    model_fields = self.fields_registry[model.__tablename__]
-                except AttributeError:
-                    model_fields = self.fields_registry[model[0].__tablename__]
-            schema[u'objects'] = [marshal(model, model_fields)]
-
-        response = jsonify(schema)
+        with timed(PHASE_SERIALIZE):
+            if model:
+                if not model_fields:
+                    try:
+                        model_fields = self.fields_registry[
+                            model.__tablename__]
+                    except AttributeError:
+                        model_fields = self.fields_registry[
+                            model[0].__tablename__]
+                schema[u'objects'] = [marshal(model, model_fields)]
+
+            response = jsonify(schema)
         response.status_code = status_code
         return response
 
@@ -616,8 +732,15 @@ class ExploreResource(ResourceMixin, Resource):
         if form.validate_on_submit():
             query_dsl = form.dsl.data
             query_filter = form.filter.data
-            sketch_indices = {
-                t.searchindex.index_name for t in sketch.timelines}
+            # Timeline colors and names are used by the UI to render the
+            # events. Collect them before the commit below expires the
+            # sketch, so that the timelines are only loaded once.
+            tl_colors = {}
+            tl_names = {}
+            for timeline in sketch.timelines:
+                tl_colors[timeline.searchindex.index_name] = timeline.color
+                tl_names[timeline.searchindex.index_name] = timeline.name
+            sketch_indices = set(tl_colors)
             indices = query_filter.get(u'indices', sketch_indices)
 
             # If _all in indices then execute the query on all indices
@@ -628,6 +751,15 @@ class ExploreResource(ResourceMixin, Resource):
             # This will also remove any deleted timeline from the search result.
             indices = get_validated_indices(indices, sketch_indices)
 
+            # Skip timelines that failed to import, they are incomplete.
+            indices = SearchIndex.filter_failed(indices)
+
+            # Skip timelines without events in the time range of the filter.
+            time_start, time_end = get_filter_time_range(
+                query_filter, query_dsl)
+            indices = SearchIndex.filter_by_time_range(
+                indices, time_start, time_end)
+
             # Make sure we have a query string or star filter
             if not (form.query.data,
                     query_filter.get(u'star'),
@@ -635,24 +767,75 @@ class ExploreResource(ResourceMixin, Resource):
                     query_dsl):
                 abort(HTTP_STATUS_CODE_BAD_REQUEST)
 
-            result = self.datastore.search(
-                sketch_id, form.query.data, query_filter, query_dsl, indices,
-                aggregations=None, return_results=True, return_fields=None,
-                enable_scroll=False)
+            # A sample gives a quick, approximate view of huge sketches. The
+            # sample rate is not stored in the view, so it follows the size
+            # of the sketch.
+            try:
+                search_filter = self.sample_filter(query_filter, indices)
+            except ValueError:
+                abort(HTTP_STATUS_CODE_BAD_REQUEST)
+            sample_rate = search_filter[u'sample']
+
+            # Aggregations requested with include are run in the same
+            # search request as the hits.
+            include = form.include.data or []
+            aggregations = {}
+            if u'heatmap' in include:
+                aggregations.update(heatmap_aggregation())
+            interval = None
+            if u'histogram' in include:
+                # The time span recorded for the indices saves a search for
+                # the time of the first and the last event.
+                interval = histogram_interval(
+                    self.datastore, sketch_id, form.query.data, search_filter,
+                    query_dsl, indices, time_span=SearchIndex.time_span(
+                        indices, time_start, time_end))
+            if interval:
+                aggregations.update(histogram_aggregation(interval[0]))
+            if u'timeline_counts' in include:
+                aggregations[u'timeline_counts'] = {
+                    u'terms': {
+                        u'field': u'_index',
+                        u'size': max(len(indices), 1)
+                    }
+                }
+
+            # Columns to return, default is the fields shown in the UI.
+            return_fields = query_filter.get(u'fields') or None
+            if return_fields is not None and not (
+                    isinstance(return_fields, list) and
+                    all(isinstance(f, basestring) for f in return_fields)):
+                abort(HTTP_STATUS_CODE_BAD_REQUEST)
+
+            try:
+                result = self.datastore.search(
+                    sketch_id, form.query.data, search_filter, query_dsl,
+                    indices, aggregations=aggregations or None,
+                    return_results=True, return_fields=return_fields,
+                    enable_scroll=False, cursor=form.cursor.data,
+                    paginate=form.paginate.data)
+            except ValueError:
+                abort(HTTP_STATUS_CODE_BAD_REQUEST)
 
             # Get labels for each event that matches the sketch.
             # Remove all other labels.
-            for event in result[u'hits'][u'hits']:
-                event[u'selected'] = False
-                event[u'_source'][u'label'] = []
-                try:
-                    for label in event[u'_source'][u'timesketch_label']:
-                        if sketch.id != label[u'sketch_id']:
-                            continue
-                        event[u'_source'][u'label'].append(label[u'name'])
-                    del event[u'_source'][u'timesketch_label']
-                except KeyError:
-                    pass
+            with timed(PHASE_PROCESS):
+                for event in result[u'hits'][u'hits']:
+                    event[u'selected'] = False
+                    event[u'_source'][u'label'] = []
+                    try:
+                        for label in event[u'_source'][u'timesketch_label']:
+                            if sketch.id != label[u'sketch_id']:
+                                continue
+                            event[u'_source'][u'label'].append(label[u'name'])
+                        del event[u'_source'][u'timesketch_label']
+                    except KeyError:
+                        pass
+
+            # Count the events before the commit below expires the sketch.
+            event_count = None
+            if u'count' in include:
+                event_count = self.count_events(sketch)
 
             # Update or create user state view. This is used in the UI to let
             # the user get back to the last state in the explore view.
@@ -667,23 +850,57 @@ class ExploreResource(ResourceMixin, Resource):
             # Add metadata for the query result. This is used by the UI to
             # render the event correctly and to display timing and hit count
             # information.
-            tl_colors = {}
-            tl_names = {}
-            for timeline in sketch.timelines:
-                tl_colors[timeline.searchindex.index_name] = timeline.color
-                tl_names[timeline.searchindex.index_name] = timeline.name
-
             meta = {
                 u'es_time': result[u'took'],
                 u'es_total_count': result[u'hits'][u'total'],
+                u'es_cached': result.get(u'cached', False),
                 u'timeline_colors': tl_colors,
                 u'timeline_names': tl_names,
             }
+            query_cache = get_query_cache()
+            if query_cache:
+                meta[u'cache_stats'] = query_cache.stats(u'search')
+            if u'heatmap' in include:
+                meta[u'heatmap'] = heatmap_result(result)
+            if u'histogram' in include:
+                meta[u'histogram'] = histogram_result(result)
+                meta[u'histogram_interval'] = interval[0] if interval else None
+                meta[u'histogram_interval_ms'] = (
+                    interval[1] * 1000 if interval else None)
+            if u'timeline_counts' in include:
+                meta[u'timeline_counts'] = {
+                    bucket[u'key']: bucket[u'doc_count']
+                    for bucket in get_buckets(result, u'timeline_counts')
+                }
+            if u'count' in include:
+                meta[u'count'] = event_count
+            if result.get(u'next_cursor'):
+                meta[u'next_cursor'] = result[u'next_cursor']
+            if sample_rate:
+                # Label the result as approximate and estimate the counts
+                # for all events from the sample.
+                meta[u'sampled'] = True
+                meta[u'sample_rate'] = sample_rate
+                meta[u'sample_count'] = result[u'hits'][u'total']
+                meta[u'es_total_count'], meta[u'es_total_count_error'] = (
+                    sample_estimate(result[u'hits'][u'total'], sample_rate))
+                if u'heatmap' in include:
+                    scale_sample(
+                        meta[u'heatmap'], sample_rate, count_key=u'count')
+                if u'histogram' in include:
+                    scale_sample(meta[u'histogram'], sample_rate)
+                if u'timeline_counts' in include:
+                    meta[u'timeline_counts'] = {
+                        index_name: sample_estimate(count, sample_rate)[0]
+                        for index_name, count in
+                        meta[u'timeline_counts'].items()
+                    }
             schema = {
                 u'meta': meta,
                 u'objects': result[u'hits'][u'hits']
             }
-            return jsonify(schema)
+            with timed(PHASE_SERIALIZE):
+                return jsonify(schema)
         return abort(HTTP_STATUS_CODE_BAD_REQUEST)
 
 
@@ -718,30 +935,89 @@ class AggregationResource(ResourceMixin, Resource):
             # This will also remove any deleted timeline from the search result.
             indices = get_validated_indices(indices, sketch_indices)
 
+            # Skip timelines that failed to import, they are incomplete.
+            indices = SearchIndex.filter_failed(indices)
+
+            # Skip timelines without events in the time range of the filter.
+            time_start, time_end = get_filter_time_range(
+                query_filter, query_dsl)
+            indices = SearchIndex.filter_by_time_range(
+                indices, time_start, time_end)
+
             # Make sure we have a query string or star filter
             if not (form.query.data,
                     query_filter.get(u'star'),
                     query_filter.get(u'events')):
                 abort(HTTP_STATUS_CODE_BAD_REQUEST)
 
+            try:
+                query_filter = self.sample_filter(query_filter, indices)
+            except ValueError:
+                abort(HTTP_STATUS_CODE_BAD_REQUEST)
+
             result = []
+            meta = {}
+            per_timeline = bool(form.per_timeline.data)
             if form.aggtype.data == u'heatmap':
                 result = heatmap(
                     es_client=self.datastore, sketch_id=sketch_id,
                     query_string=form.query.data, query_filter=query_filter,
-                    query_dsl=query_dsl, indices=indices)
+                    query_dsl=query_dsl, indices=indices,
+                    per_timeline=per_timeline)
             elif form.aggtype.data == u'histogram':
-                result = histogram(
+                zoom_start = form.zoom_start.data
+                zoom_end = form.zoom_end.data
+                if None not in (zoom_start, zoom_end) and (
+                        zoom_start >= zoom_end):
+                    abort(HTTP_STATUS_CODE_BAD_REQUEST)
+                histogram_data = histogram(
                     es_client=self.datastore, sketch_id=sketch_id,
                     query_string=form.query.data, query_filter=query_filter,
-                    query_dsl=query_dsl, indices=indices)
-
+                    query_dsl=query_dsl, indices=indices,
+                    zoom_start=zoom_start, zoom_end=zoom_end,
+                    per_timeline=per_timeline)
+                result = histogram_data[u'buckets']
+                meta[u'interval'] = histogram_data[u'interval']
+                meta[u'interval_ms'] = histogram_data[u'interval_ms']
+            elif form.aggtype.data == u'field_stats':
+                if not form.field.data:
+                    abort(HTTP_STATUS_CODE_BAD_REQUEST)
+                size = max(1, min(
+                    form.size.data or DEFAULT_TERMS_SIZE, MAX_TERMS_SIZE))
+                field_data = field_stats(
+                    es_client=self.datastore, sketch_id=sketch_id,
+                    query_string=form.query.data, query_filter=query_filter,
+                    query_dsl=query_dsl, indices=indices,
+                    field_name=form.field.data, size=size,
+                    sample_size=form.sample_size.data or None)
+                result = field_data.pop(u'terms')
+                meta.update(field_data)
+                meta[u'field'] = form.field.data
             else:
                 abort(HTTP_STATUS_CODE_BAD_REQUEST)
 
+            # Counts estimated from a sample are approximate.
+            if query_filter[u'sample']:
+                meta[u'sampled'] = True
+                meta[u'sample_rate'] = query_filter[u'sample']
+
+            # Timeline colors and names for the per timeline series.
+            if per_timeline:
+                meta[u'timeline_colors'] = {}
+                meta[u'timeline_names'] = {}
+                for timeline in sketch.timelines:
+                    index_name = timeline.searchindex.index_name
+                    meta[u'timeline_colors'][index_name] = timeline.color
+                    meta[u'timeline_names'][index_name] = timeline.name
+
             schema = {
                 u'objects': result
             }
+            query_cache = get_query_cache()
+            if query_cache:
+                meta[u'cache_stats'] = query_cache.stats(form.aggtype.data)
+            if meta:
+                schema[u'meta'] = meta
             return jsonify(schema)
         return abort(HTTP_STATUS_CODE_BAD_REQUEST)
 
@@ -811,6 +1087,87 @@ class EventResource(ResourceMixin, Resource):
         return jsonify(schema)
 
 
+class EventBatchResource(ResourceMixin, Resource):
+    """Resource to get many events from the datastore at once."""
+    @login_required
+    def post(self, sketch_id):
+        """Handles POST request to the resource.
+        Handler for /api/v1/sketches/:sketch_id/event/batch/
+
+        All events are fetched with one multi-get request to the datastore,
+        and their comments and labels with one SQL query each.
+
+        Args:
+            sketch_id: Integer primary key for a sketch database model
+
+        Returns:
+            JSON with list of events, each with its comments and labels
+        """
+        form = EventBatchForm.build(request)
+        if not form.validate_on_submit():
+            abort(HTTP_STATUS_CODE_BAD_REQUEST)
+
+        sketch = Sketch.query.get_with_acl(sketch_id)
+        searchindex_ids = {
+            t.searchindex.index_name: t.searchindex.id
+            for t in sketch.timelines
+        }
+        events = form.events.raw_data
+        if len(events) > MAX_EVENT_BATCH_SIZE:
+            abort(HTTP_STATUS_CODE_BAD_REQUEST)
+        try:
+            event_keys = [(_event[u'_index'], _event[u'_id'])
+                          for _event in events]
+        except (KeyError, TypeError):
+            abort(HTTP_STATUS_CODE_BAD_REQUEST)
+
+        # Check if the requested searchindices are part of the sketch
+        if not {index_name for index_name, _ in event_keys}.issubset(
+                searchindex_ids):
+            abort(HTTP_STATUS_CODE_BAD_REQUEST)
+
+        results = self.datastore.get_events(
+            [{u'_index': index_name, u'_id': event_id}
+             for index_name, event_id in event_keys])
+
+        # Comments and labels of all events, with their users.
+        annotated_events = Event.query.filter(
+            Event.sketch == sketch,
+            Event.searchindex_id.in_(
+                {searchindex_ids[index_name] for index_name, _ in event_keys}),
+            Event.document_id.in_({event_id for _, event_id in event_keys})
+        ).options(
+            subqueryload(Event.comments).joinedload(u'user'),
+            subqueryload(Event.labels).joinedload(u'user'))
+        annotations = {}
+        for event in annotated_events:
+            annotations[(event.searchindex_id, event.document_id)] = {
+                u'comments': [{
+                    u'user': {u'username': comment.user.username},
+                    u'created_at': comment.created_at,
+                    u'comment': comment.comment
+                } for comment in event.comments],
+                u'labels': [{
+                    u'user': {u'username': label.user.username},
+                    u'created_at': label.created_at,
+                    u'label': label.label
+                } for label in event.labels]
+            }
+
+        objects = []
+        for result in results:
+            event_annotations = annotations.get(
+                (searchindex_ids[result[u'_index']], result[u'_id']), {})
+            objects.append({
+                u'_index': result[u'_index'],
+                u'_id': result[u'_id'],
+                u'_source': result[u'_source'],
+                u'comments': event_annotations.get(u'comments', []),
+                u'labels': event_annotations.get(u'labels', [])
+            })
+        return jsonify({u'objects': objects})
+
+
 class EventAnnotationResource(ResourceMixin, Resource):
     """Resource to create an annotation for an event."""
     @login_required
@@ -831,51 +1188,85 @@ class EventAnnotationResource(ResourceMixin, Resource):
             annotation_type = form.annotation_type.data
             events = form.events.raw_data
 
+            if u'comment' in annotation_type:
+                label = u'__ts_comment'
+                toggle = False
+            elif u'label' in annotation_type:
+                label = form.annotation.data
+                toggle = False
+                if u'__ts_star' or u'__ts_hidden' in form.annotation.data:
+                    toggle = True
+            else:
+                abort(HTTP_STATUS_CODE_BAD_REQUEST)
+
+            event_indices = {_event[u'_index'] for _event in events}
+            if not event_indices.issubset(indices):
+                abort(HTTP_STATUS_CODE_BAD_REQUEST)
+
+            # Resolve all search indices and existing events with one query
+            # each instead of once per event.
+            searchindices = {
+                searchindex.index_name: searchindex
+                for searchindex in SearchIndex.query.filter(
+                    SearchIndex.index_name.in_(event_indices))
+            }
+            existing_events_query = Event.query.filter(
+                Event.sketch == sketch,
+                Event.searchindex_id.in_(
+                    [searchindex.id for searchindex in searchindices.values()]),
+                Event.document_id.in_(
+                    {_event[u'_id'] for _event in events}))
+            if u'label' in annotation_type:
+                existing_events_query = existing_events_query.options(
+                    subqueryload(u'labels'))
+            existing_events = {
+                (event.searchindex_id, event.document_id): event
+                for event in existing_events_query
+            }
+
             for _event in events:
-                searchindex_id = _event[u'_index']
-                searchindex = SearchIndex.query.filter_by(
-                    index_name=searchindex_id).first()
+                searchindex = searchindices[_event[u'_index']]
                 event_id = _event[u'_id']
-                event_type = _event[u'_type']
-
-                if searchindex_id not in indices:
-                    abort(HTTP_STATUS_CODE_BAD_REQUEST)
 
                 # Get or create an event in the SQL database to have something
                 # to attach the annotation to.
-                event = Event.get_or_create(
-                    sketch=sketch, searchindex=searchindex,
-                    document_id=event_id)
+                event = existing_events.get((searchindex.id, event_id))
+                if not event:
+                    event = Event(
+                        sketch=sketch, searchindex=searchindex,
+                        document_id=event_id)
+                    existing_events[(searchindex.id, event_id)] = event
+                    db_session.add(event)
 
                 # Add the annotation to the event object.
                 if u'comment' in annotation_type:
                     annotation = Event.Comment(
                         comment=form.annotation.data, user=current_user)
-                    event.comments.append(annotation)
-                    self.datastore.set_label(
-                        searchindex_id, event_id, event_type, sketch.id,
-                        current_user.id, u'__ts_comment', toggle=False)
-
-                elif u'label' in annotation_type:
-                    annotation = Event.Label.get_or_create(
-                        label=form.annotation.data, user=current_user)
-                    if annotation not in event.labels:
-                        event.labels.append(annotation)
-                    toggle = False
-                    if u'__ts_star' or u'__ts_hidden' in form.annotation.data:
-                        toggle = True
-                    self.datastore.set_label(
-                        searchindex_id, event_id, event_type, sketch.id,
-                        current_user.id, form.annotation.data, toggle=toggle)
+                    annotation.parent = event
+                    db_session.add(annotation)
                 else:
-                    abort(HTTP_STATUS_CODE_BAD_REQUEST)
-
+                    annotation = None
+                    for event_label in event.labels:
+                        if (event_label.label == label and
+                                event_label.user_id == current_user.id):
+                            annotation = event_label
+                            break
+                    if not annotation:
+                        annotation = Event.Label(
+                            label=label, user=current_user)
+                        event.labels.append(annotation)
                 annotations.append(annotation)
-                # Save the event to the database
-                db_session.add(event)
-                db_session.commit()
+
+            # Save all events and annotations in one transaction.
+            db_session.commit()
+
+            # The annotations are saved even if labeling some events in the
+            # datastore failed, so tell the client how many did not make it.
+            failed_events = self.datastore.set_labels(
+                events, sketch.id, current_user.id, label, toggle=toggle)
+            meta = {u'failed_events': failed_events}
             return self.to_json(
-                annotations, status_code=HTTP_STATUS_CODE_CREATED)
+                annotations, meta=meta, status_code=HTTP_STATUS_CODE_CREATED)
         return abort(HTTP_STATUS_CODE_BAD_REQUEST)
 
 
@@ -911,6 +1302,14 @@ class UploadFileResource(ResourceMixin, Resource):
             file_extension = _extension.lstrip(u'.')
             timeline_name = form.name.data or _filename.rstrip(u'.')
 
+            # Plaso indexes the events in Elasticsearch itself.
+            if (file_extension == u'plaso' and
+                    current_app.config.get(u'DATASTORE') == u'sqlite'):
+                raise ApiHTTPError(
+                    message=u'Plaso files need the Elasticsearch datastore, '
+                            u'upload a CSV file instead.',
+                    status_code=HTTP_STATUS_CODE_BAD_REQUEST)
+
             sketch = None
             if sketch_id:
                 sketch = Sketch.query.get_with_acl(sketch_id)
@@ -988,7 +1387,8 @@ class TaskResource(ResourceMixin, Resource):
         TIMEOUT_THRESHOLD_SECONDS = current_app.config.get(
             u'CELERY_TASK_TIMEOUT', 7200)
         indices = SearchIndex.query.filter(SearchIndex.status.any(
-            status=u'processing')).filter_by(user=current_user).all()
+            SearchIndex.Status.status.in_(SEARCHINDEX_PROCESSING_STATUSES))
+        ).filter_by(user=current_user).all()
         schema = {u'objects': [], u'meta': {}}
         for search_index in indices:
             # pylint: disable=too-many-function-args
@@ -996,7 +1396,7 @@ class TaskResource(ResourceMixin, Resource):
             task = dict(
                 task_id=celery_task.task_id, state=celery_task.state,
                 successful=celery_task.successful(), name=search_index.name,
-                result=False)
+                status=search_index.get_status.status, result=False)
             if celery_task.state == u'SUCCESS':
                 task[u'result'] = celery_task.result
             elif celery_task.state == u'PENDING':
@@ -1124,8 +1524,10 @@ class QueryResource(ResourceMixin, Resource):
             query_string = form.query.data
             query_filter = form.filter.data
             query_dsl = form.dsl.data
+            indices = [t.searchindex.index_name for t in sketch.timelines]
             query = self.datastore.build_query(
-                sketch.id, query_string, query_filter, query_dsl)
+                sketch.id, query_string, query_filter, query_dsl,
+                indices=indices)
             schema[u'objects'].append(query)
             return jsonify(schema)
         return abort(HTTP_STATUS_CODE_BAD_REQUEST)
@@ -1144,15 +1546,7 @@ class CountEventsResource(ResourceMixin, Resource):
             Number of events in JSON (instance of flask.wrappers.Response)
         """
         sketch = Sketch.query.get_with_acl(sketch_id)
-
-        # Exclude any timeline that is processing, i.e. not ready yet.
-        indices = []
-        for timeline in sketch.timelines:
-            if timeline.searchindex.get_status.status == u'processing':
-                continue
-            indices.append(timeline.searchindex.index_name)
-
-        count = self.datastore.count(indices)
+        count = self.count_events(sketch)
         meta = dict(count=count)
         schema = dict(meta=meta, objects=[])
         return jsonify(schema)
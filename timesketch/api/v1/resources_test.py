@@ -14,6 +14,7 @@
 """Tests for v1 of the Timesketch API."""
 
 
+import datetime
 import json
 import mock
 
@@ -21,6 +22,9 @@ from timesketch.lib.definitions import HTTP_STATUS_CODE_CREATED
 from timesketch.lib.definitions import HTTP_STATUS_CODE_BAD_REQUEST
 from timesketch.lib.testlib import BaseTest
 from timesketch.lib.testlib import MockDataStore
+from timesketch.models import db_session
+from timesketch.models.querylog import SlowQuery
+from timesketch.models.sketch import Event
 
 
 class SketchListResourceTest(BaseTest):
@@ -165,7 +169,8 @@ class ExploreResourceTest(BaseTest):
                 u'test': u'FFFFFF'
             },
             u'es_total_count': 1,
-            u'es_time': 5
+            u'es_time': 5,
+            u'es_cached': False
         },
         u'objects': [
             {
@@ -202,6 +207,144 @@ class ExploreResourceTest(BaseTest):
         self.assertDictEqual(response.json, self.expected_response)
         self.assert200(response)
 
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_search_include(self):
+        """Authenticated request to query with aggregations and counts."""
+        self.login()
+        data = dict(
+            query=u'test', filter={},
+            include=[u'heatmap', u'timeline_counts', u'count'])
+        response = self.client.post(
+            self.resource_url, data=json.dumps(data, ensure_ascii=False),
+            content_type=u'application/json')
+        self.assert200(response)
+        meta = response.json[u'meta']
+        self.assertEqual(len(meta[u'heatmap']), 168)
+        self.assertEqual(meta[u'timeline_counts'], {})
+        self.assertEqual(meta[u'count'], 1)
+        self.assertNotIn(u'histogram', meta)
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_search_include_histogram(self):
+        """Histogram interval is chosen from the recorded time span."""
+        self.login()
+        self.searchindex.set_stats({
+            u'event_count': 1,
+            u'min_datetime': datetime.datetime(2017, 1, 1),
+            u'max_datetime': datetime.datetime(2017, 1, 31)
+        })
+        self._commit_to_database(self.searchindex)
+        data = dict(query=u'test', filter={}, include=[u'histogram'])
+        with mock.patch.object(
+                MockDataStore, u'search', autospec=True,
+                return_value=MockDataStore.search_result_dict) as search:
+            response = self.client.post(
+                self.resource_url, data=json.dumps(data, ensure_ascii=False),
+                content_type=u'application/json')
+        self.assert200(response)
+        # The hits and the histogram come from one search request.
+        self.assertEqual(search.call_count, 1)
+        meta = response.json[u'meta']
+        self.assertEqual(meta[u'histogram_interval'], u'1d')
+        self.assertEqual(meta[u'histogram_interval_ms'], 86400000)
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_search_failed_timeline(self):
+        """Timelines that failed to import are not searched."""
+        self.login()
+        self.searchindex.set_status(u'fail')
+        data = dict(query=u'test', filter={})
+        with mock.patch.object(
+                MockDataStore, u'search', autospec=True,
+                return_value=MockDataStore.search_result_dict) as search:
+            response = self.client.post(
+                self.resource_url, data=json.dumps(data, ensure_ascii=False),
+                content_type=u'application/json')
+        self.assert200(response)
+        # The indices are the argument after the query DSL.
+        self.assertEqual(search.call_args[0][5], [])
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_search_next_cursor(self):
+        """Authenticated request to get a full page with a cursor."""
+        self.login()
+        data = dict(query=u'test', filter={u'limit': 1}, paginate=True)
+        with mock.patch.object(
+                MockDataStore, u'search_result_dict',
+                dict(MockDataStore.search_result_dict, next_cursor=u'abc')):
+            response = self.client.post(
+                self.resource_url, data=json.dumps(data, ensure_ascii=False),
+                content_type=u'application/json')
+        self.assert200(response)
+        self.assertEqual(response.json[u'meta'][u'next_cursor'], u'abc')
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_search_include_invalid(self):
+        """Authenticated request with an unknown include option."""
+        self.login()
+        data = dict(query=u'test', filter={}, include=[u'foo'])
+        response = self.client.post(
+            self.resource_url, data=json.dumps(data, ensure_ascii=False),
+            content_type=u'application/json')
+        self.assert400(response)
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_search_sample(self):
+        """Authenticated request to query a sample of the events."""
+        self.login()
+        data = dict(query=u'test', filter={u'sample': 0.5})
+        response = self.client.post(
+            self.resource_url, data=json.dumps(data, ensure_ascii=False),
+            content_type=u'application/json')
+        self.assert200(response)
+        meta = response.json[u'meta']
+        self.assertTrue(meta[u'sampled'])
+        self.assertEqual(meta[u'sample_count'], 1)
+        self.assertEqual(meta[u'es_total_count'], 2)
+
+        data = dict(query=u'test', filter={u'sample': 2})
+        response = self.client.post(
+            self.resource_url, data=json.dumps(data, ensure_ascii=False),
+            content_type=u'application/json')
+        self.assert400(response)
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_search_query_budget(self):
+        """Test that the number of queries does not grow with timelines."""
+        self.login()
+        data = json.dumps(
+            dict(query=u'test', filter={}, include=[u'count']),
+            ensure_ascii=False)
+        # The first request creates the user state view and records the
+        # stats of the existing timeline, which is only done once.
+        self.client.post(
+            self.resource_url, data=data, content_type=u'application/json')
+        with self.assertMaxQueries(10) as counter:
+            self.client.post(
+                self.resource_url, data=data, content_type=u'application/json')
+
+        for number in range(5):
+            name = u'test{0:d}'.format(number)
+            searchindex = self._create_searchindex(
+                name=name, user=self.user1, acl=True)
+            searchindex.event_count = 1
+            searchindex.set_status(u'ready')
+            self._create_timeline(
+                name=name, sketch=self.sketch1, searchindex=searchindex,
+                user=self.user1)
+        with self.assertMaxQueries(counter.count, max_repeats=1):
+            response = self.client.post(
+                self.resource_url, data=data, content_type=u'application/json')
+        self.assert200(response)
+        self.assertEqual(len(response.json[u'meta'][u'timeline_names']), 6)
+
 
 class AggregationResourceTest(BaseTest):
     """Test ExploreResource."""
@@ -219,6 +362,78 @@ class AggregationResourceTest(BaseTest):
         self.assertEqual(len(response.json[u'objects']), 168)
         self.assert200(response)
 
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_histogram_invalid_zoom(self):
+        """Authenticated request with a zoom window that ends too early."""
+        self.login()
+        data = dict(
+            query=u'test', filter={}, aggtype=u'histogram',
+            zoom_start=3600000, zoom_end=3600000)
+        response = self.client.post(
+            self.resource_url, data=json.dumps(data, ensure_ascii=False),
+            content_type=u'application/json')
+        self.assert400(response)
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_heatmap_per_timeline(self):
+        """Authenticated request to get heatmap split by timeline."""
+        self.login()
+        data = dict(
+            query=u'test', filter={}, aggtype=u'heatmap', per_timeline=True)
+        response = self.client.post(
+            self.resource_url, data=json.dumps(data, ensure_ascii=False),
+            content_type=u'application/json')
+        self.assert200(response)
+        self.assertEqual(response.json[u'objects'][0][u'timelines'], {})
+        self.assertEqual(
+            response.json[u'meta'][u'timeline_colors'], {u'test': u'FFFFFF'})
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_per_timeline_query_budget(self):
+        """Test that timelines are not loaded one query at a time."""
+        for number in range(5):
+            name = u'test{0:d}'.format(number)
+            searchindex = self._create_searchindex(
+                name=name, user=self.user1, acl=True)
+            self._create_timeline(
+                name=name, sketch=self.sketch1, searchindex=searchindex,
+                user=self.user1)
+        self.login()
+        data = dict(
+            query=u'test', filter={}, aggtype=u'heatmap', per_timeline=True)
+        with self.assertMaxQueries(8, max_repeats=1):
+            response = self.client.post(
+                self.resource_url, data=json.dumps(data, ensure_ascii=False),
+                content_type=u'application/json')
+        self.assert200(response)
+        self.assertEqual(len(response.json[u'meta'][u'timeline_colors']), 6)
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_field_stats_aggregation(self):
+        """Authenticated request to get the values of a field."""
+        self.login()
+        data = dict(
+            query=u'test', filter={}, aggtype=u'field_stats',
+            field=u'hostname', size=5)
+        response = self.client.post(
+            self.resource_url, data=json.dumps(data, ensure_ascii=False),
+            content_type=u'application/json')
+        self.assert200(response)
+        self.assertEqual(response.json[u'objects'], [])
+        self.assertEqual(response.json[u'meta'][u'field'], u'hostname')
+        self.assertFalse(response.json[u'meta'][u'sampled'])
+
+        # The field is required.
+        data = dict(query=u'test', filter={}, aggtype=u'field_stats')
+        response = self.client.post(
+            self.resource_url, data=json.dumps(data, ensure_ascii=False),
+            content_type=u'application/json')
+        self.assert400(response)
+
 
 class EventResourceTest(BaseTest):
     """Test EventResource."""
@@ -260,6 +475,43 @@ class EventResourceTest(BaseTest):
         self.assert400(response_400)
 
 
+class EventBatchResourceTest(BaseTest):
+    """Test EventBatchResource."""
+    resource_url = u'/api/v1/sketches/1/event/batch/'
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_get_events(self):
+        """Authenticated request to get many events with their comments."""
+        self.login()
+        events = [
+            {u'_index': u'test', u'_id': u'test'},
+            {u'_index': u'test', u'_id': u'test2'}
+        ]
+        response = self.client.post(
+            self.resource_url, data=json.dumps(dict(events=events)),
+            content_type=u'application/json')
+        self.assert200(response)
+        objects = response.json[u'objects']
+        self.assertEqual([event[u'_id'] for event in objects],
+                         [u'test', u'test2'])
+        self.assertEqual(objects[0][u'comments'][0][u'comment'], u'test')
+        self.assertEqual(
+            objects[0][u'comments'][0][u'user'][u'username'], u'test1')
+        self.assertEqual(objects[1][u'comments'], [])
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_invalid_index(self):
+        """Authenticated request to get events from the wrong index."""
+        self.login()
+        events = [{u'_index': u'wrong_index', u'_id': u'test'}]
+        response = self.client.post(
+            self.resource_url, data=json.dumps(dict(events=events)),
+            content_type=u'application/json')
+        self.assert400(response)
+
+
 class EventAnnotationResourceTest(BaseTest):
     """Test EventAnnotationResource."""
     resource_url = u'/api/v1/sketches/1/event/annotate/'
@@ -283,6 +535,43 @@ class EventAnnotationResourceTest(BaseTest):
             self.assertIsInstance(response.json, dict)
             self.assertEquals(response.status_code, HTTP_STATUS_CODE_CREATED)
 
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_post_annotate_many_events(self):
+        """Authenticated request to annotate many events at once."""
+        self.login()
+        events = [
+            {u'_type': u'test_event', u'_index': u'test', u'_id': u'test'},
+            {u'_type': u'test_event', u'_index': u'test', u'_id': u'test2'},
+            {u'_type': u'test_event', u'_index': u'test', u'_id': u'test3'}
+        ]
+        data = dict(
+            annotation=u'__ts_star', annotation_type=u'label', events=events)
+        response = self.client.post(
+            self.resource_url, data=json.dumps(data),
+            content_type=u'application/json')
+        self.assertEquals(response.status_code, HTTP_STATUS_CODE_CREATED)
+        self.assertEqual(len(response.json[u'objects'][0]), 3)
+        # One event already existed, two are new.
+        self.assertEqual(
+            Event.query.filter_by(sketch_id=self.sketch1.id).count(), 3)
+        self.assertEqual(response.json[u'meta'][u'failed_events'], 0)
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_post_annotate_reports_failed_events(self):
+        """Events the datastore failed to label are reported in meta."""
+        self.login()
+        event = {u'_type': u'test_event', u'_index': u'test', u'_id': u'test'}
+        data = dict(
+            annotation=u'__ts_star', annotation_type=u'label', events=[event])
+        with mock.patch.object(MockDataStore, u'set_labels', return_value=1):
+            response = self.client.post(
+                self.resource_url, data=json.dumps(data),
+                content_type=u'application/json')
+        self.assertEquals(response.status_code, HTTP_STATUS_CODE_CREATED)
+        self.assertEqual(response.json[u'meta'][u'failed_events'], 1)
+
     def test_post_annotate_invalid_index_resource(self):
         """
         Authenticated request to create an annotation, but in the wrong index.
@@ -295,3 +584,76 @@ class EventAnnotationResourceTest(BaseTest):
             self.resource_url, data=json.dumps(data),
             content_type=u'application/json')
         self.assertEquals(response.status_code, HTTP_STATUS_CODE_BAD_REQUEST)
+
+
+class CountEventsResourceTest(BaseTest):
+    """Test CountEventsResource."""
+    resource_url = u'/api/v1/sketches/1/count/'
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_count_from_database(self):
+        """Authenticated request to count events with recorded stats."""
+        self.login()
+        self.searchindex.set_stats({u'event_count': 42})
+        self._commit_to_database(self.searchindex)
+        response = self.client.get(self.resource_url)
+        self.assert200(response)
+        self.assertEqual(response.json[u'meta'][u'count'], 42)
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_count_failed_timeline(self):
+        """Timelines that failed to import are not counted."""
+        self.login()
+        self.searchindex.set_stats({u'event_count': 42})
+        self.searchindex.set_status(u'fail')
+        response = self.client.get(self.resource_url)
+        self.assert200(response)
+        self.assertEqual(response.json[u'meta'][u'count'], 0)
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_count_records_stats(self):
+        """Authenticated request to count events without recorded stats."""
+        self.login()
+        response = self.client.get(self.resource_url)
+        self.assert200(response)
+        self.assertEqual(response.json[u'meta'][u'count'], 1)
+        self.assertEqual(self.searchindex.event_count, 1)
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_count_records_stats_once(self):
+        """Stats of many indices are saved with one commit."""
+        searchindex = self._create_searchindex(name=u'test2', user=self.user1)
+        self._create_timeline(
+            name=u'Timeline 2', sketch=self.sketch1, searchindex=searchindex,
+            user=self.user1)
+        self.login()
+        with mock.patch.object(
+                db_session, u'commit', wraps=db_session.commit) as commit:
+            response = self.client.get(self.resource_url)
+        self.assert200(response)
+        self.assertEqual(response.json[u'meta'][u'count'], 2)
+        self.assertEqual(commit.call_count, 1)
+
+    @mock.patch(
+        u'timesketch.api.v1.resources.ElasticsearchDataStore', MockDataStore)
+    def test_count_slow_query_log(self):
+        """Slow datastore calls are recorded with the current user."""
+        def slow_index_stats(datastore, unused_index_name):
+            datastore.slow_query_callback(
+                operation=u'count', duration=3000, index_count=1)
+            return {u'event_count': 1}
+
+        self.login()
+        with mock.patch.object(
+                MockDataStore, u'index_stats', autospec=True,
+                side_effect=slow_index_stats):
+            response = self.client.get(self.resource_url)
+        self.assert200(response)
+        entry = SlowQuery.query.one()
+        self.assertEqual(entry.operation, u'count')
+        self.assertEqual(entry.duration, 3000)
+        self.assertEqual(entry.user_id, self.user1.id)
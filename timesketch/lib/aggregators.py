@@ -13,21 +13,125 @@
 # limitations under the License.
 """Elasticsearch aggregations."""
 
+import calendar
+from collections import Counter
+import functools
+import math
 
-def heatmap(
-        es_client, sketch_id, query_string, query_filter, query_dsl, indices):
-    """Aggregate query results into number of events per hour/day.
+from timesketch.lib.datastores.elastic import get_aggregation_field
+from timesketch.lib.utils import get_sample_rate
+
+# Filter keys that don't change the result of an aggregation.
+IGNORED_FILTER_KEYS = frozenset([u'limit', u'order'])
+
+# Intervals the histogram can use, from fine to coarse, with their length in
+# seconds. Months and years are calendar intervals, their length is the
+# average.
+HISTOGRAM_INTERVALS = [
+    (u'1s', 1), (u'10s', 10), (u'1m', 60), (u'10m', 600), (u'1h', 3600),
+    (u'6h', 21600), (u'1d', 86400), (u'7d', 604800), (u'month', 2629746),
+    (u'year', 31556952)
+]
+
+# Number of histogram buckets to aim for.
+DEFAULT_TARGET_BUCKETS = 100
+
+# Number of top terms to return for a field, and the maximum allowed.
+DEFAULT_TERMS_SIZE = 10
+MAX_TERMS_SIZE = 1000
+
+# Standard score for the 95% confidence interval of sampled estimates.
+CONFIDENCE_Z = 1.96
+
+
+def cached(aggregator):
+    """Decorator that caches the result of an aggregator.
+
+    Results are cached in the query cache of the datastore, if it has one,
+    and are invalidated together with search results when events in any of
+    the indices are labeled or added.
 
     Args:
-        es_client: Elasticsearch client (instance of ElasticSearchDatastore)
-        sketch_id: Integer of sketch primary key
-        query_string: Query string
-        query_filter: Dictionary containing filters to apply
-        query_dsl: Dictionary containing Elasticsearch DSL to apply
-        indices: List of indices to query
+        aggregator: Aggregator function
 
-    returns:
-        List of events per hour/day
+    Returns:
+        Aggregator function that uses the cache.
+    """
+    @functools.wraps(aggregator)
+    def wrapper(
+            es_client, sketch_id, query_string, query_filter, query_dsl,
+            indices, **kwargs):
+        """Run the aggregator, or get its result from the cache."""
+        query_cache = getattr(es_client, u'query_cache', None)
+        if not query_cache:
+            return aggregator(
+                es_client, sketch_id, query_string, query_filter, query_dsl,
+                indices, **kwargs)
+
+        cache_filter = {
+            key: value for key, value in query_filter.items()
+            if key not in IGNORED_FILTER_KEYS
+        }
+        cache_key = query_cache.make_key(aggregator.__name__, {
+            u'sketch_id': sketch_id,
+            u'query_string': query_string,
+            u'query_filter': cache_filter,
+            u'query_dsl': query_dsl,
+            u'options': kwargs
+        }, indices)
+        result = query_cache.get(cache_key)
+        if result is None:
+            result = aggregator(
+                es_client, sketch_id, query_string, query_filter, query_dsl,
+                indices, **kwargs)
+            query_cache.set(cache_key, result)
+        return result
+    return wrapper
+
+
+def timeline_aggregation(timeline_count):
+    """Elasticsearch sub-aggregation that splits a bucket per timeline.
+
+    Args:
+        timeline_count: Number of timelines (indices) that are queried
+
+    Returns:
+        Dictionary with a terms aggregation on the index.
+    """
+    return {
+        u'timelines': {
+            u'terms': {
+                u'field': u'_index',
+                u'size': max(timeline_count, 1)
+            }
+        }
+    }
+
+
+def timeline_counts(bucket):
+    """Get the number of events per timeline in a bucket.
+
+    Args:
+        bucket: Bucket with a timeline_aggregation() sub-aggregation
+
+    Returns:
+        Dictionary with index name as key and number of events as value.
+    """
+    return {
+        timeline[u'key']: timeline[u'doc_count']
+        for timeline in bucket.get(u'timelines', {}).get(u'buckets', [])
+    }
+
+
+def heatmap_aggregation(timeline_count=0):
+    """Elasticsearch aggregation for the heatmap.
+
+    Args:
+        timeline_count: Number of timelines to split each bucket by, 0 to
+            not split
+
+    Returns:
+        Dictionary with the heatmap aggregation.
     """
     aggregation = {
         u'heatmap': {
@@ -38,38 +142,413 @@ def heatmap(
             }
         }
     }
+    if timeline_count:
+        aggregation[u'heatmap'][u'aggregations'] = timeline_aggregation(
+            timeline_count)
+    return aggregation
+
+
+def histogram_aggregation(
+        interval=u'1d', zoom_start=None, zoom_end=None, timeline_count=0):
+    """Elasticsearch aggregation for the histogram.
+
+    The zoom window only sets the bounds of the buckets. The events have to
+    be limited to the window with zoom_filter() on the query.
+
+    Args:
+        interval: Elasticsearch date histogram interval
+        zoom_start: Optional start of the zoom window in epoch milliseconds
+        zoom_end: Optional end of the zoom window in epoch milliseconds
+        timeline_count: Number of timelines to split each bucket by, 0 to
+            not split
+
+    Returns:
+        Dictionary with the histogram aggregation.
+    """
+    # Show the time of day for intervals shorter than a day.
+    date_format = u'yyyy-MM-dd'
+    if dict(HISTOGRAM_INTERVALS).get(interval, 86400) < 86400:
+        date_format = u"yyyy-MM-dd'T'HH:mm:ss"
+
+    date_histogram = {
+        u'date_histogram': {
+            u'field': u'datetime',
+            u'interval': interval,
+            u'format': date_format
+        }
+    }
+    if timeline_count:
+        date_histogram[u'aggregations'] = timeline_aggregation(timeline_count)
+    if zoom_start is not None and zoom_end is not None:
+        date_histogram[u'date_histogram'][u'extended_bounds'] = {
+            u'min': zoom_start,
+            u'max': zoom_end
+        }
+    return {u'histogram': date_histogram}
+
+
+def zoom_filter(query_filter, zoom_start=None, zoom_end=None):
+    """Limit a query to the zoom window of a histogram.
+
+    The window is applied in the filter context of the query, so events
+    outside of it are never matched or scored.
+
+    Args:
+        query_filter: Dictionary containing filters to apply
+        zoom_start: Optional start of the zoom window in epoch milliseconds
+        zoom_end: Optional end of the zoom window in epoch milliseconds
+
+    Returns:
+        Copy of the filter with the window in zoom, or the filter itself if
+        there is no zoom window.
+    """
+    if zoom_start is None or zoom_end is None:
+        return query_filter
+    return dict(query_filter, zoom={u'start': zoom_start, u'end': zoom_end})
 
-    search_result = es_client.search(
-        sketch_id, query_string, query_filter, query_dsl, indices,
-        aggregations=aggregation, return_results=False, return_fields=None,
-        enable_scroll=False)
 
+def time_bounds_aggregation():
+    """Elasticsearch aggregation for the first and last event.
+
+    Returns:
+        Dictionary with min and max aggregations.
+    """
+    return {
+        u'time_min': {u'min': {u'field': u'datetime'}},
+        u'time_max': {u'max': {u'field': u'datetime'}}
+    }
+
+
+def field_aggregation(field_name, size=DEFAULT_TERMS_SIZE, sample_size=None):
+    """Elasticsearch aggregation for the values of a field.
+
+    Args:
+        field_name: Name of the event field
+        size: Number of top terms to get
+        sample_size: Optional number of events per shard to aggregate on
+            instead of all matching events
+
+    Returns:
+        Dictionary with top terms, cardinality, min/max and missing
+        aggregations, in a sampler aggregation if sample_size is set.
+    """
+    field = get_aggregation_field(field_name)
+    aggregations = {
+        u'field_terms': {u'terms': {u'field': field, u'size': size}},
+        u'field_cardinality': {u'cardinality': {u'field': field}},
+        u'field_missing': {u'missing': {u'field': field}},
+        # Ordering on the term works for keyword, date and numeric fields,
+        # unlike the min and max aggregations.
+        u'field_min': {u'terms': {
+            u'field': field, u'size': 1, u'order': {u'_term': u'asc'}}},
+        u'field_max': {u'terms': {
+            u'field': field, u'size': 1, u'order': {u'_term': u'desc'}}}
+    }
+    if not sample_size:
+        return aggregations
+    return {
+        u'field_sample': {
+            u'sampler': {u'shard_size': sample_size},
+            u'aggregations': aggregations
+        }
+    }
+
+
+def choose_interval(start, end, target_buckets=DEFAULT_TARGET_BUCKETS):
+    """Choose the histogram interval for a time span.
+
+    Args:
+        start: Start of the time span in epoch milliseconds
+        end: End of the time span in epoch milliseconds
+        target_buckets: Maximum number of buckets to aim for
+
+    Returns:
+        Tuple of Elasticsearch interval and its length in seconds. This is
+        the shortest interval that gives at most target_buckets buckets.
+    """
+    span = max(0, end - start) / 1000.0
+    for interval, seconds in HISTOGRAM_INTERVALS:
+        if span / seconds <= target_buckets:
+            return interval, seconds
+    return HISTOGRAM_INTERVALS[-1]
+
+
+def sample_estimate(count, sample_rate):
+    """Estimate the number of events from the number in a random sample.
+
+    Every event is in the sample with probability sample_rate, so the
+    number of sampled events is binomially distributed.
+
+    Args:
+        count: Number of events in the sample
+        sample_rate: Fraction of the events that were sampled
+
+    Returns:
+        Tuple of the estimated number of events and the margin of error of
+        the 95% confidence interval.
+    """
+    estimate = count / sample_rate
+    margin = CONFIDENCE_Z * math.sqrt(count * (1 - sample_rate)) / sample_rate
+    return int(round(estimate)), int(math.ceil(margin))
+
+
+def scale_sample(buckets, sample_rate, count_key=u'doc_count'):
+    """Replace sampled counts in buckets by estimates for all events.
+
+    Each bucket gets the margin of error of its count in an error key. The
+    number of events per timeline, if any, is scaled as well.
+
+    Args:
+        buckets: List of bucket dictionaries, updated in place
+        sample_rate: Fraction of the events that were sampled
+        count_key: Key of the number of events in a bucket
+
+    Returns:
+        The list of buckets.
+    """
+    for bucket in buckets:
+        bucket[count_key], bucket[u'error'] = sample_estimate(
+            bucket[count_key], sample_rate)
+        if u'timelines' in bucket:
+            bucket[u'timelines'] = {
+                index_name: sample_estimate(count, sample_rate)[0]
+                for index_name, count in bucket[u'timelines'].items()
+            }
+    return buckets
+
+
+def get_buckets(search_result, name):
+    """Get the buckets of an aggregation from a search result.
+
+    Args:
+        search_result: Elasticsearch search result
+        name: Name of the aggregation
+
+    Returns:
+        List of buckets, empty if the aggregation is missing.
+    """
     try:
         aggregation_result = search_result[u'aggregations']
         if aggregation_result.get(u'exclude', None):
-            buckets = aggregation_result[u'exclude'][u'heatmap'][u'buckets']
-        else:
-            buckets = aggregation_result[u'heatmap'][u'buckets']
+            return aggregation_result[u'exclude'][name][u'buckets']
+        return aggregation_result[name][u'buckets']
     except KeyError:
-        buckets = []
+        return []
+
 
+def heatmap_result(search_result, per_timeline=False):
+    """Get the number of events per hour/day from a search result.
+
+    Args:
+        search_result: Elasticsearch search result with the heatmap
+            aggregation
+        per_timeline: Boolean indicating if the number of events per
+            timeline should be added to each hour/day
+
+    Returns:
+        List of events per hour/day
+    """
     per_hour = {}
+    per_hour_timelines = {}
     for day in range(1, 8):
         for hour in range(0, 24):
             per_hour[(day, hour)] = 0
+            per_hour_timelines[(day, hour)] = Counter()
 
-    for bucket in buckets:
+    for bucket in get_buckets(search_result, u'heatmap'):
         day_hour = tuple(int(dh) for dh in bucket[u'key_as_string'].split(u','))
         count = bucket[u'doc_count']
         per_hour[day_hour] += count
+        per_hour_timelines[day_hour].update(timeline_counts(bucket))
 
-    return [dict(day=k[0], hour=k[1], count=v) for k, v in per_hour.items()]
+    result = [
+        dict(day=k[0], hour=k[1], count=v) for k, v in per_hour.items()]
+    if per_timeline:
+        for cell in result:
+            cell[u'timelines'] = dict(
+                per_hour_timelines[(cell[u'day'], cell[u'hour'])])
+    return result
 
 
-def histogram(
+def histogram_result(search_result):
+    """Get the number of events per time interval from a search result.
+
+    Args:
+        search_result: Elasticsearch search result with the histogram
+            aggregation
+
+    Returns:
+        List of buckets with number of events per time interval
+    """
+    try:
+        aggregation_result = search_result[u'aggregations'][u'histogram']
+    except KeyError:
+        return []
+    buckets = aggregation_result.get(u'buckets', [])
+    for bucket in buckets:
+        if u'timelines' in bucket:
+            bucket[u'timelines'] = timeline_counts(bucket)
+    return buckets
+
+
+def field_result(search_result):
+    """Get the values of a field from a search result.
+
+    Args:
+        search_result: Elasticsearch search result with the field
+            aggregation
+
+    Returns:
+        Dictionary with the top terms and their number of events, the
+        number of events with other terms, the approximate number of
+        distinct terms, the lowest and highest term, the number of events
+        without the field and, if sampled, the number of sampled events.
+    """
+    aggregation_result = search_result.get(u'aggregations', {})
+    sample = aggregation_result.get(u'field_sample')
+    if sample:
+        aggregation_result = sample
+
+    def _term(bucket):
+        """Get the term of a bucket, formatted for dates."""
+        return bucket.get(u'key_as_string', bucket[u'key'])
+
+    def _first_term(name):
+        """Get the term of the only bucket of an aggregation."""
+        buckets = aggregation_result.get(name, {}).get(u'buckets', [])
+        return _term(buckets[0]) if buckets else None
+
+    terms = aggregation_result.get(u'field_terms', {})
+    return {
+        u'terms': [
+            {u'term': _term(bucket), u'count': bucket[u'doc_count']}
+            for bucket in terms.get(u'buckets', [])
+        ],
+        u'other_count': terms.get(u'sum_other_doc_count', 0),
+        u'cardinality': aggregation_result.get(
+            u'field_cardinality', {}).get(u'value', 0),
+        u'min': _first_term(u'field_min'),
+        u'max': _first_term(u'field_max'),
+        u'missing': aggregation_result.get(
+            u'field_missing', {}).get(u'doc_count', 0),
+        u'sampled': bool(sample),
+        u'sample_count': sample.get(u'doc_count') if sample else None
+    }
+
+
+@cached
+def heatmap(
+        es_client, sketch_id, query_string, query_filter, query_dsl, indices,
+        per_timeline=False):
+    """Aggregate query results into number of events per hour/day.
+
+    Args:
+        es_client: Elasticsearch client (instance of ElasticSearchDatastore)
+        sketch_id: Integer of sketch primary key
+        query_string: Query string
+        query_filter: Dictionary containing filters to apply
+        query_dsl: Dictionary containing Elasticsearch DSL to apply
+        indices: List of indices to query
+        per_timeline: Boolean indicating if the number of events per
+            timeline should be added to each hour/day
+
+    returns:
+        List of events per hour/day. For a sampled query the counts are
+        estimates, with their margin of error in error.
+    """
+    timeline_count = len(indices) if per_timeline else 0
+    search_result = es_client.search(
+        sketch_id, query_string, query_filter, query_dsl, indices,
+        aggregations=heatmap_aggregation(timeline_count),
+        return_results=False, return_fields=None, enable_scroll=False)
+    result = heatmap_result(search_result, per_timeline)
+    sample_rate = get_sample_rate(query_filter)
+    if sample_rate:
+        scale_sample(result, sample_rate, count_key=u'count')
+    return result
+
+
+@cached
+def time_bounds(
         es_client, sketch_id, query_string, query_filter, query_dsl, indices):
+    """Get the time of the first and the last event matching a query.
+
+    The result is cached, so all zoom levels of a histogram share it.
+
+    Args:
+        es_client: Elasticsearch client (instance of ElasticSearchDatastore)
+        sketch_id: Integer of sketch primary key
+        query_string: Query string
+        query_filter: Dictionary containing filters to apply
+        query_dsl: Dictionary containing Elasticsearch DSL to apply
+        indices: List of indices to query
+
+    returns:
+        Dictionary with start and end in epoch milliseconds, None if no
+        events match.
+    """
+    search_result = es_client.search(
+        sketch_id, query_string, query_filter, query_dsl, indices,
+        aggregations=time_bounds_aggregation(), return_results=False)
+    aggregation_result = search_result.get(u'aggregations', {})
+    bounds = {}
+    for key, name in ((u'start', u'time_min'), (u'end', u'time_max')):
+        value = aggregation_result.get(name, {}).get(u'value')
+        bounds[key] = int(value) if value is not None else None
+    return bounds
+
+
+def histogram_interval(
+        es_client, sketch_id, query_string, query_filter, query_dsl, indices,
+        zoom_start=None, zoom_end=None,
+        target_buckets=DEFAULT_TARGET_BUCKETS, time_span=None):
+    """Choose the histogram interval for a query.
+
+    Without a zoom window or a time span this runs a search for the time of
+    the first and the last matching event.
+
+    Args:
+        es_client: Elasticsearch client (instance of ElasticSearchDatastore)
+        sketch_id: Integer of sketch primary key
+        query_string: Query string
+        query_filter: Dictionary containing filters to apply
+        query_dsl: Dictionary containing Elasticsearch DSL to apply
+        indices: List of indices to query
+        zoom_start: Optional start of the zoom window in epoch milliseconds
+        zoom_end: Optional end of the zoom window in epoch milliseconds
+        target_buckets: Maximum number of buckets to aim for
+        time_span: Optional tuple of the first and last datetime of the
+            events in the indices, e.g. from SearchIndex.time_span()
+
+    returns:
+        Tuple of Elasticsearch interval and its length in seconds, or None
+        if no events match.
+    """
+    if zoom_start is not None and zoom_end is not None:
+        return choose_interval(zoom_start, zoom_end, target_buckets)
+
+    if time_span:
+        start, end = [
+            calendar.timegm(time.utctimetuple()) * 1000 for time in time_span]
+        return choose_interval(start, end, target_buckets)
+
+    bounds = time_bounds(
+        es_client, sketch_id, query_string, query_filter, query_dsl, indices)
+    if bounds[u'start'] is None or bounds[u'end'] is None:
+        return None
+    return choose_interval(bounds[u'start'], bounds[u'end'], target_buckets)
+
+
+@cached
+def histogram(
+        es_client, sketch_id, query_string, query_filter, query_dsl, indices,
+        zoom_start=None, zoom_end=None,
+        target_buckets=DEFAULT_TARGET_BUCKETS, per_timeline=False):
     """Aggregate query results into number of events per time interval.
 
+    The interval is chosen from the time span of the matching events, or of
+    the zoom window, to get about target_buckets buckets.
+
     Args:
         es_client: Elasticsearch client (instance of ElasticSearchDatastore)
         sketch_id: Integer of sketch primary key
@@ -77,31 +556,75 @@ def histogram(
         query_filter: Dictionary containing filters to apply
         query_dsl: Dictionary containing Elasticsearch DSL to apply
         indices: List of indices to query
+        zoom_start: Optional start of the zoom window in epoch milliseconds
+        zoom_end: Optional end of the zoom window in epoch milliseconds
+        target_buckets: Maximum number of buckets to aim for
+        per_timeline: Boolean indicating if the number of events per
+            timeline should be added to each bucket
 
     returns:
-        List of events per hour/day
+        Dictionary with the interval, its length in milliseconds and the
+        list of buckets. For a sampled query the counts are estimates, with
+        their margin of error in error.
     """
-    aggregation = {
-        u'histogram': {
-            u'date_histogram': {
-                u'field': u'datetime',
-                u'interval': u'day',
-                u'format': u'yyyy-MM-dd'
-            }
-        }
-    }
+    interval = histogram_interval(
+        es_client, sketch_id, query_string, query_filter, query_dsl, indices,
+        zoom_start=zoom_start, zoom_end=zoom_end,
+        target_buckets=target_buckets)
+    if not interval:
+        return {u'interval': None, u'interval_ms': None, u'buckets': []}
 
+    interval, seconds = interval
+    timeline_count = len(indices) if per_timeline else 0
     search_result = es_client.search(
-        sketch_id, query_string, query_filter, query_dsl, indices,
-        aggregations=aggregation, return_results=False)
+        sketch_id, query_string,
+        zoom_filter(query_filter, zoom_start, zoom_end), query_dsl, indices,
+        aggregations=histogram_aggregation(
+            interval, zoom_start, zoom_end, timeline_count),
+        return_results=False)
+    buckets = histogram_result(search_result)
+    sample_rate = get_sample_rate(query_filter)
+    if sample_rate:
+        scale_sample(buckets, sample_rate)
+    return {
+        u'interval': interval,
+        u'interval_ms': seconds * 1000,
+        u'buckets': buckets
+    }
 
-    try:
-        aggregation_result = search_result[u'aggregations']
-        if aggregation_result.get(u'exclude', None):
-            buckets = aggregation_result[u'exclude'][u'histogram'][u'buckets']
-        else:
-            buckets = aggregation_result[u'histogram'][u'buckets']
-    except KeyError:
-        buckets = []
 
-    return buckets
+@cached
+def field_stats(
+        es_client, sketch_id, query_string, query_filter, query_dsl, indices,
+        field_name=None, size=DEFAULT_TERMS_SIZE, sample_size=None):
+    """Aggregate query results into the values of a field.
+
+    Args:
+        es_client: Elasticsearch client (instance of ElasticSearchDatastore)
+        sketch_id: Integer of sketch primary key
+        query_string: Query string
+        query_filter: Dictionary containing filters to apply
+        query_dsl: Dictionary containing Elasticsearch DSL to apply
+        indices: List of indices to query
+        field_name: Name of the event field
+        size: Number of top terms to get
+        sample_size: Optional number of events per shard to aggregate on.
+            Sampling makes the aggregation faster on huge sketches, counts
+            are then for the sample only.
+
+    returns:
+        Dictionary with the values of the field, see field_result().
+    """
+    search_result = es_client.search(
+        sketch_id, query_string, query_filter, query_dsl, indices,
+        aggregations=field_aggregation(field_name, size, sample_size),
+        return_results=False, return_fields=None, enable_scroll=False)
+    result = field_result(search_result)
+    sample_rate = get_sample_rate(query_filter)
+    if sample_rate:
+        # The number of distinct terms can not be scaled, it is the number
+        # in the sample.
+        scale_sample(result[u'terms'], sample_rate, count_key=u'count')
+        for key in (u'other_count', u'missing'):
+            result[key] = sample_estimate(result[key], sample_rate)[0]
+    return result
@@ -14,11 +14,36 @@
 """Tests for aggregations."""
 
 
+from timesketch.lib.aggregators import choose_interval
+from timesketch.lib.aggregators import field_aggregation
+from timesketch.lib.aggregators import field_result
 from timesketch.lib.aggregators import heatmap
+from timesketch.lib.aggregators import heatmap_result
+from timesketch.lib.aggregators import histogram
+from timesketch.lib.aggregators import histogram_aggregation
+from timesketch.lib.aggregators import histogram_result
+from timesketch.lib.aggregators import sample_estimate
+from timesketch.lib.aggregators import scale_sample
+from timesketch.lib.aggregators import zoom_filter
+from timesketch.lib.cache import LocalCache
+from timesketch.lib.cache import QueryCache
 from timesketch.lib.testlib import BaseTest
 from timesketch.lib.testlib import MockDataStore
 
 
+class CountingDataStore(MockDataStore):
+    """A mock datastore with a query cache that counts searches."""
+    def __init__(self, host, port):
+        super(CountingDataStore, self).__init__(host, port)
+        self.query_cache = QueryCache(LocalCache())
+        self.searches = 0
+
+    def search(self, *args, **kwargs):
+        """Count and mock a search."""
+        self.searches += 1
+        return super(CountingDataStore, self).search(*args, **kwargs)
+
+
 class TestAggregators(BaseTest):
     """Tests for the functionality of the aggregation module."""
     def test_heatmap(self):
@@ -27,3 +52,111 @@ class TestAggregators(BaseTest):
         h = heatmap(es_client, 1, u'test', {}, [], [u'all'])
         self.assertEqual(len(h), 168)
         self.assertIsInstance(h, list)
+
+    def test_cached_aggregation(self):
+        """Test that aggregations are cached without limit and order."""
+        es_client = CountingDataStore(u'127.0.0,1', 4711)
+        first = histogram(
+            es_client, 1, u'test', {u'limit': 40}, [], [u'all'])
+        second = histogram(
+            es_client, 1, u'test', {u'order': u'desc'}, [], [u'all'])
+        self.assertEqual(first, second)
+        self.assertEqual(es_client.searches, 1)
+
+        es_client.query_cache.bump(u'all')
+        histogram(es_client, 1, u'test', {}, [], [u'all'])
+        self.assertEqual(es_client.searches, 2)
+
+    def test_choose_interval(self):
+        """Test that the interval follows the time span."""
+        hour = 3600 * 1000
+        self.assertEqual(choose_interval(0, hour)[0], u'1m')
+        self.assertEqual(choose_interval(0, 30 * 24 * hour)[0], u'1d')
+        self.assertEqual(choose_interval(0, 5 * 365 * 24 * hour)[0], u'month')
+        self.assertEqual(choose_interval(0, 0)[0], u'1s')
+
+    def test_zoomed_histogram(self):
+        """Test that a zoom window limits the query and the buckets."""
+        aggregation = histogram_aggregation(u'1m', 0, 3600000)
+        self.assertEqual(
+            aggregation[u'histogram'][u'date_histogram'][u'extended_bounds'],
+            {u'min': 0, u'max': 3600000})
+        query_filter = {u'limit': 10}
+        self.assertIs(zoom_filter(query_filter), query_filter)
+        self.assertEqual(
+            zoom_filter(query_filter, 0, 3600000),
+            {u'limit': 10, u'zoom': {u'start': 0, u'end': 3600000}})
+        self.assertEqual(query_filter, {u'limit': 10})
+
+    def test_per_timeline(self):
+        """Test that buckets are split by timeline."""
+        search_result = {
+            u'aggregations': {
+                u'heatmap': {
+                    u'buckets': [{
+                        u'key_as_string': u'1,0',
+                        u'doc_count': 3,
+                        u'timelines': {
+                            u'buckets': [
+                                {u'key': u'index1', u'doc_count': 2},
+                                {u'key': u'index2', u'doc_count': 1}
+                            ]
+                        }
+                    }]
+                }
+            }
+        }
+        cells = heatmap_result(search_result, per_timeline=True)
+        cell = [c for c in cells if c[u'day'] == 1 and c[u'hour'] == 0][0]
+        self.assertEqual(cell[u'count'], 3)
+        self.assertEqual(cell[u'timelines'], {u'index1': 2, u'index2': 1})
+
+    def test_field_aggregation(self):
+        """Test the aggregation and result for the values of a field."""
+        aggregation = field_aggregation(u'hostname', size=5, sample_size=100)
+        sample = aggregation[u'field_sample']
+        self.assertEqual(sample[u'sampler'], {u'shard_size': 100})
+        self.assertEqual(
+            sample[u'aggregations'][u'field_terms'][u'terms'],
+            {u'field': u'hostname.keyword', u'size': 5})
+        self.assertEqual(
+            field_aggregation(u'data_type')[u'field_cardinality'],
+            {u'cardinality': {u'field': u'data_type'}})
+
+        search_result = {
+            u'aggregations': {
+                u'field_sample': {
+                    u'doc_count': 100,
+                    u'field_terms': {
+                        u'sum_other_doc_count': 10,
+                        u'buckets': [
+                            {u'key': u'host1', u'doc_count': 60},
+                            {u'key': u'host2', u'doc_count': 30}
+                        ]
+                    },
+                    u'field_cardinality': {u'value': 5},
+                    u'field_missing': {u'doc_count': 0},
+                    u'field_min': {u'buckets': [
+                        {u'key': u'host0', u'doc_count': 1}]},
+                    u'field_max': {u'buckets': [
+                        {u'key': u'host9', u'doc_count': 2}]}
+                }
+            }
+        }
+        result = field_result(search_result)
+        self.assertEqual(result[u'terms'][0], {u'term': u'host1', u'count': 60})
+        self.assertEqual(result[u'other_count'], 10)
+        self.assertEqual(result[u'cardinality'], 5)
+        self.assertEqual((result[u'min'], result[u'max']), (u'host0', u'host9'))
+        self.assertTrue(result[u'sampled'])
+        self.assertEqual(result[u'sample_count'], 100)
+
+    def test_sample_estimate(self):
+        """Test estimating counts from a sample."""
+        self.assertEqual(sample_estimate(100, 0.01), (10000, 1951))
+        self.assertEqual(sample_estimate(0, 0.5), (0, 0))
+        buckets = scale_sample(
+            [{u'count': 10, u'timelines': {u'test': 5}}], 0.5,
+            count_key=u'count')
+        self.assertEqual(buckets, [
+            {u'count': 20, u'error': 9, u'timelines': {u'test': 10}}])
@@ -0,0 +1,272 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""End to end benchmarks of the API.
+
+Requests go through the whole Flask app with the test client. The app uses
+an in-memory database and the SQLite datastore as a local stand-in for
+Elasticsearch, loaded with the synthetic timeline. Run the benchmarks in the
+app context of create_benchmark_app().
+"""
+
+import functools
+import json
+import os
+
+from flask import current_app
+
+from timesketch import create_app
+from timesketch.api.v1.resources import ResourceMixin
+from timesketch.lib.benchmarks.runner import benchmark
+from timesketch.lib.datastores.sqlite import SqliteDataStore
+from timesketch.lib.datastores.sqlite import close_connection
+from timesketch.models import db_session
+from timesketch.models.sketch import Event
+from timesketch.models.sketch import SearchIndex
+from timesketch.models.sketch import Sketch
+from timesketch.models.sketch import Timeline
+from timesketch.models.sketch import View
+from timesketch.models.user import User
+
+# Name of the index with the synthetic timeline.
+INDEX_NAME = u'benchmark'
+
+# Number of events with a comment, and number of saved views in the sketch.
+COMMENTED_EVENTS = 100
+VIEW_COUNT = 50
+
+# Number of events in an event batch request.
+BATCH_SIZE = 100
+
+
+class BenchmarkConfig(object):
+    """Config for the benchmark app."""
+    SECRET_KEY = u'benchmark'
+    SQLALCHEMY_DATABASE_URI = u'sqlite://'
+    WTF_CSRF_ENABLED = False
+    UPLOAD_ENABLED = False
+    ELASTIC_HOST = u'127.0.0.1'
+    ELASTIC_PORT = 9200
+    DATASTORE = u'sqlite'
+
+
+def create_benchmark_app(context):
+    """Create a Timesketch app that only uses local, temporary storage.
+
+    Args:
+        context: Instance of BenchmarkContext
+
+    Returns:
+        Application object (instance of flask.Flask).
+    """
+    class Config(BenchmarkConfig):
+        """Config with the datastore in the temporary directory."""
+        SQLITE_DATASTORE_PATH = os.path.join(context.temp_dir, u'events.db')
+
+    app = create_app(Config)
+    context.add_cleanup(db_session.remove)
+    context.add_cleanup(
+        functools.partial(close_connection, Config.SQLITE_DATASTORE_PATH))
+    return app
+
+
+def _api_fixture(context):
+    """Create a sketch with the synthetic timeline and log in.
+
+    The fixture is shared by all API benchmarks of a run.
+
+    Args:
+        context: Instance of BenchmarkContext
+
+    Returns:
+        Dictionary with the test client, the sketch ID and the IDs of the
+        events in the timeline.
+    """
+    fixture = context.shared.get(u'api')
+    if fixture:
+        return fixture
+
+    user = User(username=u'benchmark')
+    user.set_password(plaintext=u'benchmark', rounds=4)
+    sketch = Sketch(name=u'Benchmark', description=u'Benchmark', user=user)
+    for permission in [u'read', u'write', u'delete']:
+        sketch.grant_permission(permission=permission, user=user)
+    searchindex = SearchIndex(
+        name=INDEX_NAME, description=INDEX_NAME, index_name=INDEX_NAME,
+        user=user)
+    searchindex.grant_permission(permission=u'read', user=user)
+    timeline = Timeline(
+        name=INDEX_NAME, description=INDEX_NAME, user=user, sketch=sketch,
+        searchindex=searchindex, color=u'FFFFFF')
+    db_session.add_all([user, sketch, searchindex, timeline])
+    for i in range(VIEW_COUNT):
+        db_session.add(View(
+            name=u'View {0:d}'.format(i), query_string=u'logon',
+            query_filter=json.dumps({u'indices': [INDEX_NAME]}), user=user,
+            sketch=sketch))
+    db_session.commit()
+
+    datastore = SqliteDataStore(current_app.config[u'SQLITE_DATASTORE_PATH'])
+    datastore.create_index(INDEX_NAME, u'generic_event')
+    for event in context.events:
+        datastore.import_event(1000, INDEX_NAME, u'generic_event', event)
+    datastore.import_event(1000, INDEX_NAME, u'generic_event')
+    datastore.finalize_index(INDEX_NAME)
+    searchindex.set_stats(datastore.index_stats(INDEX_NAME))
+    db_session.commit()
+    event_ids = [
+        hit[u'_id'] for hit in datastore.search_stream(
+            sketch.id, u'*', {}, None, [INDEX_NAME], return_fields=[])]
+
+    # Comments on some of the events, like in a sketch that is worked on.
+    for event_id in event_ids[:COMMENTED_EVENTS]:
+        event = Event(
+            sketch=sketch, searchindex=searchindex, document_id=event_id)
+        event.comments.append(event.Comment(comment=u'Benchmark', user=user))
+        db_session.add(event)
+    db_session.commit()
+
+    client = current_app.test_client()
+    client.post(
+        u'/login/', data=dict(username=u'benchmark', password=u'benchmark'))
+
+    fixture = {
+        u'client': client,
+        u'sketch_id': sketch.id,
+        u'event_ids': event_ids
+    }
+    context.shared[u'api'] = fixture
+    return fixture
+
+
+def _post_json(client, url, data):
+    """POST JSON data and check the response.
+
+    Args:
+        client: Flask test client
+        url: URL to post to
+        data: Dictionary to send as JSON
+
+    Returns:
+        Response object.
+
+    Raises:
+        RuntimeError: If the request failed.
+    """
+    response = client.post(
+        url, data=json.dumps(data), content_type=u'application/json')
+    if response.status_code != 200:
+        raise RuntimeError(u'POST {0:s} failed with HTTP {1:d}'.format(
+            url, response.status_code))
+    return response
+
+
+def _explore(fixture, query, query_filter=None):
+    """Build a function that searches the sketch.
+
+    Args:
+        fixture: Dictionary from _api_fixture()
+        query: Query string
+        query_filter: Optional dictionary with the query filter
+
+    Returns:
+        Function without arguments.
+    """
+    url = u'/api/v1/sketches/{0:d}/explore/'.format(fixture[u'sketch_id'])
+    data = {
+        u'query': query,
+        u'filter': dict(query_filter or {}, indices=[INDEX_NAME])
+    }
+
+    def run():
+        _post_json(fixture[u'client'], url, data)
+    return run
+
+
+@benchmark(u'api.explore_full_text')
+def bench_explore_full_text(context):
+    """Search for a word, first page of 500 events."""
+    return _explore(_api_fixture(context), u'logon')
+
+
+@benchmark(u'api.explore_field_filter')
+def bench_explore_field_filter(context):
+    """Search on a field with a time range and excluded data types."""
+    return _explore(
+        _api_fixture(context), u'data_type:"fs:stat" AND NOT deleted', {
+            u'time_start': u'2017-01-01', u'time_end': u'2017-01-31',
+            u'exclude': [u'syslog:line'], u'limit': 100
+        })
+
+
+@benchmark(u'api.get_event')
+def bench_get_event(context):
+    """Get a single event with its comments."""
+    fixture = _api_fixture(context)
+    url = (
+        u'/api/v1/sketches/{0:d}/event/?searchindex_id={1:s}'
+        u'&event_id={2:s}').format(
+            fixture[u'sketch_id'], INDEX_NAME, fixture[u'event_ids'][0])
+
+    def run():
+        response = fixture[u'client'].get(url)
+        if response.status_code != 200:
+            raise RuntimeError(u'GET {0:s} failed with HTTP {1:d}'.format(
+                url, response.status_code))
+    return run
+
+
+@benchmark(u'api.get_event_batch')
+def bench_get_event_batch(context):
+    """Get a batch of events, half of them with comments."""
+    fixture = _api_fixture(context)
+    url = u'/api/v1/sketches/{0:d}/event/batch/'.format(fixture[u'sketch_id'])
+    start = COMMENTED_EVENTS - BATCH_SIZE // 2
+    data = {
+        u'events': [
+            {u'_index': INDEX_NAME, u'_id': event_id}
+            for event_id in fixture[u'event_ids'][start:start + BATCH_SIZE]
+        ]
+    }
+
+    def run():
+        _post_json(fixture[u'client'], url, data)
+    return run
+
+
+@benchmark(u'api.export_csv')
+def bench_export_csv(context):
+    """Export the events matching the user view as CSV."""
+    fixture = _api_fixture(context)
+    # The export uses the query of the last search.
+    _explore(fixture, u'*')()
+    url = u'/sketch/{0:d}/explore/export/?format=csv'.format(
+        fixture[u'sketch_id'])
+
+    def run():
+        response = fixture[u'client'].get(url)
+        # The export is streamed, reading the data runs the search.
+        response.get_data()
+    return run
+
+
+@benchmark(u'api.to_json_sketch')
+def bench_to_json_sketch(context):
+    """Serialize a sketch with its timelines and views."""
+    fixture = _api_fixture(context)
+    resource = ResourceMixin()
+
+    def run():
+        with current_app.test_request_context():
+            resource.to_json(Sketch.query.get(fixture[u'sketch_id']))
+    return run
@@ -0,0 +1,183 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Generator for synthetic timelines.
+
+The events look like Plaso output: a handful of parsers and data types, a
+skewed distribution over hosts, users and files, and messages built from a
+small vocabulary. The same seed always gives the same timeline, so runs of
+the benchmarks can be compared.
+"""
+
+import csv
+import datetime
+import json
+import random
+
+# Epoch seconds of the first event, 2017-01-01T00:00:00+00:00.
+DEFAULT_START = 1483228800
+
+# Time span of the timeline in seconds.
+DEFAULT_SPAN = 90 * 24 * 3600
+
+# Number of distinct hosts, users and files.
+DEFAULT_CARDINALITY = 100
+
+OUTPUT_FORMATS = (u'csv', u'jsonl')
+
+# Fields in the order they are written to CSV files.
+FIELDS = [
+    u'message', u'timestamp', u'datetime', u'timestamp_desc', u'data_type',
+    u'parser', u'source_short', u'source_long', u'hostname', u'username',
+    u'filename', u'tag'
+]
+
+# (parser, data_type, source_short, source_long, timestamp_desc, weight)
+EVENT_TYPES = [
+    (u'filestat', u'fs:stat', u'FILE', u'OS Timestamp',
+     u'Content Modification Time', 40),
+    (u'winevtx', u'windows:evtx:record', u'EVT', u'WinEVTX',
+     u'Event Recorded', 25),
+    (u'winreg', u'windows:registry:key_value', u'REG', u'Registry Key',
+     u'Last Written Time', 15),
+    (u'chrome_history', u'chrome:history:page_visited', u'WEBHIST',
+     u'Chrome History', u'Last Visited Time', 10),
+    (u'syslog', u'syslog:line', u'LOG', u'Log File',
+     u'Content Modification Time', 8),
+    (u'prefetch', u'windows:prefetch:execution', u'LOG', u'WinPrefetch',
+     u'Last Time Executed', 2)
+]
+
+WORDS = [
+    u'user', u'logon', u'logoff', u'service', u'started', u'stopped',
+    u'process', u'created', u'file', u'opened', u'deleted', u'registry',
+    u'key', u'value', u'network', u'connection', u'download', u'update',
+    u'error', u'warning', u'success', u'failure', u'session', u'remote',
+    u'admin', u'system', u'policy', u'task', u'scheduled', u'executable'
+]
+
+TAGS = [u'malware', u'lateral_movement', u'persistence', u'exfiltration']
+
+
+def _skewed_choice(rng, values):
+    """Choose a value with a Zipf like distribution.
+
+    Real timelines have a few very common values and a long tail, which
+    matters for terms aggregations and for the size of the full text index.
+
+    Args:
+        rng: Instance of random.Random
+        values: List of values, the first values are the most common
+
+    Returns:
+        One of the values.
+    """
+    index = int(len(values) * rng.random() ** 3)
+    return values[min(index, len(values) - 1)]
+
+
+def generate_events(
+        event_count, cardinality=DEFAULT_CARDINALITY, start=DEFAULT_START,
+        span=DEFAULT_SPAN, seed=0):
+    """Generate synthetic Plaso like events.
+
+    Args:
+        event_count: Number of events to generate
+        cardinality: Number of distinct hosts, users and files
+        start: Epoch seconds of the first event
+        span: Time span of the events in seconds
+        seed: Seed for the random generator
+
+    Yields:
+        Event dictionaries, sorted on time, with the fields in FIELDS. The
+        timestamp is in microseconds like Plaso.
+    """
+    rng = random.Random(seed)
+    cardinality = max(int(cardinality), 1)
+    hosts = [u'host{0:d}.example.com'.format(i) for i in range(cardinality)]
+    users = [u'user{0:d}'.format(i) for i in range(cardinality)]
+    files = [
+        u'C:\\Users\\{0:s}\\AppData\\file{1:d}.dat'.format(
+            users[i % len(users)], i) for i in range(cardinality)]
+    weights = [event_type[-1] for event_type in EVENT_TYPES]
+    total_weight = sum(weights)
+
+    timestamp = start * 1000000
+    step = (span * 1000000) // max(event_count, 1)
+    for _ in range(event_count):
+        # Events come in bursts, like real activity.
+        timestamp += int(rng.expovariate(1.0) * step)
+
+        pick = rng.random() * total_weight
+        for event_type, weight in zip(EVENT_TYPES, weights):
+            pick -= weight
+            if pick < 0:
+                break
+        parser, data_type, source_short, source_long, timestamp_desc, _ = (
+            event_type)
+
+        username = _skewed_choice(rng, users)
+        filename = _skewed_choice(rng, files)
+        message = u'{0:s} {1:s} {2:s} {3:s}'.format(
+            u' '.join(rng.sample(WORDS, 3)), username, filename,
+            u' '.join(rng.sample(WORDS, 2)))
+        event_time = datetime.datetime.utcfromtimestamp(timestamp / 1000000.0)
+        yield {
+            u'message': message,
+            u'timestamp': timestamp,
+            u'datetime': event_time.strftime(u'%Y-%m-%dT%H:%M:%S+00:00'),
+            u'timestamp_desc': timestamp_desc,
+            u'data_type': data_type,
+            u'parser': parser,
+            u'source_short': source_short,
+            u'source_long': source_long,
+            u'hostname': _skewed_choice(rng, hosts),
+            u'username': username,
+            u'filename': filename,
+            u'tag': rng.choice(TAGS) if rng.random() < 0.01 else u''
+        }
+
+
+def write_timeline(path, events, output_format=u'csv'):
+    """Write events to a file that tsctl csv2ts or the upload can import.
+
+    Args:
+        path: Path to the file to write
+        events: Iterable of event dictionaries
+        output_format: csv, or jsonl for one JSON event per line
+
+    Returns:
+        Number of events written.
+
+    Raises:
+        ValueError: If the output format is not supported.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            u'Unsupported output format: {0:s}'.format(output_format))
+
+    event_count = 0
+    with open(path, u'wb') as fh:
+        if output_format == u'csv':
+            writer = csv.writer(fh)
+            writer.writerow(FIELDS)
+        for event in events:
+            if output_format == u'csv':
+                writer.writerow([
+                    unicode(event.get(field, u'')).encode(u'utf-8')
+                    for field in FIELDS])
+            else:
+                fh.write(json.dumps(event).encode(u'utf-8'))
+                fh.write(b'\n')
+            event_count += 1
+    return event_count
@@ -0,0 +1,70 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the synthetic timeline generator."""
+
+import json
+import os
+import shutil
+import tempfile
+
+from timesketch.lib.benchmarks.generator import FIELDS
+from timesketch.lib.benchmarks.generator import generate_events
+from timesketch.lib.benchmarks.generator import write_timeline
+from timesketch.lib.testlib import BaseTest
+from timesketch.lib.utils import read_and_validate_csv
+
+
+class GeneratorTest(BaseTest):
+    """Test the synthetic timeline generator."""
+    def setUp(self):
+        super(GeneratorTest, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(GeneratorTest, self).tearDown()
+        shutil.rmtree(self.temp_dir)
+
+    def test_generate_events(self):
+        """Test that events are repeatable, sorted and within cardinality."""
+        events = list(generate_events(1000, cardinality=5, seed=1))
+        self.assertEqual(len(events), 1000)
+        self.assertEqual(events, list(generate_events(
+            1000, cardinality=5, seed=1)))
+        self.assertNotEqual(events, list(generate_events(
+            1000, cardinality=5, seed=2)))
+
+        timestamps = [event[u'timestamp'] for event in events]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertLessEqual(
+            len(set(event[u'hostname'] for event in events)), 5)
+        for event in events:
+            self.assertEqual(sorted(event), sorted(FIELDS))
+
+    def test_write_timeline(self):
+        """Test that written timelines can be read back."""
+        events = list(generate_events(10))
+        csv_path = os.path.join(self.temp_dir, u'timeline.csv')
+        self.assertEqual(write_timeline(csv_path, events), 10)
+        rows = list(read_and_validate_csv(csv_path))
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(
+            rows[0][u'message'], events[0][u'message'].encode(u'utf-8'))
+
+        jsonl_path = os.path.join(self.temp_dir, u'timeline.jsonl')
+        write_timeline(jsonl_path, events, output_format=u'jsonl')
+        with open(jsonl_path, u'rb') as fh:
+            self.assertEqual([json.loads(line) for line in fh], events)
+
+        with self.assertRaises(ValueError):
+            write_timeline(jsonl_path, events, output_format=u'xml')
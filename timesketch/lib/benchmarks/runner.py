@@ -0,0 +1,295 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Run benchmarks and save the results.
+
+A benchmark is a function that is registered with the benchmark decorator.
+It gets a BenchmarkContext and returns a function without arguments that
+does the work to time. Setup, like generating events or starting the app, is
+done before the function is returned and is not timed.
+"""
+
+import datetime
+import fnmatch
+import json
+import math
+import os
+import platform
+import shutil
+import tempfile
+import timeit
+
+from timesketch.lib.benchmarks.generator import DEFAULT_CARDINALITY
+from timesketch.lib.benchmarks.generator import generate_events
+from timesketch.lib.benchmarks.generator import write_timeline
+
+# Version of the results file format.
+RESULTS_VERSION = 1
+
+# Each repeat runs the benchmark for at least this many seconds.
+DEFAULT_MIN_TIME = 0.2
+DEFAULT_REPEAT = 5
+
+# Registry of benchmarks, name as key and function as value.
+_BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Decorator to register a benchmark.
+
+    Args:
+        name: Name of the benchmark, e.g. import.read_and_validate_csv
+
+    Returns:
+        Decorator that registers the function and returns it unchanged.
+    """
+    def register(setup):
+        """Register the benchmark setup function."""
+        if name in _BENCHMARKS:
+            raise ValueError(u'Benchmark already registered: {0:s}'.format(
+                name))
+        _BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def get_benchmarks(patterns=None):
+    """Get the registered benchmarks.
+
+    Args:
+        patterns: Optional list of shell patterns, e.g. api.*, to select
+            benchmarks by name
+
+    Returns:
+        List of (name, setup function) tuples sorted by name.
+    """
+    # Benchmarks register themselves when their module is imported.
+    # pylint: disable=unused-variable
+    from timesketch.lib.benchmarks import suite
+    from timesketch.lib.benchmarks import api_suite
+
+    names = sorted(_BENCHMARKS)
+    if patterns:
+        names = [
+            name for name in names
+            if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+    return [(name, _BENCHMARKS[name]) for name in names]
+
+
+class BenchmarkContext(object):
+    """Shared input for the benchmarks of one run.
+
+    Attributes:
+        event_count: Number of events in the synthetic timeline
+        cardinality: Number of distinct hosts, users and files
+        seed: Seed for the synthetic timeline
+        temp_dir: Directory for files created by the benchmarks
+        shared: Dictionary for setup that is shared between benchmarks
+    """
+    def __init__(
+            self, event_count, cardinality=DEFAULT_CARDINALITY, seed=0):
+        """Initialize the context.
+
+        Args:
+            event_count: Number of events in the synthetic timeline
+            cardinality: Number of distinct hosts, users and files
+            seed: Seed for the synthetic timeline
+        """
+        super(BenchmarkContext, self).__init__()
+        self.event_count = event_count
+        self.cardinality = cardinality
+        self.seed = seed
+        self.temp_dir = tempfile.mkdtemp(prefix=u'timesketch-bench-')
+        self.shared = {}
+        self._events = None
+        self._timelines = {}
+        self._cleanup = []
+
+    @property
+    def events(self):
+        """List of the synthetic events, generated on first use."""
+        if self._events is None:
+            self._events = list(generate_events(
+                self.event_count, cardinality=self.cardinality,
+                seed=self.seed))
+        return self._events
+
+    def timeline_path(self, output_format=u'csv'):
+        """Get the path to the synthetic timeline in a file format.
+
+        Args:
+            output_format: csv or jsonl
+
+        Returns:
+            Path to the file, written on first use.
+        """
+        if output_format not in self._timelines:
+            path = os.path.join(
+                self.temp_dir, u'timeline.{0:s}'.format(output_format))
+            write_timeline(path, self.events, output_format)
+            self._timelines[output_format] = path
+        return self._timelines[output_format]
+
+    def add_cleanup(self, function):
+        """Register a function to call when the run is done.
+
+        Args:
+            function: Function without arguments
+        """
+        self._cleanup.append(function)
+
+    def close(self):
+        """Run the cleanup functions and remove the temporary files."""
+        while self._cleanup:
+            self._cleanup.pop()()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+
+def measure(function, repeat=DEFAULT_REPEAT, min_time=DEFAULT_MIN_TIME):
+    """Time a function.
+
+    Like the timeit module, the function is called in a loop that is long
+    enough to time reliably, and the loop is repeated to see the variance.
+
+    Args:
+        function: Function without arguments
+        repeat: Number of times to repeat the loop
+        min_time: Minimum time of one loop in seconds
+
+    Returns:
+        Dictionary with the number of calls per loop and the min, median,
+        mean and standard deviation of the time per call in seconds.
+    """
+    timer = timeit.Timer(function)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time or number >= 1000000:
+            break
+        # Aim a bit over the minimum time, but never grow more than 10x.
+        number = min(
+            number * 10, int(number * 1.2 * min_time / max(elapsed, 1e-9)) + 1)
+
+    times = [elapsed / number] + [
+        timer.timeit(number) / number for _ in range(max(repeat, 1) - 1)]
+    times.sort()
+    mean = sum(times) / len(times)
+    middle = len(times) // 2
+    if len(times) % 2:
+        median = times[middle]
+    else:
+        median = (times[middle - 1] + times[middle]) / 2
+    return {
+        u'number': number,
+        u'repeat': len(times),
+        u'min': times[0],
+        u'median': median,
+        u'mean': mean,
+        u'stdev': math.sqrt(
+            sum((value - mean) ** 2 for value in times) / len(times))
+    }
+
+
+def run_benchmarks(
+        context, benchmarks, repeat=DEFAULT_REPEAT, min_time=DEFAULT_MIN_TIME,
+        progress=None):
+    """Run benchmarks.
+
+    Args:
+        context: Instance of BenchmarkContext
+        benchmarks: List of (name, setup function) tuples
+        repeat: Number of times to repeat each benchmark loop
+        min_time: Minimum time of one loop in seconds
+        progress: Optional function that is called with the name and result
+            of each benchmark
+
+    Returns:
+        Dictionary with the results, see save_results().
+    """
+    results = {}
+    for name, setup in benchmarks:
+        function = setup(context)
+        result = measure(function, repeat=repeat, min_time=min_time)
+        results[name] = result
+        if progress:
+            progress(name, result)
+
+    return {
+        u'version': RESULTS_VERSION,
+        u'created_at': datetime.datetime.utcnow().isoformat(),
+        u'python': platform.python_version(),
+        u'platform': platform.platform(),
+        u'parameters': {
+            u'events': context.event_count,
+            u'cardinality': context.cardinality,
+            u'seed': context.seed,
+            u'repeat': repeat,
+            u'min_time': min_time
+        },
+        u'benchmarks': results
+    }
+
+
+def save_results(results, path):
+    """Save benchmark results as JSON.
+
+    Args:
+        results: Dictionary from run_benchmarks()
+        path: Path to the JSON file
+    """
+    with open(path, u'wb') as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    """Load benchmark results saved with save_results().
+
+    Args:
+        path: Path to the JSON file
+
+    Returns:
+        Dictionary with the results.
+
+    Raises:
+        ValueError: If the file is not a benchmark results file.
+    """
+    with open(path, u'rb') as fh:
+        results = json.load(fh)
+    if not isinstance(results, dict) or results.get(
+            u'version') != RESULTS_VERSION:
+        raise ValueError(
+            u'Not a benchmark results file: {0:s}'.format(path))
+    return results
+
+
+def compare_results(baseline, current):
+    """Compare the median times of two runs.
+
+    Args:
+        baseline: Dictionary with the results of the earlier run
+        current: Dictionary with the results of the new run
+
+    Returns:
+        List of (name, baseline median, current median, ratio) tuples for
+        the benchmarks in both runs, sorted by name. A ratio above 1 means
+        the benchmark got slower.
+    """
+    comparison = []
+    for name in sorted(current[u'benchmarks']):
+        if name not in baseline[u'benchmarks']:
+            continue
+        old = baseline[u'benchmarks'][name][u'median']
+        new = current[u'benchmarks'][name][u'median']
+        ratio = new / old if old else float(u'inf')
+        comparison.append((name, old, new, ratio))
+    return comparison
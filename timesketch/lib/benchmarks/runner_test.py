@@ -0,0 +1,71 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the benchmark runner."""
+
+import os
+
+from timesketch.lib.benchmarks.api_suite import create_benchmark_app
+from timesketch.lib.benchmarks.runner import BenchmarkContext
+from timesketch.lib.benchmarks.runner import compare_results
+from timesketch.lib.benchmarks.runner import get_benchmarks
+from timesketch.lib.benchmarks.runner import load_results
+from timesketch.lib.benchmarks.runner import measure
+from timesketch.lib.benchmarks.runner import run_benchmarks
+from timesketch.lib.benchmarks.runner import save_results
+from timesketch.lib.testlib import BaseTest
+
+
+class RunnerTest(BaseTest):
+    """Test the benchmark runner."""
+    def setUp(self):
+        super(RunnerTest, self).setUp()
+        self.context = BenchmarkContext(200, cardinality=10)
+
+    def tearDown(self):
+        self.context.close()
+        super(RunnerTest, self).tearDown()
+
+    def test_measure(self):
+        """Test that a function is called in repeated loops."""
+        calls = []
+        result = measure(lambda: calls.append(1), repeat=3, min_time=0.001)
+        self.assertEqual(result[u'repeat'], 3)
+        self.assertGreaterEqual(len(calls), 3 * result[u'number'])
+        self.assertLessEqual(result[u'min'], result[u'median'])
+
+    def test_get_benchmarks(self):
+        """Test selecting benchmarks by name."""
+        names = [name for name, _ in get_benchmarks([u'api.*'])]
+        self.assertIn(u'api.explore_full_text', names)
+        self.assertTrue(all(name.startswith(u'api.') for name in names))
+        self.assertIn(
+            u'query.build_query', [name for name, _ in get_benchmarks()])
+
+    def test_run_benchmarks(self):
+        """Test running all benchmarks and saving the results."""
+        with create_benchmark_app(self.context).app_context():
+            results = run_benchmarks(
+                self.context, get_benchmarks(), repeat=1, min_time=0)
+        self.assertEqual(results[u'parameters'][u'events'], 200)
+        self.assertEqual(
+            sorted(results[u'benchmarks']),
+            [name for name, _ in get_benchmarks()])
+
+        path = os.path.join(self.context.temp_dir, u'results.json')
+        save_results(results, path)
+        self.assertEqual(load_results(path), results)
+
+        comparison = compare_results(results, results)
+        self.assertEqual(len(comparison), len(results[u'benchmarks']))
+        self.assertTrue(all(ratio == 1 for _, _, _, ratio in comparison))
@@ -0,0 +1,228 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks for importing, querying and formatting results.
+
+These run without Elasticsearch or Neo4j: the Elasticsearch client is
+replaced by a stand-in that accepts every bulk request, and search and graph
+results are built from the synthetic events.
+"""
+
+from collections import Counter
+import datetime
+
+from timesketch.lib.aggregators import heatmap_result
+from timesketch.lib.aggregators import histogram_result
+from timesketch.lib.benchmarks.runner import benchmark
+from timesketch.lib.datastores.elastic import ElasticsearchDataStore
+from timesketch.lib.datastores.neo4j import CytoscapeOutputFormatter
+from timesketch.lib.datastores.sqlite import SqliteDataStore
+from timesketch.lib.datastores.sqlite import close_connection
+from timesketch.lib.datastores.sqlite import create_schema
+from timesketch.lib.utils import read_and_validate_csv
+
+# Number of timelines the synthetic aggregation results are split over.
+TIMELINE_COUNT = 3
+
+# Query filters for the query builder benchmark.
+QUERY_FILTERS = [
+    (u'logon AND user1', {u'limit': 500}),
+    (u'data_type:"fs:stat" AND NOT deleted', {
+        u'time_start': u'2017-01-01', u'time_end': u'2017-01-31',
+        u'exclude': [u'syslog:line']
+    }),
+    (u'', {u'star': True, u'order': u'desc'}),
+    (u'*', {
+        u'time_ranges': [
+            {u'start': u'2017-01-01', u'end': u'2017-01-02'},
+            {u'start': u'2017-02-01', u'end': u'2017-02-02'}
+        ],
+        u'sample': 0.1
+    })
+]
+
+
+class NullBulkClient(object):
+    """Elasticsearch client stand-in that accepts every bulk request."""
+
+    # pylint: disable=unused-argument
+    def bulk(self, body, request_timeout=None):
+        """Answer a bulk request as if all events were indexed.
+
+        Args:
+            body: Bulk request body, an action and a document per line
+            request_timeout: Ignored
+
+        Returns:
+            Bulk response without errors.
+        """
+        documents = body.count(u'\n') // 2
+        return {
+            u'errors': False,
+            u'items': [{u'index': {u'status': 201}}] * documents
+        }
+
+
+@benchmark(u'import.read_and_validate_csv')
+def bench_read_csv(context):
+    """Parse the synthetic timeline as CSV."""
+    path = context.timeline_path(u'csv')
+
+    def run():
+        for _ in read_and_validate_csv(path):
+            pass
+    return run
+
+
+@benchmark(u'import.elastic_import_event')
+def bench_elastic_import(context):
+    """Serialize the synthetic timeline into bulk requests."""
+    events = context.events
+
+    def run():
+        datastore = ElasticsearchDataStore()
+        datastore.client = NullBulkClient()
+        for event in events:
+            datastore.import_event(1000, u'bench', u'generic_event', event)
+        datastore.import_event(1000, u'bench', u'generic_event')
+    return run
+
+
+@benchmark(u'import.sqlite_import_event')
+def bench_sqlite_import(context):
+    """Import the synthetic timeline into an in-memory SQLite datastore."""
+    events = context.events
+
+    def run():
+        create_schema(u':memory:')
+        datastore = SqliteDataStore(u':memory:')
+        index_name, doc_type = datastore.create_index(u'bench')
+        for event in events:
+            datastore.import_event(1000, index_name, doc_type, event)
+        datastore.import_event(1000, index_name, doc_type)
+        datastore.finalize_index(index_name)
+        close_connection(u':memory:')
+    return run
+
+
+@benchmark(u'query.build_query')
+def bench_build_query(context):
+    """Build and optimize Elasticsearch queries for a set of filters."""
+    datastore = ElasticsearchDataStore()
+
+    def run():
+        for query_string, query_filter in QUERY_FILTERS:
+            datastore.build_query(1, query_string, query_filter, None)
+    return run
+
+
+def _hour_buckets(events):
+    """Count the synthetic events per hour and timeline.
+
+    Args:
+        events: List of event dictionaries
+
+    Returns:
+        List of (hour as datetime, Counter of events per timeline) tuples,
+        sorted on time.
+    """
+    counts = {}
+    for position, event in enumerate(events):
+        hour = datetime.datetime.utcfromtimestamp(
+            event[u'timestamp'] // 1000000).replace(minute=0, second=0)
+        index_name = u'timeline{0:d}'.format(position % TIMELINE_COUNT)
+        counts.setdefault(hour, Counter())[index_name] += 1
+    return sorted(counts.items())
+
+
+def _timeline_buckets(counter):
+    """Build the buckets of a timeline sub-aggregation."""
+    return {
+        u'buckets': [
+            {u'key': key, u'doc_count': count}
+            for key, count in counter.most_common()
+        ]
+    }
+
+
+@benchmark(u'aggregation.heatmap_result')
+def bench_heatmap_result(context):
+    """Post-process a heatmap aggregation split per timeline."""
+    buckets = [
+        {
+            u'key_as_string': u'{0:d},{1:d}'.format(
+                hour.isoweekday(), hour.hour),
+            u'doc_count': sum(counter.values()),
+            u'timelines': _timeline_buckets(counter)
+        } for hour, counter in _hour_buckets(context.events)
+    ]
+    search_result = {u'aggregations': {u'heatmap': {u'buckets': buckets}}}
+
+    def run():
+        heatmap_result(search_result, per_timeline=True)
+    return run
+
+
+@benchmark(u'aggregation.histogram_result')
+def bench_histogram_result(context):
+    """Post-process a histogram aggregation split per timeline."""
+    hours = _hour_buckets(context.events)
+
+    def run():
+        # The timeline counts are replaced in place, so every run gets a
+        # fresh result like a new search would.
+        buckets = [
+            {
+                u'key': hour.isoformat(),
+                u'doc_count': sum(counter.values()),
+                u'timelines': _timeline_buckets(counter)
+            } for hour, counter in hours
+        ]
+        histogram_result(
+            {u'aggregations': {u'histogram': {u'buckets': buckets}}})
+    return run
+
+
+@benchmark(u'graph.format_graph')
+def bench_format_graph(context):
+    """Format a user to host logon graph for Cytoscape."""
+    graph = []
+    node_ids = {}
+    edge_ids = {}
+    for event in context.events[:10000]:
+        nodes = []
+        for label, name in ((u'User', event[u'username']),
+                            (u'Host', event[u'hostname'])):
+            node_id = node_ids.setdefault((label, name), len(node_ids))
+            nodes.append({
+                u'id': unicode(node_id),
+                u'labels': [label],
+                u'properties': {u'name': name}
+            })
+        edge_id = edge_ids.setdefault(
+            (nodes[0][u'id'], nodes[1][u'id']), len(edge_ids))
+        graph.append({
+            u'nodes': nodes,
+            u'relationships': [{
+                u'id': unicode(edge_id),
+                u'type': u'LOGGED_IN',
+                u'startNode': nodes[0][u'id'],
+                u'endNode': nodes[1][u'id'],
+                u'properties': {}
+            }]
+        })
+    formatter = CytoscapeOutputFormatter()
+
+    def run():
+        formatter.format_graph(graph)
+    return run
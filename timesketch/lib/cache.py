@@ -0,0 +1,327 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cache for datastore query results."""
+
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import current_app
+from flask import has_app_context
+import redis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(u'timesketch.cache')
+logger.addHandler(logging.NullHandler())
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_REDIS_URL = u'redis://127.0.0.1:6379/1'
+
+# Registry of caches, one per process and set of settings.
+_CACHE_REGISTRY = {}
+_CACHE_REGISTRY_LOCK = threading.Lock()
+
+
+class LocalCache(object):
+    """In-process least recently used cache with expiring entries.
+
+    Counters are kept apart from the entries so they are never evicted.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        """Initialize the cache.
+
+        Args:
+            max_entries: Maximum number of entries before the least recently
+                used entries are evicted.
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a value.
+
+        Args:
+            key: Cache key as string
+
+        Returns:
+            The value or None if the key is missing or expired.
+        """
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires and expires < time.time():
+                return None
+            # Re-insert to mark the entry as most recently used.
+            self._entries[key] = entry
+            return value
+
+    def get_many(self, keys):
+        """Get many values.
+
+        Args:
+            keys: List of cache keys
+
+        Returns:
+            List of values, None for missing keys.
+        """
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ttl=None):
+        """Set a value.
+
+        Args:
+            key: Cache key as string
+            value: Value to store
+            ttl: Optional time to live in seconds
+        """
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def incr(self, key):
+        """Increment a counter.
+
+        Args:
+            key: Cache key as string
+
+        Returns:
+            The new value of the counter.
+        """
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+
+class RedisCache(object):
+    """Cache in Redis, shared by all workers.
+
+    Redis errors are logged and treated as cache misses, so the cache never
+    makes a search fail.
+    """
+
+    def __init__(self, url=DEFAULT_REDIS_URL):
+        """Initialize the cache.
+
+        Args:
+            url: Redis URL, e.g. redis://127.0.0.1:6379/1
+        """
+        self.client = redis.StrictRedis.from_url(url)
+
+    def get(self, key):
+        """Get a value.
+
+        Args:
+            key: Cache key as string
+
+        Returns:
+            The value or None if the key is missing.
+        """
+        try:
+            return self.client.get(key)
+        except RedisError as e:
+            logger.warning(u'Unable to read from cache: %s', e)
+            return None
+
+    def get_many(self, keys):
+        """Get many values.
+
+        Args:
+            keys: List of cache keys
+
+        Returns:
+            List of values, None for missing keys.
+        """
+        if not keys:
+            return []
+        try:
+            return self.client.mget(keys)
+        except RedisError as e:
+            logger.warning(u'Unable to read from cache: %s', e)
+            return [None] * len(keys)
+
+    def set(self, key, value, ttl=None):
+        """Set a value.
+
+        Args:
+            key: Cache key as string
+            value: Value to store
+            ttl: Optional time to live in seconds
+        """
+        try:
+            self.client.set(key, value, ex=ttl)
+        except RedisError as e:
+            logger.warning(u'Unable to write to cache: %s', e)
+
+    def incr(self, key):
+        """Increment a counter.
+
+        Args:
+            key: Cache key as string
+
+        Returns:
+            The new value of the counter, or None on error.
+        """
+        try:
+            return self.client.incr(key)
+        except RedisError as e:
+            logger.warning(u'Unable to write to cache: %s', e)
+            return None
+
+
+class QueryCache(object):
+    """Cache for query results that is invalidated per index.
+
+    Every index has a generation counter that is part of the cache key of
+    all queries on that index. Bumping the generation when events are added
+    or labeled makes all cached results for that index stale.
+    """
+
+    def __init__(self, backend, ttl=DEFAULT_TTL):
+        """Initialize the cache.
+
+        Args:
+            backend: Cache backend (instance of LocalCache or RedisCache)
+            ttl: Time to live in seconds for cached results
+        """
+        self.backend = backend
+        self.ttl = ttl
+
+    @staticmethod
+    def _generation_key(index_name):
+        """Get the cache key of the generation counter for an index."""
+        return u'generation:{0:s}'.format(index_name)
+
+    def make_key(self, namespace, query, indices):
+        """Build the cache key for a query.
+
+        Args:
+            namespace: Kind of cached result, e.g. search
+            query: JSON serializable query, e.g. Elasticsearch DSL
+            indices: List of indices that are queried
+
+        Returns:
+            Cache key as string.
+        """
+        indices = sorted(indices)
+        generations = self.backend.get_many(
+            [self._generation_key(index) for index in indices])
+        payload = json.dumps({
+            u'query': query,
+            u'indices': indices,
+            u'generations': [int(g or 0) for g in generations]
+        }, sort_keys=True)
+        return u'{0:s}:{1:s}'.format(
+            namespace, hashlib.sha1(payload.encode(u'utf-8')).hexdigest())
+
+    def get(self, key):
+        """Get a cached result.
+
+        Args:
+            key: Cache key from make_key()
+
+        Returns:
+            The result or None on a cache miss.
+        """
+        namespace = key.partition(u':')[0]
+        value = self.backend.get(key)
+        if value is None:
+            self.backend.incr(u'stats:{0:s}:misses'.format(namespace))
+            return None
+        self.backend.incr(u'stats:{0:s}:hits'.format(namespace))
+        return json.loads(value)
+
+    def set(self, key, result):
+        """Cache a result.
+
+        Args:
+            key: Cache key from make_key()
+            result: JSON serializable result
+        """
+        self.backend.set(key, json.dumps(result), ttl=self.ttl)
+
+    def bump(self, index_name):
+        """Invalidate all cached results for an index.
+
+        Args:
+            index_name: Name of the index
+        """
+        self.backend.incr(self._generation_key(index_name))
+
+    def stats(self, namespace):
+        """Get hit and miss counters.
+
+        Args:
+            namespace: Kind of cached result, e.g. search
+
+        Returns:
+            Dictionary with number of hits and misses.
+        """
+        hits, misses = self.backend.get_many([
+            u'stats:{0:s}:hits'.format(namespace),
+            u'stats:{0:s}:misses'.format(namespace)])
+        return {u'hits': int(hits or 0), u'misses': int(misses or 0)}
+
+
+def get_query_cache():
+    """Get the query cache configured in the Timesketch config.
+
+    Configured with SEARCH_CACHE_BACKEND (local, redis or None),
+    SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES and SEARCH_CACHE_REDIS_URL.
+
+    Returns:
+        Instance of QueryCache, or None if caching is disabled.
+    """
+    if not has_app_context():
+        return None
+    config = current_app.config
+    backend_name = config.get(u'SEARCH_CACHE_BACKEND')
+    if not backend_name:
+        return None
+
+    ttl = config.get(u'SEARCH_CACHE_TTL', DEFAULT_TTL)
+    max_entries = config.get(u'SEARCH_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)
+    redis_url = config.get(u'SEARCH_CACHE_REDIS_URL', DEFAULT_REDIS_URL)
+    key = (os.getpid(), backend_name, ttl, max_entries, redis_url)
+    query_cache = _CACHE_REGISTRY.get(key)
+    if query_cache:
+        return query_cache
+
+    with _CACHE_REGISTRY_LOCK:
+        query_cache = _CACHE_REGISTRY.get(key)
+        if not query_cache:
+            if backend_name == u'redis':
+                backend = RedisCache(redis_url)
+            elif backend_name == u'local':
+                backend = LocalCache(max_entries)
+            else:
+                raise ValueError(
+                    u'Unknown cache backend: {0:s}'.format(backend_name))
+            query_cache = QueryCache(backend, ttl=ttl)
+            _CACHE_REGISTRY[key] = query_cache
+    return query_cache
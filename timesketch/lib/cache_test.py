@@ -0,0 +1,72 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the query cache."""
+
+from timesketch.lib.cache import LocalCache
+from timesketch.lib.cache import QueryCache
+from timesketch.lib.testlib import BaseTest
+
+
+class LocalCacheTest(BaseTest):
+    """Test the in-process cache."""
+    def test_evict_least_recently_used(self):
+        """Test that the least recently used entry is evicted."""
+        cache = LocalCache(max_entries=2)
+        cache.set(u'a', 1)
+        cache.set(u'b', 2)
+        cache.get(u'a')
+        cache.set(u'c', 3)
+        self.assertEqual(cache.get(u'a'), 1)
+        self.assertIsNone(cache.get(u'b'))
+        self.assertEqual(cache.get(u'c'), 3)
+
+    def test_counters_are_not_evicted(self):
+        """Test that counters survive eviction of entries."""
+        cache = LocalCache(max_entries=1)
+        cache.incr(u'counter')
+        cache.set(u'a', 1)
+        cache.set(u'b', 2)
+        self.assertEqual(cache.incr(u'counter'), 2)
+
+
+class QueryCacheTest(BaseTest):
+    """Test the query cache."""
+    def setUp(self):
+        super(QueryCacheTest, self).setUp()
+        self.query_cache = QueryCache(LocalCache())
+
+    def test_key_is_normalized(self):
+        """Test that key order and index order don't change the key."""
+        first = self.query_cache.make_key(
+            u'search', {u'a': 1, u'b': 2}, [u'index1', u'index2'])
+        second = self.query_cache.make_key(
+            u'search', {u'b': 2, u'a': 1}, [u'index2', u'index1'])
+        self.assertEqual(first, second)
+
+    def test_bump_invalidates(self):
+        """Test that bumping an index generation makes results stale."""
+        key = self.query_cache.make_key(u'search', {}, [u'index1'])
+        self.query_cache.set(key, {u'took': 1})
+        self.assertEqual(self.query_cache.get(key), {u'took': 1})
+
+        self.query_cache.bump(u'index2')
+        self.assertEqual(
+            self.query_cache.make_key(u'search', {}, [u'index1']), key)
+        self.query_cache.bump(u'index1')
+        new_key = self.query_cache.make_key(u'search', {}, [u'index1'])
+        self.assertNotEqual(new_key, key)
+        self.assertIsNone(self.query_cache.get(new_key))
+
+        self.assertEqual(
+            self.query_cache.stats(u'search'), {u'hits': 1, u'misses': 1})
@@ -24,7 +24,8 @@ class DataStore(object):
     @abc.abstractmethod
     def search(
             self, sketch_id, query, query_filter, query_dsl, indices,
-            aggregations, return_results, return_fields, enable_scroll):
+            aggregations, return_results, return_fields, enable_scroll,
+            cursor):
         """Return search results.
 
         Args:
@@ -37,6 +38,7 @@ class DataStore(object):
             return_results: Boolean indicating if results should be returned
             return_fields: List of fields to return
             enable_scroll: If Elasticsearch scroll API should be used
+            cursor: Cursor to get the page after a previous search
         """
 
     @abc.abstractmethod
@@ -48,6 +50,14 @@ class DataStore(object):
             event_id: String of ElasticSearch event id
         """
 
+    @abc.abstractmethod
+    def get_events(self, events):
+        """Get many events from the datastore at once.
+
+        Args:
+            events: List of dictionaries with _index and _id keys
+        """
+
     @abc.abstractmethod
     def set_label(
             self, searchindex_id, event_id, event_type, sketch_id, user_id,
@@ -63,3 +73,16 @@ class DataStore(object):
             toggle: Optional boolean value if the label should be toggled
             (add/remove). The default is False.
         """
+
+    @abc.abstractmethod
+    def set_labels(self, events, sketch_id, user_id, label, toggle=False):
+        """Add label to many events at once.
+
+        Args:
+            events: List of dictionaries with _index, _id and _type keys
+            sketch_id: Integer of sketch primary key
+            user_id: Integer of user primary key
+            label: String with the name of the label
+            toggle: Optional boolean value if the label should be toggled
+            (add/remove). The default is False.
+        """
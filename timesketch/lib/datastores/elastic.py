@@ -13,67 +13,496 @@
 # limitations under the License.
 """Elasticsearch datastore."""
 
+import base64
+import binascii
 from collections import Counter
+import datetime
 import json
 import logging
+import os
+import threading
+import time
 
 from uuid import uuid4
 
 from elasticsearch import Elasticsearch
+from elasticsearch.connection import Urllib3HttpConnection
 from elasticsearch.exceptions import NotFoundError
 from elasticsearch.exceptions import ConnectionError
+from elasticsearch.exceptions import ConnectionTimeout
+from elasticsearch.exceptions import RequestError
 from flask import abort
+from flask import current_app
+from flask import g
+from flask import has_app_context
+from flask import has_request_context
 
 from timesketch.lib import datastore
+from timesketch.lib.cache import get_query_cache
+from timesketch.lib.datastores.elastic_bulk import BulkIndexer
+from timesketch.lib.datastores.elastic_query import optimize_query
 from timesketch.lib.definitions import HTTP_STATUS_CODE_NOT_FOUND
+from timesketch.lib.metrics import PHASE_DATASTORE
+from timesketch.lib.metrics import timed_method
+from timesketch.lib.utils import get_sample_rate
+from timesketch.lib.utils import get_time_ranges
 
 # Setup logging
 es_logger = logging.getLogger(u'elasticsearch')
 es_logger.addHandler(logging.NullHandler())
 
+# Default client settings. These can be overridden in the Timesketch config.
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BULK_WORKERS = 2
+DEFAULT_BULK_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BULK_TARGET_LATENCY = 2.0
+DEFAULT_INDEX_SHARD_SIZE = 10 * 1024 * 1024 * 1024
+DEFAULT_INDEX_MAX_SHARDS = 5
+DEFAULT_INDEX_REPLICAS = 1
+DEFAULT_INGEST_MAX_SEGMENTS = 1
+
+# Fields with few distinct values that are only matched exactly or
+# aggregated on. These are mapped as keyword only, without the analyzed text
+# field that the dynamic mapping would add.
+KEYWORD_FIELDS = frozenset([
+    u'data_type', u'parser', u'source_long', u'source_short', u'tag',
+    u'timestamp_desc', u'timezone'
+])
+
+# Values longer than this are not added to the keyword subfield of the
+# message, so aggregations on it count only short messages. Same as the
+# keyword subfield added by the dynamic mapping.
+MESSAGE_KEYWORD_IGNORE_ABOVE = 256
+
+# Date and numeric fields in the Timesketch mapping.
+NUMERIC_FIELDS = frozenset([u'datetime', u'timestamp'])
+
+# Field with labels as flat "<sketch_id>:<label>" keywords.
+LABEL_KEYS_FIELD = u'timesketch_label_keys'
+
+# Field with a unique ID for each event, written when the event is imported.
+# It has doc values so it can break ties when sorting, unlike _uid that needs
+# fielddata loaded into the heap.
+EVENT_ID_FIELD = u'timesketch_event_id'
+
+# Flag in the _meta of a mapping when every labeled event in the index has
+# the flat label field, i.e. it was created with the Timesketch mapping or
+# migrated with backfill_label_keys().
+LABEL_KEYS_COMPLETE_META = u'timesketch_label_keys_complete'
+
+# Fields returned by search() if the caller does not ask for others.
+DEFAULT_RETURN_FIELDS = [
+    u'datetime', u'timestamp', u'message', u'timestamp_desc',
+    u'timesketch_label', u'tag'
+]
+
+# Mapping types that have doc values, so they can be read without loading
+# and parsing the _source of the event. Dates are left out since their doc
+# values are epoch milliseconds and not the string that was indexed.
+DOCVALUE_TYPES = frozenset([
+    u'keyword', u'long', u'integer', u'short', u'byte', u'double', u'float',
+    u'boolean'
+])
+
+# Fields that can have more than one value. Doc values are always lists, so
+# the values of all other fields are unwrapped.
+MULTI_VALUED_FIELDS = frozenset([u'tag', LABEL_KEYS_FIELD])
+
+# Registry of Elasticsearch clients, one per process and set of connection
+# settings. The client owns the connection pool so sharing it means that
+# TCP/TLS connections are reused between requests.
+_CLIENT_REGISTRY = {}
+_CLIENT_REGISTRY_LOCK = threading.Lock()
+
+# Header with an ID for the web request that a datastore request is made
+# for. Elasticsearch shows it for running requests in the tasks API.
+OPAQUE_ID_HEADER = u'X-Opaque-Id'
+
+# Mappings per index, as a list with the mapping of each document type. The
+# type of a mapped field can not change, so this is only looked up once per
+# process.
+_FIELD_MAPPINGS_CACHE = {}
+
+# Indices where the flat label field has been mapped as keyword by this
+# process, so it is never mapped dynamically as text by the first label.
+_LABEL_KEYS_MAPPED = set()
+
+
+def _parse_hosts(host, port, extra_hosts=None):
+    """Build the list of Elasticsearch nodes to connect to.
+
+    Args:
+        host: Hostname or IP address of the primary node.
+        port: Port of the primary node.
+        extra_hosts: Optional list of additional nodes as "host:port" strings.
+
+    Returns:
+        List of (host, port) tuples without duplicates.
+    """
+    hosts = [(host, int(port))]
+    for extra_host in extra_hosts or []:
+        extra_host, _, extra_port = extra_host.partition(u':')
+        node = (extra_host, int(extra_port or port))
+        if node not in hosts:
+            hosts.append(node)
+    return hosts
+
+
+def label_key(sketch_id, label_name):
+    """Get the keyword used for a label in the flat label field.
+
+    Args:
+        sketch_id: Integer of sketch primary key.
+        label_name: Name of the label.
+
+    Returns:
+        Label keyword as string.
+    """
+    return u'{0:d}:{1:s}'.format(int(sketch_id), label_name)
+
+
+def encode_cursor(sort_values):
+    """Encode the sort values of the last event of a page as a cursor.
+
+    Args:
+        sort_values: List of sort values of an event from a search result.
+
+    Returns:
+        Opaque cursor as string.
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps(sort_values).encode(u'utf-8')).decode(u'ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor from encode_cursor().
+
+    Args:
+        cursor: Opaque cursor as string.
+
+    Returns:
+        List of sort values to search after.
+
+    Raises:
+        ValueError: If the cursor is not valid.
+    """
+    try:
+        sort_values = json.loads(
+            base64.urlsafe_b64decode(cursor.encode(u'ascii')).decode(u'utf-8'))
+    except (TypeError, UnicodeError, binascii.Error) as e:
+        raise ValueError(u'Invalid cursor: {0!s}'.format(e))
+    if not isinstance(sort_values, list):
+        raise ValueError(u'Invalid cursor')
+    return sort_values
+
+
+def get_aggregation_field(field_name):
+    """Get the field to aggregate on for an event field.
+
+    Text fields can not be aggregated, the keyword subfield that the dynamic
+    mapping adds is used for them instead.
+
+    Args:
+        field_name: Name of the event field.
+
+    Returns:
+        Name of the field to use in aggregations.
+    """
+    if field_name in KEYWORD_FIELDS or field_name in NUMERIC_FIELDS or (
+            field_name == LABEL_KEYS_FIELD or field_name.endswith(u'.keyword')):
+        return field_name
+    return u'{0:s}.keyword'.format(field_name)
+
+
+def get_opaque_id():
+    """Get the ID that is sent with datastore requests.
+
+    The ID is generated once per web request, so all datastore requests made
+    for it share the same ID.
+
+    Returns:
+        ID as string, or None outside of a web request.
+    """
+    if not has_request_context():
+        return None
+    opaque_id = getattr(g, u'opaque_id', None)
+    if opaque_id is None:
+        opaque_id = g.opaque_id = uuid4().hex
+    return opaque_id
+
+
+class OpaqueIdHttpConnection(Urllib3HttpConnection):
+    """Connection that sends the ID of the current web request.
+
+    Connections are shared by all threads of a process, so the ID is added
+    to a copy of the headers for every request instead of being set on the
+    connection.
+    """
+    def __init__(self, *args, **kwargs):
+        """Initialize the connection, see Urllib3HttpConnection."""
+        self._base_headers = {}
+        self._add_opaque_id = False
+        super(OpaqueIdHttpConnection, self).__init__(*args, **kwargs)
+        self._add_opaque_id = True
+
+    @property
+    def headers(self):
+        """Headers for the next request."""
+        opaque_id = None
+        if self._add_opaque_id:
+            opaque_id = get_opaque_id()
+        if not opaque_id:
+            return self._base_headers
+        headers = dict(self._base_headers)
+        headers[OPAQUE_ID_HEADER] = opaque_id
+        return headers
+
+    @headers.setter
+    def headers(self, headers):
+        """Set the headers that are sent with every request."""
+        self._base_headers = headers
+
+
+def get_client(
+        hosts, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+        max_retries=DEFAULT_MAX_RETRIES, keep_alive=True,
+        http_compress=False):
+    """Get a shared Elasticsearch client for the current process.
+
+    Clients are created once per process and set of settings. The process ID
+    is part of the key so that forked workers (e.g. Gunicorn or Celery) never
+    use sockets inherited from their parent.
+
+    Args:
+        hosts: List of (host, port) tuples. Requests are load balanced
+            round-robin over the nodes and failed nodes are retried later.
+        pool_size: Maximum number of connections per node.
+        timeout: Default timeout in seconds for requests.
+        max_retries: Number of retries on connection errors and timeouts.
+        keep_alive: Boolean indicating if connections should be kept open.
+        http_compress: Boolean indicating if compressed responses should be
+            requested from Elasticsearch.
+
+    Returns:
+        Instance of elasticsearch.Elasticsearch
+    """
+    key = (
+        os.getpid(), tuple(hosts), pool_size, timeout, max_retries,
+        keep_alive, http_compress)
+    client = _CLIENT_REGISTRY.get(key)
+    if client:
+        return client
+
+    with _CLIENT_REGISTRY_LOCK:
+        client = _CLIENT_REGISTRY.get(key)
+        if not client:
+            headers = {}
+            if not keep_alive:
+                headers[u'connection'] = u'close'
+            if http_compress:
+                headers[u'accept-encoding'] = u'gzip,deflate'
+            client = Elasticsearch(
+                [{u'host': host, u'port': port} for host, port in hosts],
+                maxsize=pool_size, timeout=timeout, max_retries=max_retries,
+                retry_on_timeout=True, headers=headers,
+                connection_class=OpaqueIdHttpConnection)
+            _CLIENT_REGISTRY[key] = client
+    return client
+
 
 class ElasticsearchDataStore(datastore.DataStore):
     """Implements the datastore."""
-    def __init__(self, host=u'127.0.0.1', port=9200):
-        """Create a Elasticsearch client."""
+    def __init__(self, host=u'127.0.0.1', port=9200, slow_query_callback=None):
+        """Create a Elasticsearch client.
+
+        The client is shared with all other datastore objects in the same
+        process. Pool size, extra hosts, compression and timeouts are read
+        from the Flask app config if there is an app context.
+
+        Args:
+            host: Hostname or IP address of Elasticsearch
+            port: Port of Elasticsearch
+            slow_query_callback: Optional function that is called with the
+                details of each search or count that took longer than
+                ELASTIC_SLOW_QUERY_THRESHOLD, see _log_slow_query().
+        """
         super(ElasticsearchDataStore, self).__init__()
-        self.client = Elasticsearch([
-            {u'host': host, u'port': port}
-        ])
+        config = {}
+        if has_app_context():
+            config = current_app.config
+
+        self._client_settings = dict(
+            hosts=_parse_hosts(host, port, config.get(u'ELASTIC_HOSTS')),
+            pool_size=config.get(u'ELASTIC_POOL_SIZE', DEFAULT_POOL_SIZE),
+            timeout=config.get(u'ELASTIC_TIMEOUT', DEFAULT_TIMEOUT),
+            keep_alive=config.get(u'ELASTIC_KEEP_ALIVE', True),
+            http_compress=config.get(u'ELASTIC_HTTP_COMPRESS', False))
+        self.client = get_client(
+            max_retries=config.get(
+                u'ELASTIC_MAX_RETRIES', DEFAULT_MAX_RETRIES),
+            **self._client_settings)
+        self.request_timeouts = config.get(u'ELASTIC_REQUEST_TIMEOUTS', {})
+        self.slow_query_threshold = config.get(
+            u'ELASTIC_SLOW_QUERY_THRESHOLD')
+        self.slow_query_callback = slow_query_callback
         self.import_counter = Counter()
-        self.import_events = []
+        self.bulk_indexer = None
+        self.dead_letter_path = None
+        self.ingest_indices = set()
+        self.query_cache = get_query_cache()
+
+    def _get_merge_client(self):
+        """Get a client that does not retry requests.
+
+        A force merge keeps running in Elasticsearch when the request times
+        out, so retrying it would start the merge a second time.
+
+        Returns:
+            Instance of elasticsearch.Elasticsearch
+        """
+        return get_client(max_retries=0, **self._client_settings)
+
+    def _request_timeout(self, operation):
+        """Get the timeout for a type of datastore call.
+
+        Args:
+            operation: Name of the operation, e.g. search, count or bulk.
+
+        Returns:
+            Timeout in seconds or None to use the client default.
+        """
+        return self.request_timeouts.get(operation)
+
+    def _log_slow_query(
+            self, operation, start_time, result=None, query_dsl=None,
+            indices=None, sketch_id=None):
+        """Report a datastore call to the slow query callback if it was slow.
+
+        The callback gets the operation, duration and took in milliseconds,
+        query_dsl as JSON string, index_count, opaque_id and sketch_id as
+        keyword arguments.
+
+        Args:
+            operation: Name of the operation, e.g. search or count.
+            start_time: Time the call was started.
+            result: Response of the call, or None if it failed.
+            query_dsl: Dictionary containing Elasticsearch DSL query
+            indices: List of queried indices
+            sketch_id: Integer of sketch primary key
+        """
+        if not self.slow_query_callback:
+            return
+        duration = time.time() - start_time
+        if self.slow_query_threshold is None or (
+                duration < self.slow_query_threshold):
+            return
+
+        if query_dsl is not None:
+            query_dsl = json.dumps(query_dsl, ensure_ascii=False)
+        self.slow_query_callback(
+            operation=operation, duration=int(duration * 1000),
+            took=(result or {}).get(u'took'), query_dsl=query_dsl,
+            index_count=len(indices) if indices is not None else None,
+            opaque_id=get_opaque_id(), sketch_id=sketch_id)
+
+    def _label_refresh(self):
+        """Get the refresh policy for label updates.
+
+        With a query cache the update has to be searchable before the cache
+        is invalidated, otherwise the next search caches the old result.
+
+        Returns:
+            Refresh parameter for the update, or None to not wait.
+        """
+        if self.query_cache:
+            return u'wait_for'
+        return None
+
+    def invalidate_cache(self, index_names):
+        """Make cached query results for indices stale.
+
+        Args:
+            index_names: Iterable of index names
+        """
+        if not self.query_cache:
+            return
+        for index_name in set(index_names):
+            self.query_cache.bump(index_name)
 
     @staticmethod
-    def _build_label_query(sketch_id, label_name):
+    def _build_label_filter(sketch_id, label_name):
+        """Build Elasticsearch filter for a Timesketch label.
+
+        Labels are stored both as nested objects in timesketch_label and as
+        flat "<sketch_id>:<label>" keywords in timesketch_label_keys. The
+        latter can be matched with a term filter, which is a lot faster than
+        a nested query and is cached by Elasticsearch.
+
+        Args:
+            sketch_id: Integer of sketch primary key.
+            label_name: Name of the label to search for.
+
+        Returns:
+            Elasticsearch filter clause as a dictionary.
+        """
+        return {
+            u'term': {
+                LABEL_KEYS_FIELD: label_key(sketch_id, label_name)
+            }
+        }
+
+    def _build_label_query(self, sketch_id, label_name, indices=None):
         """Build Elasticsearch query for Timesketch labels.
 
+        Events in indices that have not been migrated with backfill_label_keys()
+        only have the nested labels, so the nested query is kept for them.
+
         Args:
             sketch_id: Integer of sketch primary key.
             label_name: Name of the label to search for.
+            indices: Optional list of indices the query is run on.
 
         Returns:
             Elasticsearch query as a dictionary.
         """
-        query_dict = {
-            u'query': {
-                u'nested': {
-                    u'query': {
-                        u'bool': {
-                            u'must': [
-                                {
-                                    u'term': {
-                                        u'timesketch_label.name': label_name
+        label_filter = self._build_label_filter(sketch_id, label_name)
+        if not self._has_label_keys(list(indices or [])):
+            label_filter = {
+                u'bool': {
+                    u'should': [
+                        label_filter,
+                        {
+                            u'nested': {
+                                u'query': {
+                                    u'bool': {
+                                        u'must': [
+                                            {
+                                                u'term': {
+                                                    u'timesketch_label.name':
+                                                        label_name
+                                                }
+                                            },
+                                            {
+                                                u'term': {
+                                                    u'timesketch_label.'
+                                                    u'sketch_id': sketch_id
+                                                }
+                                            }
+                                        ]
                                     }
                                 },
-                                {
-                                    u'term': {
-                                        u'timesketch_label.sketch_id': sketch_id
-                                    }
-                                }
-                            ]
+                                u'path': u'timesketch_label'
+                            }
                         }
-                    },
-                    u'path': u'timesketch_label'
+                    ]
+                }
+            }
+        query_dict = {
+            u'query': {
+                u'bool': {
+                    u'filter': [label_filter]
                 }
             }
         }
@@ -109,18 +538,193 @@ class ElasticsearchDataStore(datastore.DataStore):
         Returns:
             Elasticsearch aggregation as a dictionary.
         """
+        field_name = get_aggregation_field(field_name)
         field_aggregation = {
             u'field_aggregation': {
                 u'terms': {
-                    u'field': u'{0:s}.keyword'.format(field_name)
+                    u'field': field_name
                 }
             }
         }
         return field_aggregation
 
+    @staticmethod
+    def _add_filter(query_dsl, filter_clause):
+        """Add a filter clause to the top level bool query.
+
+        Existing filters are kept. Queries that are not a bool query are
+        wrapped in one.
+
+        Args:
+            query_dsl: Dictionary containing Elasticsearch DSL query
+            filter_clause: Dictionary with the filter to add
+        """
+        query = query_dsl.get(u'query', {u'match_all': {}})
+        if u'bool' not in query:
+            query = {u'bool': {u'must': [query]}}
+            query_dsl[u'query'] = query
+        filters = query[u'bool'].get(u'filter', [])
+        if isinstance(filters, dict):
+            filters = [filters]
+        filters.append(filter_clause)
+        query[u'bool'][u'filter'] = filters
+
+    @staticmethod
+    def _sample_query(query_dsl, sample_rate, seed):
+        """Only match a random sample of the events matching a query.
+
+        Every event gets a random score between 0 and 1 and events scoring
+        below 1 - sample_rate are dropped, so each event is kept with the
+        same probability, whatever index or shard it is in. Aggregations
+        only count the kept events. The seed makes the sample the same for
+        every page and aggregation of a query.
+
+        Args:
+            query_dsl: Dictionary containing Elasticsearch DSL query, updated
+                in place
+            sample_rate: Fraction of the events to keep
+            seed: Integer seed for the random scores
+        """
+        query_dsl[u'query'] = {
+            u'function_score': {
+                u'query': query_dsl.get(u'query', {u'match_all': {}}),
+                u'random_score': {u'seed': seed},
+                u'boost_mode': u'replace'
+            }
+        }
+        query_dsl[u'min_score'] = 1.0 - sample_rate
+
+    def _get_mappings(self, indices):
+        """Get the mappings of indices.
+
+        Args:
+            indices: List of indices
+
+        Returns:
+            Dictionary with the list of document type mappings per index, or
+            None if the mappings can not be read.
+        """
+        missing = [index for index in indices
+                   if index not in _FIELD_MAPPINGS_CACHE]
+        if missing:
+            try:
+                mappings = self.client.indices.get_mapping(index=missing)
+            except (NotFoundError, ConnectionError) as e:
+                es_logger.warning(u'Unable to get mappings: %s', e)
+                return None
+            for index in missing:
+                doc_types = mappings.get(index, {}).get(u'mappings', {})
+                _FIELD_MAPPINGS_CACHE[index] = list(doc_types.values())
+        return {index: _FIELD_MAPPINGS_CACHE[index] for index in indices}
+
+    def _get_mapped_fields(self, indices, predicate):
+        """Get the fields with a mapping that matches in all indices.
+
+        Args:
+            indices: List of indices
+            predicate: Function that gets the mapping of a field as a
+                dictionary and returns a boolean.
+
+        Returns:
+            Set of field names. Empty if the mappings can not be read.
+        """
+        mappings = self._get_mappings(indices) if indices else None
+        if not mappings:
+            return set()
+
+        fields = None
+        for index in indices:
+            for doc_type in mappings[index] or [{}]:
+                doc_type_fields = {
+                    name for name, mapping in doc_type.get(
+                        u'properties', {}).items()
+                    if predicate(mapping)
+                }
+                if fields is None:
+                    fields = doc_type_fields
+                else:
+                    fields &= doc_type_fields
+        return fields
+
+    def _has_label_keys(self, indices):
+        """Check if labels can be matched on the flat label field alone.
+
+        Args:
+            indices: List of indices
+
+        Returns:
+            True if all labeled events in the indices have the flat label
+            field.
+        """
+        mappings = self._get_mappings(indices) if indices else None
+        if not mappings:
+            return False
+        for index in indices:
+            if not mappings[index]:
+                return False
+            for doc_type in mappings[index]:
+                if not doc_type.get(u'_meta', {}).get(
+                        LABEL_KEYS_COMPLETE_META):
+                    return False
+        return True
+
+    def _get_docvalue_fields(self, indices):
+        """Get the fields that have doc values in all indices.
+
+        Args:
+            indices: List of indices
+
+        Returns:
+            Set of field names.
+        """
+        return self._get_mapped_fields(
+            indices, lambda mapping: (
+                mapping.get(u'type') in DOCVALUE_TYPES and
+                mapping.get(u'doc_values', True)))
+
+    def _get_keyword_fields(self, indices):
+        """Get the fields that are mapped as keyword in all indices.
+
+        Only these can be matched with a term filter. In indices created
+        before the Timesketch mapping the same fields are analyzed text.
+
+        Args:
+            indices: List of indices
+
+        Returns:
+            Set of field names.
+        """
+        return self._get_mapped_fields(
+            indices, lambda mapping: mapping.get(u'type') == u'keyword')
+
+    def _project_fields(self, query_dsl, indices, return_fields):
+        """Get only the fields the caller needs from each event.
+
+        Fields with doc values in all indices are read from the doc values
+        with docvalue_fields, so Elasticsearch only has to load and parse the
+        _source for the remaining fields. Wide events are not sent in full.
+
+        Args:
+            query_dsl: Elasticsearch DSL query, docvalue_fields is added to it
+            indices: List of indices to query
+            return_fields: List of fields to return
+
+        Returns:
+            Dictionary with the _source parameters for the search request.
+        """
+        docvalue_fields = self._get_docvalue_fields(
+            list(indices)) & set(return_fields)
+        source_fields = [
+            field for field in return_fields if field not in docvalue_fields]
+        if docvalue_fields:
+            query_dsl[u'docvalue_fields'] = sorted(docvalue_fields)
+        if not source_fields:
+            return {u'_source': False}
+        return {u'_source_include': source_fields}
+
     def build_query(
             self, sketch_id, query_string, query_filter, query_dsl,
-            aggregations=None):
+            aggregations=None, indices=None, tie_breaker=False):
         """Build Elasticsearch DSL query.
 
         Args:
@@ -129,13 +733,21 @@ class ElasticsearchDataStore(datastore.DataStore):
             query_filter: Dictionary containing filters to apply
             query_dsl: Dictionary containing Elasticsearch DSL query
             aggregations: Dict of Elasticsearch aggregations
+            indices: Optional list of indices the query is run on. Their
+                mappings decide which optimizations are safe.
+            tie_breaker: Boolean indicating if events with the same datetime
+                should be sorted on the event ID, see search().
 
         Returns:
             Elasticsearch DSL query as a dictionary
+
+        Raises:
+            ValueError: If the sample in the filter is not valid.
         """
         if not query_dsl:
             if query_filter.get(u'star', None):
-                query_dsl = self._build_label_query(sketch_id, u'__ts_star')
+                query_dsl = self._build_label_query(
+                    sketch_id, u'__ts_star', indices)
 
             if query_filter.get(u'events', None):
                 events = query_filter[u'events']
@@ -153,22 +765,22 @@ class ElasticsearchDataStore(datastore.DataStore):
                         }
                     }
                 }
-            if query_filter.get(u'time_start', None):
-                # TODO(jberggren): Add support for multiple time ranges.
-                query_dsl[u'query'][u'bool'][u'filter'] = {
+            time_ranges = get_time_ranges(query_filter)
+            if time_ranges:
+                self._add_filter(query_dsl, {
                     u'bool': {
                         u'should': [
                             {
                                 u'range': {
                                     u'datetime': {
-                                        u'gte': query_filter[u'time_start'],
-                                        u'lte': query_filter[u'time_end']
+                                        u'gte': time_start,
+                                        u'lte': time_end
                                     }
                                 }
-                            }
+                            } for time_start, time_end in time_ranges
                         ]
                     }
-                }
+                })
             if query_filter.get(u'exclude', None):
                 query_dsl[u'post_filter'] = {
                     u'bool': {
@@ -182,11 +794,30 @@ class ElasticsearchDataStore(datastore.DataStore):
         else:
             query_dsl = json.loads(query_dsl)
 
-        # Make sure we are sorting.
+        # The zoom window of a histogram, see aggregators.zoom_filter().
+        zoom = query_filter.get(u'zoom')
+        if zoom:
+            self._add_filter(query_dsl, {
+                u'range': {
+                    u'datetime': {
+                        u'gte': zoom[u'start'],
+                        u'lte': zoom[u'end'],
+                        u'format': u'epoch_millis'
+                    }
+                }
+            })
+
+        keyword_fields = self._get_keyword_fields(list(indices or []))
+
+        # Make sure we are sorting. When paging, the unique event ID breaks
+        # ties between events with the same datetime so the order is stable
+        # across pages. Sorting on _uid instead would load fielddata for all
+        # document IDs, so indices without the event ID only sort on time.
         if not query_dsl.get(u'sort', None):
-            query_dsl[u'sort'] = {
-                u'datetime': query_filter.get(u'order', u'asc')
-            }
+            order = query_filter.get(u'order', u'asc')
+            query_dsl[u'sort'] = [{u'datetime': order}]
+            if tie_breaker and EVENT_ID_FIELD in keyword_fields:
+                query_dsl[u'sort'].append({EVENT_ID_FIELD: order})
 
         # Remove any aggregation coming from user supplied Query DSL. We have
         # no way to display this data in a good way today.
@@ -199,20 +830,34 @@ class ElasticsearchDataStore(datastore.DataStore):
             # post_filter happens after aggregation so we need to move the
             # filter to the query instead.
             if query_dsl.get(u'post_filter', None):
-                query_dsl[
-                    u'query'][u'bool'][u'filter'] = query_dsl[u'post_filter']
-                query_dsl.pop(u'post_filter', None)
+                self._add_filter(query_dsl, query_dsl.pop(u'post_filter'))
             query_dsl[u'aggregations'] = aggregations
+        query_dsl = optimize_query(query_dsl, keyword_fields)
+
+        # Sampling needs the score, so it is added after the optimizer has
+        # moved the query to filter context.
+        sample_rate = get_sample_rate(query_filter)
+        if sample_rate:
+            self._sample_query(query_dsl, sample_rate, seed=sketch_id)
         return query_dsl
 
+    @timed_method(PHASE_DATASTORE)
     def search(
             self, sketch_id, query_string, query_filter, query_dsl, indices,
             aggregations=None, return_results=True, return_fields=None,
-            enable_scroll=False):
+            enable_scroll=False, cursor=None, paginate=False):
         """Search ElasticSearch. This will take a query string from the UI
         together with a filter definition. Based on this it will execute the
         search request on ElasticSearch and get result back.
 
+        When paginating, a full page of results has a next_cursor that can
+        be passed as cursor to get the next page. Unlike an offset this uses
+        search_after, so deep pages are as cheap as the first one. Events
+        with the same datetime are only kept in a stable order across pages
+        in indices where they were imported with an event ID. In other
+        indices, e.g. from psort, such events can be skipped or repeated at
+        the border between two pages.
+
         Args:
             sketch_id: Integer of sketch primary key
             query_string: Query string
@@ -223,9 +868,16 @@ class ElasticsearchDataStore(datastore.DataStore):
             return_results: Boolean indicating if results should be returned
             return_fields: List of fields to return
             enable_scroll: If Elasticsearch scroll API should be used
+            cursor: Optional cursor from the next_cursor of the previous page
+            paginate: Boolean indicating if a next_cursor should be returned
+                for a full page. Implied by a cursor.
 
         Returns:
             Set of event documents in JSON format
+
+        Raises:
+            ValueError: If the cursor or the sample in the filter is not
+                valid.
         """
         # Limit the number of returned documents.
         DEFAULT_LIMIT = 500  # Maximum events to return
@@ -236,12 +888,8 @@ class ElasticsearchDataStore(datastore.DataStore):
             scroll_timeout = u'1m'  # Default to 1 minute scroll timeout
 
         # Use default fields if none is provided
-        default_fields = [
-            u'datetime', u'timestamp', u'message', u'timestamp_desc',
-            u'timesketch_label', u'tag'
-        ]
         if not return_fields:
-            return_fields = default_fields
+            return_fields = DEFAULT_RETURN_FIELDS
 
         # Exit early if we have no indices to query
         if not indices:
@@ -254,8 +902,12 @@ class ElasticsearchDataStore(datastore.DataStore):
                 if event[u'index'] in indices
             }
 
+        paginate = paginate or bool(cursor)
         query_dsl = self.build_query(
-            sketch_id, query_string, query_filter, query_dsl, aggregations)
+            sketch_id, query_string, query_filter, query_dsl, aggregations,
+            indices=indices, tie_breaker=paginate)
+        if cursor:
+            query_dsl[u'search_after'] = decode_cursor(cursor)
 
         # Default search type for elasticsearch is query_then_fetch.
         search_type = u'query_then_fetch'
@@ -264,14 +916,116 @@ class ElasticsearchDataStore(datastore.DataStore):
         if not return_results:
             LIMIT_RESULTS = 0
 
-        # Suppress the lint error because elasticsearch-py adds parameters
-        # to the function with a decorator and this makes pylint sad.
+        # Results are cached unless they are scrolled, which is stateful.
+        cache_key = None
+        if self.query_cache and not scroll_timeout:
+            cache_key = self.query_cache.make_key(u'search', {
+                u'body': query_dsl,
+                u'size': LIMIT_RESULTS,
+                u'search_type': search_type,
+                u'fields': sorted(return_fields)
+            }, indices)
+            result = self.query_cache.get(cache_key)
+            if result is not None:
+                result[u'cached'] = True
+                return result
+
+        source_params = {u'_source_include': return_fields}
+        if LIMIT_RESULTS:
+            source_params = self._project_fields(
+                query_dsl, indices, return_fields)
+
+        start_time = time.time()
+        result = None
+        try:
+            # Suppress the lint error because elasticsearch-py adds
+            # parameters to the function with a decorator and this makes
+            # pylint sad.
+            # pylint: disable=unexpected-keyword-arg
+            result = self.client.search(
+                body=query_dsl, index=list(indices), size=LIMIT_RESULTS,
+                search_type=search_type, scroll=scroll_timeout,
+                request_timeout=self._request_timeout(u'search'),
+                **source_params)
+        finally:
+            self._log_slow_query(
+                u'search', start_time, result, query_dsl=query_dsl,
+                indices=indices, sketch_id=sketch_id)
+        for event in result[u'hits'][u'hits']:
+            _merge_docvalue_fields(event)
+
+        # A full page means there can be more events after the last one.
+        hits = result[u'hits'][u'hits']
+        if paginate and LIMIT_RESULTS and len(hits) == LIMIT_RESULTS and (
+                hits[-1].get(u'sort')):
+            result[u'next_cursor'] = encode_cursor(hits[-1][u'sort'])
+
+        if cache_key:
+            self.query_cache.set(cache_key, result)
+        return result
+
+    def search_stream(
+            self, sketch_id, query_string, query_filter, query_dsl, indices,
+            return_fields=None, page_size=1000, scroll_timeout=u'1m'):
+        """Search ElasticSearch and yield every matching event.
+
+        Unlike search() this is not limited by the filter limit. Results are
+        fetched page by page with the scroll API so memory use is bounded by
+        the page size, not by the number of matching events.
+
+        Args:
+            sketch_id: Integer of sketch primary key
+            query_string: Query string
+            query_filter: Dictionary containing filters to apply
+            query_dsl: Dictionary containing Elasticsearch DSL query
+            indices: List of indices to query
+            return_fields: List of fields to return
+            page_size: Number of events to fetch per request
+            scroll_timeout: How long Elasticsearch keeps the scroll context
+                alive between two pages
+
+        Yields:
+            Event documents in JSON format
+        """
+        if not indices:
+            return
+
+        if query_filter.get(u'events', None):
+            indices = {
+                event[u'index'] for event in query_filter[u'events']
+                if event[u'index'] in indices
+            }
+
+        query_dsl = self.build_query(
+            sketch_id, query_string, query_filter, query_dsl, indices=indices)
+        source_params = {u'_source_include': return_fields}
+        if return_fields:
+            source_params = self._project_fields(
+                query_dsl, indices, return_fields)
+
         # pylint: disable=unexpected-keyword-arg
-        return self.client.search(
-            body=query_dsl, index=list(indices), size=LIMIT_RESULTS,
-            search_type=search_type, _source_include=return_fields,
-            scroll=scroll_timeout)
+        result = self.client.search(
+            body=query_dsl, index=list(indices), size=page_size,
+            scroll=scroll_timeout,
+            request_timeout=self._request_timeout(u'search'),
+            **source_params)
+        scroll_id = result.get(u'_scroll_id')
+        try:
+            while result[u'hits'][u'hits']:
+                for event in result[u'hits'][u'hits']:
+                    _merge_docvalue_fields(event)
+                    yield event
+                result = self.client.scroll(
+                    scroll_id=scroll_id, scroll=scroll_timeout,
+                    request_timeout=self._request_timeout(u'search'))
+                scroll_id = result.get(u'_scroll_id', scroll_id)
+        finally:
+            # Free the scroll context right away, also if the consumer stops
+            # iterating early (e.g. the client closed the connection).
+            if scroll_id:
+                self.client.clear_scroll(scroll_id=scroll_id, ignore=(404,))
 
+    @timed_method(PHASE_DATASTORE)
     def get_event(self, searchindex_id, event_id):
         """Get one event from the datastore.
 
@@ -292,6 +1046,30 @@ class ElasticsearchDataStore(datastore.DataStore):
         except NotFoundError:
             abort(HTTP_STATUS_CODE_NOT_FOUND)
 
+    @timed_method(PHASE_DATASTORE)
+    def get_events(self, events):
+        """Get many events from the datastore with one request.
+
+        Args:
+            events: List of dictionaries with _index and _id keys
+
+        Returns:
+            List of event documents in JSON format, in the same order.
+            Events that do not exist are left out.
+        """
+        if not events:
+            return []
+        docs = [
+            {u'_index': event[u'_index'], u'_id': event[u'_id']}
+            for event in events
+        ]
+        # pylint: disable=unexpected-keyword-arg
+        result = self.client.mget(
+            body={u'docs': docs}, _source_exclude=[u'timesketch_label'],
+            request_timeout=self._request_timeout(u'search'))
+        return [doc for doc in result[u'docs'] if doc.get(u'found')]
+
+    @timed_method(PHASE_DATASTORE)
     def count(self, indices):
         """Count number of documents.
 
@@ -303,9 +1081,17 @@ class ElasticsearchDataStore(datastore.DataStore):
         """
         if not indices:
             return 0
-        result = self.client.count(index=indices)
+        start_time = time.time()
+        result = None
+        try:
+            # pylint: disable=unexpected-keyword-arg
+            result = self.client.count(
+                index=indices, request_timeout=self._request_timeout(u'count'))
+        finally:
+            self._log_slow_query(u'count', start_time, result, indices=indices)
         return result.get(u'count', 0)
 
+    @timed_method(PHASE_DATASTORE)
     def set_label(
             self, searchindex_id, event_id, event_type, sketch_id, user_id,
             label, toggle=False):
@@ -321,102 +1107,521 @@ class ElasticsearchDataStore(datastore.DataStore):
             toggle: Optional boolean value if the label should be toggled
             (add/remove). The default is False.
         """
-        doc = self.client.get(index=searchindex_id, id=event_id)
-        try:
-            doc[u'_source'][u'timesketch_label']
-        except KeyError:
-            # pylint: disable=redefined-variable-type
-            doc = {u'doc': {u'timesketch_label': []}}
-            self.client.update(
-                index=searchindex_id, doc_type=event_type, id=event_id,
-                body=doc)
+        self._ensure_label_keys_mapping([searchindex_id])
+        script = self._build_label_script(sketch_id, user_id, label, toggle)
+        # pylint: disable=unexpected-keyword-arg
+        self.client.update(
+            index=searchindex_id, id=event_id, doc_type=event_type,
+            body=script, retry_on_conflict=3, refresh=self._label_refresh())
+        self.invalidate_cache([searchindex_id])
+
+    @timed_method(PHASE_DATASTORE)
+    def set_labels(self, events, sketch_id, user_id, label, toggle=False):
+        """Set label on many events with a single bulk request.
+
+        Args:
+            events: List of dictionaries with _index, _id and _type for the
+                events to label
+            sketch_id: Integer of sketch primary key
+            user_id: Integer of user primary key
+            label: String with the name of the label
+            toggle: Optional boolean value if the label should be toggled
+            (add/remove). The default is False.
+
+        Returns:
+            Number of events that could not be labeled.
+        """
+        if not events:
+            return 0
+
+        self._ensure_label_keys_mapping(event[u'_index'] for event in events)
+        script = self._build_label_script(sketch_id, user_id, label, toggle)
+        body = []
+        for event in events:
+            body.append({
+                u'update': {
+                    u'_index': event[u'_index'],
+                    u'_type': event[u'_type'],
+                    u'_id': event[u'_id'],
+                    u'_retry_on_conflict': 3
+                }
+            })
+            body.append(script)
+
+        # pylint: disable=unexpected-keyword-arg
+        result = self.client.bulk(
+            body=body, refresh=self._label_refresh(),
+            request_timeout=self._request_timeout(u'bulk'))
+        self.invalidate_cache(event[u'_index'] for event in events)
+
+        failed = 0
+        if result.get(u'errors'):
+            for item in result[u'items']:
+                error = item.get(u'update', {}).get(u'error')
+                if error:
+                    failed += 1
+                    es_logger.error(
+                        u'Unable to set label on event %s: %s',
+                        item[u'update'].get(u'_id'), error)
+        return failed
+
+    def _put_label_keys_mapping(self, index_name, complete=False):
+        """Map the flat label field as keyword in all document types.
+
+        Args:
+            index_name: Name of the index in Elasticsearch
+            complete: Boolean indicating if the index should be flagged as
+                having the flat label field on all labeled events.
+        """
+        mapping = self.client.indices.get_mapping(index=[index_name])
+        doc_types = mapping.get(index_name, {}).get(u'mappings', {})
+        for doc_type, doc_type_mapping in doc_types.items():
+            body = {
+                u'properties': {
+                    LABEL_KEYS_FIELD: {
+                        u'type': u'keyword'
+                    }
+                }
+            }
+            if complete:
+                meta = dict(doc_type_mapping.get(u'_meta', {}))
+                meta[LABEL_KEYS_COMPLETE_META] = True
+                body[u'_meta'] = meta
+            elif doc_type_mapping.get(u'properties', {}).get(
+                    LABEL_KEYS_FIELD, {}).get(u'type') == u'keyword':
+                continue
+            self.client.indices.put_mapping(
+                index=index_name, doc_type=doc_type, body=body)
+        _FIELD_MAPPINGS_CACHE.pop(index_name, None)
+
+    def _ensure_label_keys_mapping(self, index_names):
+        """Map the flat label field before it is written for the first time.
+
+        Otherwise the first label on an index created before the field
+        existed would map it dynamically as text, where the term filter does
+        not match. Done once per index and process.
+
+        Args:
+            index_names: Iterable of index names
+        """
+        for index_name in set(index_names) - _LABEL_KEYS_MAPPED:
+            try:
+                self._put_label_keys_mapping(index_name)
+            except RequestError as e:
+                # The field is already mapped with another type.
+                es_logger.error(
+                    u'Unable to map %s in %s: %s', LABEL_KEYS_FIELD,
+                    index_name, e)
+            _LABEL_KEYS_MAPPED.add(index_name)
+
+    def backfill_label_keys(self, index_name):
+        """Add the flat label key field to events labeled in an older version.
+
+        Requires the update_label_keys script from the contrib folder to be
+        installed on the Elasticsearch nodes. When all events are updated the
+        index is flagged in its mapping, and labels in it are no longer
+        searched with the nested query.
+
+        Args:
+            index_name: Name of the index in Elasticsearch
+
+        Returns:
+            Number of events that were updated.
+        """
+        self._put_label_keys_mapping(index_name)
+
+        body = {
+            u'query': {
+                u'nested': {
+                    u'path': u'timesketch_label',
+                    u'query': {
+                        u'exists': {
+                            u'field': u'timesketch_label.name'
+                        }
+                    }
+                }
+            },
+            u'script': {
+                u'lang': u'groovy',
+                u'file': u'update_label_keys'
+            }
+        }
+        # pylint: disable=unexpected-keyword-arg
+        result = self.client.update_by_query(
+            index=index_name, body=body, conflicts=u'proceed',
+            request_timeout=self._request_timeout(u'bulk'))
+        if result.get(u'failures'):
+            es_logger.error(
+                u'Unable to update all labeled events in %s: %s',
+                index_name, result[u'failures'])
+        else:
+            self._put_label_keys_mapping(index_name, complete=True)
+        return result.get(u'updated', 0)
+
+    @staticmethod
+    def _build_label_script(sketch_id, user_id, label, toggle=False):
+        """Build the update script that adds or toggles a label.
+
+        The scripts are installed on the Elasticsearch nodes, see the contrib
+        folder. They create the label list if the event has no labels yet.
+
+        Args:
+            sketch_id: Integer of sketch primary key
+            user_id: Integer of user primary key
+            label: String with the name of the label
+            toggle: Boolean value if the label should be toggled
 
+        Returns:
+            Elasticsearch update request body as a dictionary.
+        """
         # Choose the correct script.
         script_name = u'add_label'
         if toggle:
             script_name = u'toggle_label'
-        script = {
+        return {
             u'script': {
                 u'lang': u'groovy',
                 u'file': script_name,
                 u'params': {
                     u'timesketch_label': {
-                        u'name': str(label),
+                        u'name': unicode(label),
                         u'user_id': user_id,
                         u'sketch_id': sketch_id
                     }
                 }
             }
         }
-        self.client.update(
-            index=searchindex_id, id=event_id, doc_type=event_type,
-            body=script)
+
+    @staticmethod
+    def _build_document_mapping(doc_type):
+        """Build the mapping for Timesketch events.
+
+        Fields not listed here are mapped dynamically.
+
+        Args:
+            doc_type: Name of the document type.
+
+        Returns:
+            Elasticsearch mapping as a dictionary.
+        """
+        properties = {
+            u'datetime': {
+                u'type': u'date'
+            },
+            u'timestamp': {
+                u'type': u'long'
+            },
+            u'message': {
+                u'type': u'text',
+                u'fields': {
+                    u'keyword': {
+                        u'type': u'keyword',
+                        u'ignore_above': MESSAGE_KEYWORD_IGNORE_ABOVE
+                    }
+                }
+            },
+            u'timesketch_label': {
+                u'type': u'nested'
+            },
+            LABEL_KEYS_FIELD: {
+                u'type': u'keyword'
+            },
+            EVENT_ID_FIELD: {
+                u'type': u'keyword'
+            }
+        }
+        for field_name in KEYWORD_FIELDS:
+            properties[field_name] = {u'type': u'keyword'}
+        return {
+            doc_type: {
+                u'_meta': {LABEL_KEYS_COMPLETE_META: True},
+                u'properties': properties
+            }
+        }
+
+    @staticmethod
+    def _build_index_settings(source_size=None, ingest_mode=False):
+        """Build the index settings for a new timeline.
+
+        The number of shards grows with the size of the imported file, one
+        shard per ELASTIC_INDEX_SHARD_SIZE bytes up to ELASTIC_INDEX_MAX_SHARDS.
+
+        Args:
+            source_size: Optional size in bytes of the file that is imported.
+            ingest_mode: Boolean indicating if the index should be tuned for
+                bulk loading, see finalize_index().
+
+        Returns:
+            Elasticsearch index settings as a dictionary.
+        """
+        config = {}
+        if has_app_context():
+            config = current_app.config
+
+        shard_size = config.get(
+            u'ELASTIC_INDEX_SHARD_SIZE', DEFAULT_INDEX_SHARD_SIZE)
+        max_shards = config.get(
+            u'ELASTIC_INDEX_MAX_SHARDS', DEFAULT_INDEX_MAX_SHARDS)
+        shards = 1
+        if source_size:
+            shards = min(max_shards, max(1, -(-source_size // shard_size)))
+
+        settings = {
+            u'number_of_shards': shards,
+            u'number_of_replicas': config.get(
+                u'ELASTIC_INDEX_REPLICAS', DEFAULT_INDEX_REPLICAS)
+        }
+        codec = config.get(u'ELASTIC_INDEX_CODEC')
+        if codec:
+            settings[u'codec'] = codec
+
+        if ingest_mode:
+            # Nobody searches the index before the import is done, so don't
+            # spend time on refreshes and on copying every batch to replicas.
+            settings[u'refresh_interval'] = u'-1'
+            settings[u'number_of_replicas'] = 0
+            if config.get(u'ELASTIC_INGEST_TRANSLOG_ASYNC', False):
+                settings[u'translog.durability'] = u'async'
+        return {u'index': settings}
 
     def create_index(
-            self, index_name=uuid4().hex, doc_type=u'generic_event'):
+            self, index_name=uuid4().hex, doc_type=u'generic_event',
+            source_size=None, ingest_mode=False):
         """Create index with Timesketch settings.
 
         Args:
             index_name: Name of the index. Default is a generated UUID.
             doc_type: Name of the document type. Default id generic_event.
+            source_size: Optional size in bytes of the file that is imported,
+                used to pick the number of shards.
+            ingest_mode: Optional boolean indicating if a new index should be
+                tuned for bulk loading. The caller must call finalize_index()
+                when all events are imported. The default is False.
 
         Returns:
             Index name in string format.
             Document type in string format.
         """
-        _document_mapping = {
-            doc_type: {
-                u'properties': {
-                    u'timesketch_label': {
-                        u'type': u'nested'
-                    }
-                }
-            }
-        }
-
         if not self.client.indices.exists(index_name):
+            body = {
+                u'settings': self._build_index_settings(
+                    source_size, ingest_mode),
+                u'mappings': self._build_document_mapping(doc_type)
+            }
             try:
-                self.client.indices.create(
-                    index=index_name, body={u'mappings': _document_mapping})
+                self.client.indices.create(index=index_name, body=body)
             except ConnectionError:
                 raise RuntimeError(u'Unable to connect to Timesketch backend.')
+            if ingest_mode:
+                self.ingest_indices.add(index_name)
         # We want to return unicode here to keep SQLalchemy happy.
         index_name = unicode(index_name.decode(encoding=u'utf-8'))
         doc_type = unicode(doc_type.decode(encoding=u'utf-8'))
         return index_name, doc_type
 
+    def finalize_index(self, index_name, merge=True):
+        """Make an index created in ingest mode ready for searching.
+
+        Restores refresh, replicas and translog settings and merges the index
+        down to a few segments. Timelines are read only after import, so the
+        merge only has to be done once and makes searches faster. Indices not
+        created in ingest mode by this datastore object are left untouched.
+
+        Args:
+            index_name: Name of the index in Elasticsearch
+            merge: Optional boolean indicating if the index should be merged.
+                Set to False to only restore the settings, e.g. after a
+                failed import. The default is True.
+
+        Returns:
+            Boolean indicating if the index was finalized.
+        """
+        if index_name not in self.ingest_indices:
+            return False
+
+        config = {}
+        if has_app_context():
+            config = current_app.config
+
+        settings = {
+            u'refresh_interval': None,
+            u'number_of_replicas': config.get(
+                u'ELASTIC_INDEX_REPLICAS', DEFAULT_INDEX_REPLICAS)
+        }
+        if config.get(u'ELASTIC_INGEST_TRANSLOG_ASYNC', False):
+            settings[u'translog.durability'] = None
+        self.client.indices.put_settings(
+            index=index_name, body={u'index': settings})
+        self.ingest_indices.discard(index_name)
+        self.client.indices.refresh(index=index_name)
+
+        if merge:
+            try:
+                # pylint: disable=unexpected-keyword-arg
+                self._get_merge_client().indices.forcemerge(
+                    index=index_name,
+                    max_num_segments=config.get(
+                        u'ELASTIC_INGEST_MAX_SEGMENTS',
+                        DEFAULT_INGEST_MAX_SEGMENTS),
+                    request_timeout=self._request_timeout(u'forcemerge'))
+            except ConnectionTimeout:
+                # The merge keeps running in Elasticsearch.
+                es_logger.warning(
+                    u'Timeout waiting for force merge of %s', index_name)
+
+        self.invalidate_cache([index_name])
+        return True
+
+    def index_stats(self, index_name):
+        """Get the number of events, time span and size of an index.
+
+        The min and max aggregations read doc values, so this is one cheap
+        request regardless of the size of the index.
+
+        Args:
+            index_name: Name of the index
+
+        Returns:
+            Dictionary with event_count, min_datetime and max_datetime (as
+            datetime.datetime in UTC or None for an empty index) and
+            size_in_bytes.
+        """
+        body = {
+            u'size': 0,
+            u'aggs': {
+                u'min_datetime': {u'min': {u'field': u'datetime'}},
+                u'max_datetime': {u'max': {u'field': u'datetime'}}
+            }
+        }
+        # pylint: disable=unexpected-keyword-arg
+        result = self.client.search(
+            index=index_name, body=body,
+            request_timeout=self._request_timeout(u'search'))
+        store = self.client.indices.stats(index=index_name, metric=u'store')
+        aggregations = result.get(u'aggregations', {})
+
+        def _to_datetime(aggregation):
+            """Convert epoch milliseconds from a min/max aggregation."""
+            value = aggregations.get(aggregation, {}).get(u'value')
+            if value is None:
+                return None
+            return datetime.datetime.utcfromtimestamp(value / 1000.0)
+
+        return {
+            u'event_count': result[u'hits'][u'total'],
+            u'min_datetime': _to_datetime(u'min_datetime'),
+            u'max_datetime': _to_datetime(u'max_datetime'),
+            u'size_in_bytes': store.get(u'_all', {}).get(
+                u'primaries', {}).get(u'store', {}).get(u'size_in_bytes')
+        }
+
     def import_event(self, flush_interval, index_name, event_type, event=None):
         """Add event to Elasticsearch.
 
+        Events are indexed in the background by a pipelined bulk indexer.
+        Call this method without an event when all events have been added to
+        index the remaining events and wait for indexing to finish.
+
         Args:
-            flush_interval: Number of events to queue up before indexing
+            flush_interval: Number of events to queue up before indexing. The
+                bulk indexer adapts this to the observed latency.
             index_name: Name of the index in Elasticsearch
             event_type: Type of event (e.g. plaso_event)
             event: Event dictionary
+
+        Returns:
+            Number of events added so far.
         """
+        if not self.bulk_indexer:
+            self.bulk_indexer = self._create_bulk_indexer(
+                flush_interval, index_name, event_type)
+
         if event:
             # Make sure we have decoded strings in the event dict.
             event = {
-                k.decode(u'utf8'): v.decode(u'utf8') for k, v in event.items()
+                _decode(k): _decode(v) for k, v in event.items()
             }
-
-            # Header needed by Elasticsearch when bulk inserting.
-            self.import_events.append({
-                u'index': {
-                    u'_index': index_name, u'_type': event_type
-                }
-            })
-            self.import_events.append(event)
+            event.setdefault(EVENT_ID_FIELD, uuid4().hex)
+            self.bulk_indexer.add(event)
             self.import_counter[u'events'] += 1
-            if self.import_counter[u'events'] % int(flush_interval) == 0:
-                self.client.bulk(
-                    index=index_name, doc_type=event_type,
-                    body=self.import_events)
-                self.import_events = []
         else:
-            if self.import_events:
-                self.client.bulk(
-                    index=index_name, doc_type=event_type,
-                    body=self.import_events)
+            counter = self.bulk_indexer.close()
+            self.bulk_indexer = None
+            self.invalidate_cache([index_name])
+            self.import_counter[u'indexed'] += counter[u'indexed']
+            self.import_counter[u'failed'] += counter[u'failed']
+            if counter[u'failed']:
+                es_logger.error(
+                    u'%d events could not be indexed into %s',
+                    counter[u'failed'], index_name)
 
         return self.import_counter[u'events']
+
+    def _create_bulk_indexer(self, flush_interval, index_name, event_type):
+        """Create a bulk indexer configured from the Timesketch config.
+
+        Args:
+            flush_interval: Initial number of events per bulk request
+            index_name: Name of the index in Elasticsearch
+            event_type: Type of event (e.g. plaso_event)
+
+        Returns:
+            Instance of timesketch.lib.datastores.elastic_bulk.BulkIndexer
+        """
+        config = {}
+        if has_app_context():
+            config = current_app.config
+
+        dead_letter_path = None
+        dead_letter_folder = config.get(u'ELASTIC_BULK_DEAD_LETTER_FOLDER')
+        if dead_letter_folder:
+            dead_letter_path = os.path.join(
+                dead_letter_folder, u'{0:s}.failed.jsonl'.format(index_name))
+        self.dead_letter_path = dead_letter_path
+
+        return BulkIndexer(
+            self.client, index_name, event_type, batch_size=flush_interval,
+            max_bytes=config.get(
+                u'ELASTIC_BULK_MAX_BYTES', DEFAULT_BULK_MAX_BYTES),
+            workers=config.get(u'ELASTIC_BULK_WORKERS', DEFAULT_BULK_WORKERS),
+            target_latency=config.get(
+                u'ELASTIC_BULK_TARGET_LATENCY', DEFAULT_BULK_TARGET_LATENCY),
+            max_retries=config.get(
+                u'ELASTIC_BULK_MAX_RETRIES', DEFAULT_MAX_RETRIES),
+            dead_letter_path=dead_letter_path,
+            request_timeout=self._request_timeout(u'bulk'),
+            id_field=EVENT_ID_FIELD)
+
+
+def _merge_docvalue_fields(event):
+    """Move doc value fields of a search hit into its _source.
+
+    This way callers get the same event whether a field was read from the
+    doc values or from the _source. Events always get a _source, also when
+    it was not requested and the event has none of the doc value fields.
+
+    Args:
+        event: Event document from a search result, updated in place.
+    """
+    source = event.setdefault(u'_source', {})
+    docvalues = event.pop(u'fields', None)
+    if not docvalues:
+        return
+    for field, values in docvalues.items():
+        if field not in MULTI_VALUED_FIELDS and len(values) == 1:
+            values = values[0]
+        source[field] = values
+
+
+def _decode(value):
+    """Decode byte strings to unicode, leave other values untouched.
+
+    Args:
+        value: Any value from an event dictionary.
+
+    Returns:
+        The value, as unicode if it was a byte string.
+    """
+    if isinstance(value, str):
+        return value.decode(u'utf8')
+    return value
@@ -0,0 +1,303 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Pipelined bulk indexer for Elasticsearch."""
+
+from collections import Counter
+import json
+import logging
+import os
+import Queue
+import threading
+import time
+
+from elasticsearch.exceptions import ConnectionError
+from elasticsearch.exceptions import TransportError
+
+logger = logging.getLogger(u'timesketch.bulk')
+logger.addHandler(logging.NullHandler())
+
+# HTTP status codes for rejected bulk items that are worth retrying.
+RETRY_STATUS_CODES = frozenset([429, 502, 503, 504])
+
+
+class BulkIndexer(object):
+    """Index events with bulk requests sent from worker threads.
+
+    Events are serialized on the calling thread and grouped into batches. A
+    batch is handed over to a pool of worker threads when it reaches either
+    the current batch size or the maximum number of bytes, so parsing of the
+    next batch overlaps with indexing of the previous ones.
+
+    The batch size adapts to the observed latency of the bulk requests. Items
+    rejected by Elasticsearch because it is overloaded are retried with
+    exponential backoff. Items that fail permanently are written to a dead
+    letter file in JSON lines format.
+
+    Events that have a value for the ID field are indexed with that value
+    as document ID. Sending a batch again after a timeout then overwrites
+    the events instead of storing them twice.
+
+    Attributes:
+        counter: Counter with number of events added, indexed and failed.
+        batch_size: Current target number of events per bulk request.
+    """
+
+    def __init__(
+            self, client, index_name, doc_type, batch_size=1000,
+            max_bytes=10 * 1024 * 1024, workers=2, target_latency=2.0,
+            max_retries=5, backoff=0.5, dead_letter_path=None,
+            request_timeout=None, id_field=None):
+        """Initialize the indexer and start the worker threads.
+
+        Args:
+            client: Elasticsearch client (instance of Elasticsearch)
+            index_name: Name of the index in Elasticsearch
+            doc_type: Document type of the events
+            batch_size: Initial number of events per bulk request
+            max_bytes: Maximum size of a bulk request body in bytes
+            workers: Number of threads sending bulk requests
+            target_latency: Bulk request latency in seconds to aim for when
+                adapting the batch size
+            max_retries: Number of times to retry rejected events
+            backoff: Seconds to wait before the first retry, doubled for
+                every following attempt
+            dead_letter_path: Optional path to a file where events that could
+                not be indexed are written
+            request_timeout: Optional timeout in seconds for bulk requests
+            id_field: Optional name of the event field with the document ID
+        """
+        self.client = client
+        self.index_name = index_name
+        self.doc_type = doc_type
+        self.batch_size = int(batch_size)
+        self.min_batch_size = max(1, self.batch_size // 10)
+        self.max_batch_size = self.batch_size * 10
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.dead_letter_path = dead_letter_path
+        self.request_timeout = request_timeout
+        self.id_field = id_field
+        self.counter = Counter()
+
+        self._action = json.dumps(
+            {u'index': {u'_index': index_name, u'_type': doc_type}})
+        self._batch = []
+        self._batch_bytes = 0
+        self._lock = threading.Lock()
+        self._dead_letter_file = None
+        # Bound the queue so that parsing can't run arbitrarily far ahead of
+        # indexing and use up all memory.
+        self._queue = Queue.Queue(maxsize=workers * 2)
+        self._workers = []
+        for _ in range(workers):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def add(self, event):
+        """Queue an event for indexing.
+
+        Args:
+            event: Event dictionary
+        """
+        document = json.dumps(event)
+        action = self._action
+        if self.id_field and event.get(self.id_field):
+            action = json.dumps({u'index': {
+                u'_index': self.index_name, u'_type': self.doc_type,
+                u'_id': event[self.id_field]}})
+        self._batch.append((action, document))
+        # Account for the two newlines.
+        self._batch_bytes += len(action) + len(document) + 2
+        self.counter[u'events'] += 1
+        if (len(self._batch) >= self.batch_size or
+                self._batch_bytes >= self.max_bytes):
+            self.flush()
+
+    def flush(self):
+        """Hand over the current batch to the worker threads."""
+        if self._batch:
+            self._queue.put(self._batch)
+            self._batch = []
+            self._batch_bytes = 0
+
+    def close(self):
+        """Index remaining events and wait for the workers to finish.
+
+        Returns:
+            Counter with number of events added, indexed and failed.
+        """
+        self.flush()
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self._dead_letter_file:
+            self._dead_letter_file.close()
+            self._dead_letter_file = None
+        return self.counter
+
+    def _worker(self):
+        """Worker thread main loop."""
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            try:
+                self._index_batch(batch)
+            except Exception as e:  # pylint: disable=broad-except
+                # Never let a worker die, that would dead lock close().
+                logger.exception(u'Bulk indexing failed')
+                self._dead_letter(batch, unicode(e))
+
+    def _index_batch(self, batch):
+        """Send a batch and retry rejected events with backoff.
+
+        Args:
+            batch: List of (action, event) tuples, both JSON serialized
+        """
+        attempt = 0
+        while batch:
+            try:
+                rejected, failed = self._send(batch)
+            except (ConnectionError, TransportError) as e:
+                status_code = getattr(e, u'status_code', None)
+                if (isinstance(e, TransportError) and
+                        not isinstance(e, ConnectionError) and
+                        status_code not in RETRY_STATUS_CODES):
+                    raise
+                rejected, failed = batch, []
+
+            if failed:
+                self._dead_letter(
+                    [item for item, _ in failed],
+                    [error for _, error in failed])
+
+            if not rejected:
+                return
+
+            attempt += 1
+            if attempt > self.max_retries:
+                self._dead_letter(rejected, u'Too many retries')
+                return
+
+            with self._lock:
+                self.counter[u'retried'] += len(rejected)
+            time.sleep(self.backoff * 2 ** (attempt - 1))
+            batch = rejected
+
+    def _send(self, batch):
+        """Send one bulk request.
+
+        Args:
+            batch: List of (action, event) tuples, both JSON serialized
+
+        Returns:
+            Tuple of list of items to retry, and list of (item, error)
+            tuples for items that failed permanently.
+        """
+        lines = []
+        for action, document in batch:
+            lines.append(action)
+            lines.append(document)
+        body = u'\n'.join(lines) + u'\n'
+
+        start_time = time.time()
+        # pylint: disable=unexpected-keyword-arg
+        response = self.client.bulk(
+            body=body, request_timeout=self.request_timeout)
+        self._adapt_batch_size(time.time() - start_time)
+
+        rejected = []
+        failed = []
+        if response.get(u'errors'):
+            for batch_item, item in zip(batch, response[u'items']):
+                result = item.get(u'index', {})
+                status = result.get(u'status', 200)
+                if status in RETRY_STATUS_CODES:
+                    rejected.append(batch_item)
+                elif status >= 300:
+                    failed.append((batch_item, result.get(u'error')))
+
+        with self._lock:
+            self.counter[u'indexed'] += len(batch) - len(rejected) - len(
+                failed)
+        return rejected, failed
+
+    def _adapt_batch_size(self, latency):
+        """Grow or shrink the batch size based on bulk request latency.
+
+        Args:
+            latency: Seconds the last bulk request took
+        """
+        with self._lock:
+            if latency > self.target_latency * 1.5:
+                self.batch_size = max(
+                    self.min_batch_size, int(self.batch_size * 0.5))
+            elif latency < self.target_latency * 0.5:
+                self.batch_size = min(
+                    self.max_batch_size, int(self.batch_size * 1.5) + 1)
+
+    def _dead_letter(self, batch, errors):
+        """Record events that could not be indexed.
+
+        Args:
+            batch: List of (action, event) tuples, both JSON serialized
+            errors: Error description, or list of errors, one per event
+        """
+        documents = [document for _, document in batch]
+        if not isinstance(errors, list):
+            errors = [errors] * len(documents)
+
+        with self._lock:
+            self.counter[u'failed'] += len(documents)
+            if not self.dead_letter_path:
+                logger.error(
+                    u'%d events could not be indexed', len(documents))
+                return
+            if not self._dead_letter_file:
+                try:
+                    self._dead_letter_file = _open_private(
+                        self.dead_letter_path)
+                except (IOError, OSError) as e:
+                    logger.error(
+                        u'%d events could not be indexed, unable to open '
+                        u'%s: %s', len(documents), self.dead_letter_path, e)
+                    return
+            for document, error in zip(documents, errors):
+                self._dead_letter_file.write(json.dumps({
+                    u'event': json.loads(document),
+                    u'error': error
+                }) + u'\n')
+            self._dead_letter_file.flush()
+
+
+def _open_private(path):
+    """Open a file for appending that only the current user can read.
+
+    The file holds event data, so it is created with mode 0600 and a symlink
+    in its place is not followed.
+
+    Args:
+        path: Path to the file
+
+    Returns:
+        File object opened for appending in binary mode.
+    """
+    fd = os.open(
+        path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_NOFOLLOW, 0o600)
+    return os.fdopen(fd, u'ab')
@@ -0,0 +1,158 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the bulk indexer."""
+
+import json
+import os
+import shutil
+import tempfile
+
+from elasticsearch.exceptions import ConnectionTimeout
+
+from timesketch.lib.datastores.elastic_bulk import BulkIndexer
+from timesketch.lib.testlib import BaseTest
+
+
+class MockBulkClient(object):
+    """A mock Elasticsearch client that answers bulk requests.
+
+    Events with a message of "reject" are rejected with HTTP 429 the first
+    time they are seen, events with a message of "fail" always fail. Stored
+    events are kept by document ID, events without one get a new ID.
+    """
+    def __init__(self):
+        self.requests = []
+        self.rejected = set()
+        self.stored = {}
+
+    # pylint: disable=unused-argument
+    def bulk(self, body, request_timeout=None):
+        """Mock a bulk request."""
+        lines = body.strip().split(u'\n')
+        actions = [json.loads(line) for line in lines[::2]]
+        documents = [json.loads(line) for line in lines[1::2]]
+        self.requests.append(documents)
+        items = []
+        for action, document in zip(actions, documents):
+            document_id = action[u'index'].get(u'_id', len(self.stored))
+            self.stored[document_id] = document
+            status = 201
+            if document[u'message'] == u'fail':
+                status = 400
+            elif (document[u'message'] == u'reject' and
+                  document[u'id'] not in self.rejected):
+                self.rejected.add(document[u'id'])
+                status = 429
+            items.append({u'index': {u'status': status, u'error': u'test'}})
+        errors = any(item[u'index'][u'status'] != 201 for item in items)
+        return {u'errors': errors, u'items': items}
+
+
+class BulkIndexerTest(BaseTest):
+    """Test the bulk indexer."""
+    def setUp(self):
+        super(BulkIndexerTest, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.dead_letter_path = os.path.join(self.temp_dir, u'failed.jsonl')
+
+    def tearDown(self):
+        super(BulkIndexerTest, self).tearDown()
+        shutil.rmtree(self.temp_dir)
+
+    def _index(self, messages, **kwargs):
+        """Index events with the given messages.
+
+        Returns:
+            Tuple with mock client and the indexer counter.
+        """
+        client = MockBulkClient()
+        indexer = BulkIndexer(
+            client, u'test', u'test_event', backoff=0,
+            dead_letter_path=self.dead_letter_path, **kwargs)
+        for i, message in enumerate(messages):
+            indexer.add({u'id': i, u'message': message})
+        return client, indexer.close()
+
+    def test_index_in_batches(self):
+        """Test that events are split in batches."""
+        client, counter = self._index([u'test'] * 25, batch_size=10)
+        self.assertEqual(counter[u'events'], 25)
+        self.assertEqual(counter[u'indexed'], 25)
+        self.assertEqual(sum(len(r) for r in client.requests), 25)
+
+    def test_flush_on_size(self):
+        """Test that a batch is sent when it reaches the maximum size."""
+        client, _ = self._index(
+            [u'test'] * 10, batch_size=1000, max_bytes=100, workers=1)
+        self.assertGreater(len(client.requests), 1)
+
+    def test_retry_rejected(self):
+        """Test that rejected events are retried."""
+        _, counter = self._index([u'test', u'reject'], batch_size=10)
+        self.assertEqual(counter[u'indexed'], 2)
+        self.assertEqual(counter[u'retried'], 1)
+        self.assertEqual(counter[u'failed'], 0)
+
+    def test_dead_letter(self):
+        """Test that failed events end up in the dead letter file."""
+        _, counter = self._index([u'test', u'fail'], batch_size=10)
+        self.assertEqual(counter[u'indexed'], 1)
+        self.assertEqual(counter[u'failed'], 1)
+        with open(self.dead_letter_path) as fh:
+            failed = [json.loads(line) for line in fh]
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0][u'event'][u'message'], u'fail')
+        self.assertEqual(os.stat(self.dead_letter_path).st_mode & 0o777, 0o600)
+
+    def test_dead_letter_symlink(self):
+        """Test that a symlink in place of the dead letter file is refused."""
+        target = os.path.join(self.temp_dir, u'target')
+        os.symlink(target, self.dead_letter_path)
+        _, counter = self._index([u'test', u'fail'], batch_size=10)
+        self.assertEqual(counter[u'failed'], 1)
+        self.assertFalse(os.path.exists(target))
+
+    def test_retry_timeout_with_id(self):
+        """Test that a batch sent again after a timeout is not duplicated."""
+        client = MockBulkClient()
+        bulk = client.bulk
+
+        def _timeout_once(body, request_timeout=None):
+            """Index the batch, but time out the first request."""
+            response = bulk(body, request_timeout=request_timeout)
+            if len(client.requests) == 1:
+                raise ConnectionTimeout(u'TIMEOUT', u'timeout', None)
+            return response
+
+        client.bulk = _timeout_once
+        indexer = BulkIndexer(
+            client, u'test', u'test_event', backoff=0, id_field=u'event_id')
+        for i in range(2):
+            indexer.add({u'event_id': u'id{0:d}'.format(i), u'message': u'a'})
+        counter = indexer.close()
+        self.assertEqual(len(client.requests), 2)
+        self.assertEqual(sorted(client.stored), [u'id0', u'id1'])
+        self.assertEqual(counter[u'indexed'], 2)
+
+    def test_adapt_batch_size(self):
+        """Test that the batch size follows the bulk request latency."""
+        indexer = BulkIndexer(
+            MockBulkClient(), u'test', u'test_event', batch_size=100,
+            target_latency=1.0)
+        # pylint: disable=protected-access
+        indexer._adapt_batch_size(5.0)
+        self.assertEqual(indexer.batch_size, 50)
+        indexer._adapt_batch_size(0.1)
+        self.assertGreater(indexer.batch_size, 50)
+        indexer.close()
@@ -0,0 +1,226 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Optimizer for Elasticsearch queries.
+
+Results are sorted on time, so the relevance score Elasticsearch computes
+for every hit is thrown away. The optimizer rewrites a query so that it
+matches the same events, but runs in filter context where it is not scored
+and where Elasticsearch can cache the clauses.
+"""
+
+import re
+
+# Simple "field:value" or field:"value" query strings. Values with query
+# string syntax (wildcards, ranges, escapes, boolean operators) are left to
+# the query string parser.
+SIMPLE_FIELD_QUERY_RE = re.compile(
+    r'^(?P<field>[A-Za-z][\w.]*):'
+    r'(?:"(?P<quoted>[^"\\]*)"|(?P<value>[^\s"*?~^\\:()\[\]{}<>=/+\-!&|]+))$',
+    re.UNICODE)
+
+# Query string that matches all events.
+MATCH_ALL_QUERY_STRING = u'*'
+
+# Clauses of a bool query.
+BOOL_OCCURRENCES = (u'must', u'filter', u'should', u'must_not')
+
+
+def optimize_query(query_dsl, keyword_fields=frozenset()):
+    """Rewrite a query to be cheaper to execute.
+
+    The following rewrites are done:
+
+    * Clauses that do not affect the sort order are moved to filter context,
+      using constant_score or the filter clause of a bool query.
+    * A post_filter is moved into the query when there are no aggregations
+      that must not be filtered by it.
+    * Query strings like field:value on keyword fields become term filters.
+    * Query strings matching everything and match_all clauses are removed.
+
+    Args:
+        query_dsl: Dictionary containing Elasticsearch DSL query, updated in
+            place.
+        keyword_fields: Set of field names mapped as keyword only.
+
+    Returns:
+        The optimized Elasticsearch DSL query as a dictionary.
+    """
+    if query_dsl.get(u'post_filter') and not (
+            query_dsl.get(u'aggregations') or query_dsl.get(u'aggs')):
+        post_filter = query_dsl.pop(u'post_filter')
+        query = query_dsl.get(u'query', {u'match_all': {}})
+        if u'bool' not in query:
+            query = {u'bool': {u'must': [query]}}
+        filters = query[u'bool'].get(u'filter', [])
+        if isinstance(filters, dict):
+            filters = [filters]
+        query[u'bool'][u'filter'] = filters + [post_filter]
+        query_dsl[u'query'] = query
+
+    query = query_dsl.get(u'query')
+    if query is None:
+        return query_dsl
+
+    query = _optimize_clause(query, keyword_fields)
+    if not _uses_score(query_dsl):
+        query = _to_filter_context(query)
+    if _is_match_all(query):
+        # No query is the same as match_all.
+        del query_dsl[u'query']
+    else:
+        query_dsl[u'query'] = query
+    return query_dsl
+
+
+def _uses_score(query_dsl):
+    """Check if the relevance score is used by a query.
+
+    Args:
+        query_dsl: Dictionary containing Elasticsearch DSL query
+
+    Returns:
+        True if the results are sorted on or filtered by the score.
+    """
+    if query_dsl.get(u'min_score') is not None or query_dsl.get(
+            u'track_scores'):
+        return True
+    sort = query_dsl.get(u'sort')
+    if not sort:
+        # Elasticsearch sorts on score by default.
+        return True
+    if not isinstance(sort, list):
+        sort = [sort]
+    for sort_clause in sort:
+        if isinstance(sort_clause, dict):
+            if u'_score' in sort_clause:
+                return True
+        elif sort_clause == u'_score':
+            return True
+    return False
+
+
+def _is_match_all(clause):
+    """Check if a clause matches all events.
+
+    Args:
+        clause: Elasticsearch query clause as a dictionary
+
+    Returns:
+        True if the clause is a match_all query without a boost.
+    """
+    return clause == {u'match_all': {}}
+
+
+def _optimize_query_string(clause, keyword_fields):
+    """Rewrite a simple query string query.
+
+    Args:
+        clause: Elasticsearch query_string clause as a dictionary
+        keyword_fields: Set of field names mapped as keyword only.
+
+    Returns:
+        The rewritten clause, or the clause itself if it can not be
+        rewritten.
+    """
+    options = clause[u'query_string']
+    # Any option (default field, analyzer, ...) changes how the query string
+    # is parsed, so only plain query strings are rewritten.
+    if set(options) != {u'query'}:
+        return clause
+    query_string = options[u'query'].strip()
+    if query_string == MATCH_ALL_QUERY_STRING:
+        return {u'match_all': {}}
+
+    match = SIMPLE_FIELD_QUERY_RE.match(query_string)
+    if not match or match.group(u'field') not in keyword_fields:
+        # Other fields are analyzed, so a term query would not match the
+        # same events.
+        return clause
+    value = match.group(u'quoted')
+    if value is None:
+        value = match.group(u'value')
+    return {u'term': {match.group(u'field'): value}}
+
+
+def _optimize_clause(clause, keyword_fields):
+    """Optimize a query clause and all clauses in it.
+
+    Args:
+        clause: Elasticsearch query clause as a dictionary
+        keyword_fields: Set of field names mapped as keyword only.
+
+    Returns:
+        The optimized clause.
+    """
+    if u'query_string' in clause:
+        return _optimize_query_string(clause, keyword_fields)
+
+    if u'constant_score' in clause:
+        constant_score = dict(clause[u'constant_score'])
+        constant_score[u'filter'] = _optimize_clause(
+            constant_score[u'filter'], keyword_fields)
+        return {u'constant_score': constant_score}
+
+    if u'bool' not in clause:
+        return clause
+
+    bool_query = dict(clause[u'bool'])
+    removed_match_all = False
+    for occurrence in BOOL_OCCURRENCES:
+        if occurrence not in bool_query:
+            continue
+        clauses = bool_query[occurrence]
+        if isinstance(clauses, dict):
+            clauses = [clauses]
+        clauses = [_optimize_clause(c, keyword_fields) for c in clauses]
+        if occurrence in (u'must', u'filter'):
+            # Required clauses that match everything do nothing.
+            required = [c for c in clauses if not _is_match_all(c)]
+            removed_match_all |= len(required) != len(clauses)
+            clauses = required
+        if clauses:
+            bool_query[occurrence] = clauses
+        else:
+            del bool_query[occurrence]
+
+    if not any(occurrence in bool_query for occurrence in BOOL_OCCURRENCES):
+        return {u'match_all': {}}
+    if removed_match_all and u'should' in bool_query and not (
+            u'must' in bool_query or u'filter' in bool_query or
+            u'minimum_should_match' in bool_query):
+        # Without required clauses at least one should clause has to match,
+        # so keep a required clause to leave the should clauses optional.
+        bool_query[u'filter'] = [{u'match_all': {}}]
+    return {u'bool': bool_query}
+
+
+def _to_filter_context(query):
+    """Run a query in filter context, where it is not scored.
+
+    Args:
+        query: Elasticsearch query clause as a dictionary
+
+    Returns:
+        Query clause that matches the same events without scoring them.
+    """
+    if u'match_all' in query or u'constant_score' in query:
+        return query
+    if u'bool' not in query:
+        return {u'constant_score': {u'filter': query}}
+
+    bool_query = dict(query[u'bool'])
+    must = bool_query.pop(u'must', [])
+    if must:
+        bool_query[u'filter'] = must + bool_query.get(u'filter', [])
+    return {u'bool': bool_query}
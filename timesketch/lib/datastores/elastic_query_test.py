@@ -0,0 +1,273 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the Elasticsearch query optimizer."""
+
+import copy
+
+from timesketch.lib.datastores.elastic_query import optimize_query
+from timesketch.lib.testlib import BaseTest
+
+KEYWORD_FIELDS = frozenset([u'data_type', u'tag'])
+
+SORT = [{u'datetime': u'asc'}, {u'_uid': u'asc'}]
+
+TIME_RANGE = {
+    u'range': {
+        u'datetime': {u'gte': u'2017-01-01', u'lte': u'2017-01-02'}
+    }
+}
+
+EXCLUDE = {
+    u'bool': {
+        u'must_not': [{u'terms': {u'data_type': [u'fs:stat']}}]
+    }
+}
+
+# Test corpus of (description, query, optimized query).
+QUERY_CORPUS = [
+    (
+        u'Query string is not scored',
+        {
+            u'query': {u'bool': {u'must': [
+                {u'query_string': {u'query': u'foo bar'}}]}},
+            u'sort': SORT
+        },
+        {
+            u'query': {u'bool': {u'filter': [
+                {u'query_string': {u'query': u'foo bar'}}]}},
+            u'sort': SORT
+        }
+    ),
+    (
+        u'Required clauses are moved in front of existing filters',
+        {
+            u'query': {u'bool': {
+                u'must': [{u'query_string': {u'query': u'foo'}}],
+                u'filter': [TIME_RANGE]
+            }},
+            u'sort': SORT
+        },
+        {
+            u'query': {u'bool': {u'filter': [
+                {u'query_string': {u'query': u'foo'}}, TIME_RANGE]}},
+            u'sort': SORT
+        }
+    ),
+    (
+        u'Match all query string is dropped',
+        {
+            u'query': {u'bool': {
+                u'must': [{u'query_string': {u'query': u' * '}}],
+                u'filter': [TIME_RANGE]
+            }},
+            u'sort': SORT
+        },
+        {
+            u'query': {u'bool': {u'filter': [TIME_RANGE]}},
+            u'sort': SORT
+        }
+    ),
+    (
+        u'Query that matches everything is removed',
+        {
+            u'query': {u'bool': {u'must': [{u'match_all': {}}]}},
+            u'sort': SORT
+        },
+        {
+            u'sort': SORT
+        }
+    ),
+    (
+        u'Post filter without aggregations becomes a filter',
+        {
+            u'query': {u'bool': {u'must': [
+                {u'query_string': {u'query': u'foo'}}]}},
+            u'post_filter': EXCLUDE,
+            u'sort': SORT
+        },
+        {
+            u'query': {u'bool': {u'filter': [
+                {u'query_string': {u'query': u'foo'}}, EXCLUDE]}},
+            u'sort': SORT
+        }
+    ),
+    (
+        u'Post filter is kept for aggregations',
+        {
+            u'query': {u'match_all': {}},
+            u'post_filter': EXCLUDE,
+            u'aggregations': {u'count': {u'value_count': {u'field': u'_uid'}}},
+            u'sort': SORT
+        },
+        {
+            u'post_filter': EXCLUDE,
+            u'aggregations': {u'count': {u'value_count': {u'field': u'_uid'}}},
+            u'sort': SORT
+        }
+    ),
+    (
+        u'Keyword field query string becomes a term filter',
+        {
+            u'query': {u'bool': {u'must': [
+                {u'query_string': {u'query': u'data_type:"fs:stat"'}}]}},
+            u'sort': SORT
+        },
+        {
+            u'query': {u'bool': {u'filter': [
+                {u'term': {u'data_type': u'fs:stat'}}]}},
+            u'sort': SORT
+        }
+    ),
+    (
+        u'Unquoted keyword value becomes a term filter',
+        {
+            u'query': {u'bool': {u'must': [
+                {u'query_string': {u'query': u'tag:malware'}}]}},
+            u'sort': SORT
+        },
+        {
+            u'query': {u'bool': {u'filter': [
+                {u'term': {u'tag': u'malware'}}]}},
+            u'sort': SORT
+        }
+    ),
+    (
+        u'Analyzed field query string is kept',
+        {
+            u'query': {u'bool': {u'must': [
+                {u'query_string': {u'query': u'message:foo'}}]}},
+            u'sort': SORT
+        },
+        {
+            u'query': {u'bool': {u'filter': [
+                {u'query_string': {u'query': u'message:foo'}}]}},
+            u'sort': SORT
+        }
+    ),
+    (
+        u'Keyword query string with wildcards is kept',
+        {
+            u'query': {u'bool': {u'must': [
+                {u'query_string': {u'query': u'tag:mal*'}}]}},
+            u'sort': SORT
+        },
+        {
+            u'query': {u'bool': {u'filter': [
+                {u'query_string': {u'query': u'tag:mal*'}}]}},
+            u'sort': SORT
+        }
+    ),
+    (
+        u'Query string with options is kept',
+        {
+            u'query': {u'bool': {u'must': [{u'query_string': {
+                u'query': u'tag:malware', u'analyze_wildcard': True}}]}},
+            u'sort': SORT
+        },
+        {
+            u'query': {u'bool': {u'filter': [{u'query_string': {
+                u'query': u'tag:malware', u'analyze_wildcard': True}}]}},
+            u'sort': SORT
+        }
+    ),
+    (
+        u'Query that is not a bool query gets a constant score',
+        {
+            u'query': {u'ids': {u'values': [u'a', u'b']}},
+            u'sort': SORT
+        },
+        {
+            u'query': {u'constant_score': {
+                u'filter': {u'ids': {u'values': [u'a', u'b']}}}},
+            u'sort': SORT
+        }
+    ),
+    (
+        u'Should clauses stay optional when match all is dropped',
+        {
+            u'query': {u'bool': {
+                u'must': [{u'match_all': {}}],
+                u'should': [{u'term': {u'tag': u'malware'}}]
+            }},
+            u'sort': SORT
+        },
+        {
+            u'query': {u'bool': {
+                u'filter': [{u'match_all': {}}],
+                u'should': [{u'term': {u'tag': u'malware'}}]
+            }},
+            u'sort': SORT
+        }
+    ),
+    (
+        u'Nested bool queries are optimized',
+        {
+            u'query': {u'bool': {u'must': [{u'bool': {
+                u'must': [{u'query_string': {u'query': u'*'}}],
+                u'must_not': [{u'query_string': {u'query': u'tag:test'}}]
+            }}]}},
+            u'sort': SORT
+        },
+        {
+            u'query': {u'bool': {u'filter': [{u'bool': {
+                u'must_not': [{u'term': {u'tag': u'test'}}]
+            }}]}},
+            u'sort': SORT
+        }
+    ),
+    (
+        u'Scored query is not moved to filter context',
+        {
+            u'query': {u'bool': {u'must': [
+                {u'query_string': {u'query': u'tag:malware'}}]}},
+            u'sort': [u'_score']
+        },
+        {
+            u'query': {u'bool': {u'must': [
+                {u'term': {u'tag': u'malware'}}]}},
+            u'sort': [u'_score']
+        }
+    ),
+    (
+        u'Query without sort is sorted on score',
+        {
+            u'query': {u'bool': {u'must': [
+                {u'query_string': {u'query': u'foo'}}]}}
+        },
+        {
+            u'query': {u'bool': {u'must': [
+                {u'query_string': {u'query': u'foo'}}]}}
+        }
+    )
+]
+
+
+class ElasticsearchQueryOptimizerTest(BaseTest):
+    """Test the Elasticsearch query optimizer."""
+
+    def test_query_corpus(self):
+        """Test the rewrites of all queries in the corpus."""
+        for description, query_dsl, expected in QUERY_CORPUS:
+            optimized = optimize_query(
+                copy.deepcopy(query_dsl), KEYWORD_FIELDS)
+            self.assertEqual(optimized, expected, description)
+
+    def test_idempotent(self):
+        """Test that optimizing an optimized query does not change it."""
+        for description, query_dsl, _ in QUERY_CORPUS:
+            optimized = optimize_query(
+                copy.deepcopy(query_dsl), KEYWORD_FIELDS)
+            self.assertEqual(
+                optimize_query(copy.deepcopy(optimized), KEYWORD_FIELDS),
+                optimized, description)
@@ -0,0 +1,491 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the Elasticsearch datastore."""
+
+import datetime
+
+import mock
+
+from timesketch.lib.datastores import elastic
+from timesketch.lib.datastores.elastic import ElasticsearchDataStore
+from timesketch.lib.testlib import BaseTest
+
+
+class MockIndicesClient(object):
+    """A mock implementation of the Elasticsearch indices client."""
+    def __init__(self):
+        self.created = {}
+        self.settings = {}
+        self.merged = []
+
+    def exists(self, index):
+        """Mock checking if an index exists."""
+        return index in self.created
+
+    def create(self, index, body):
+        """Mock creating an index."""
+        self.created[index] = body
+        self.settings[index] = dict(body[u'settings'][u'index'])
+
+    def put_settings(self, index, body):
+        """Mock updating index settings."""
+        self.settings[index].update(body[u'index'])
+
+    def refresh(self, index):
+        """Mock refreshing an index."""
+        pass
+
+    # pylint: disable=unused-argument
+    def forcemerge(self, index, max_num_segments, request_timeout=None):
+        """Mock force merging an index."""
+        self.merged.append(index)
+
+    def put_mapping(self, index, doc_type, body):
+        """Mock updating the mapping of a document type."""
+        mapping = self.created[index][u'mappings'].setdefault(doc_type, {})
+        mapping.setdefault(u'properties', {}).update(body[u'properties'])
+        if u'_meta' in body:
+            mapping[u'_meta'] = body[u'_meta']
+
+    def get_mapping(self, index):
+        """Mock getting the mappings of indices."""
+        return {
+            name: {u'mappings': self.created[name][u'mappings']}
+            for name in index if name in self.created
+        }
+
+    # pylint: disable=unused-argument
+    def stats(self, index, metric):
+        """Mock getting index stats."""
+        return {u'_all': {u'primaries': {u'store': {u'size_in_bytes': 2048}}}}
+
+
+class MockElasticsearch(object):
+    """A mock implementation of the Elasticsearch client."""
+    def __init__(self, hosts, **kwargs):
+        self.hosts = hosts
+        self.kwargs = kwargs
+        self.indices = MockIndicesClient()
+        self.last_search = None
+
+    # pylint: disable=unused-argument
+    def search(self, index, body, request_timeout=None, **kwargs):
+        """Mock a search with min and max aggregations on datetime."""
+        self.last_search = dict(kwargs, body=body)
+        if kwargs.get(u'size'):
+            return {
+                u'hits': {u'total': 1, u'hits': [{
+                    u'_source': {u'message': u'test'},
+                    u'fields': {
+                        u'timestamp_desc': [u'Last Written'],
+                        u'tag': [u'test']
+                    }
+                }]}
+            }
+        return {
+            u'hits': {u'total': 2, u'hits': []},
+            u'aggregations': {
+                u'min_datetime': {u'value': 1483228800000.0},
+                u'max_datetime': {u'value': 1483315200000.0}
+            }
+        }
+
+    # pylint: disable=unused-argument
+    def bulk(self, body, request_timeout=None, **kwargs):
+        """Mock a bulk request where all actions succeed."""
+        return {u'errors': False, u'items': []}
+
+    # pylint: disable=unused-argument
+    def update_by_query(self, index, body, request_timeout=None, **kwargs):
+        """Mock updating documents matching a query."""
+        return {u'updated': 1, u'failures': []}
+
+    # pylint: disable=unused-argument
+    def mget(self, body, request_timeout=None, **kwargs):
+        """Mock getting documents, the one with id missing is not found."""
+        return {u'docs': [
+            dict(doc, found=doc[u'_id'] != u'missing', _source={})
+            for doc in body[u'docs']
+        ]}
+
+
+@mock.patch(u'timesketch.lib.datastores.elastic.Elasticsearch',
+            MockElasticsearch)
+class ElasticsearchClientTest(BaseTest):
+    """Test the shared Elasticsearch client."""
+    def setUp(self):
+        super(ElasticsearchClientTest, self).setUp()
+        elastic._CLIENT_REGISTRY.clear()  # pylint: disable=protected-access
+
+    def test_client_is_shared(self):
+        """Test that datastore objects share one client per process."""
+        first = ElasticsearchDataStore(host=u'127.0.0.1', port=9200)
+        second = ElasticsearchDataStore(host=u'127.0.0.1', port=9200)
+        other = ElasticsearchDataStore(host=u'127.0.0.2', port=9200)
+        self.assertIs(first.client, second.client)
+        self.assertIsNot(first.client, other.client)
+
+    def test_client_settings(self):
+        """Test that pool settings from the config are used."""
+        self.app.config[u'ELASTIC_HOSTS'] = [u'127.0.0.2', u'127.0.0.3:9300']
+        self.app.config[u'ELASTIC_POOL_SIZE'] = 25
+        self.app.config[u'ELASTIC_HTTP_COMPRESS'] = True
+        self.app.config[u'ELASTIC_REQUEST_TIMEOUTS'] = {u'search': 5}
+        datastore = ElasticsearchDataStore(host=u'127.0.0.1', port=9200)
+        self.assertEqual(len(datastore.client.hosts), 3)
+        self.assertEqual(datastore.client.hosts[2][u'port'], 9300)
+        self.assertEqual(datastore.client.kwargs[u'maxsize'], 25)
+        self.assertEqual(
+            datastore.client.kwargs[u'headers'][u'accept-encoding'],
+            u'gzip,deflate')
+        self.assertIs(
+            datastore.client.kwargs[u'connection_class'],
+            elastic.OpaqueIdHttpConnection)
+        # pylint: disable=protected-access
+        self.assertEqual(datastore._request_timeout(u'search'), 5)
+        self.assertIsNone(datastore._request_timeout(u'count'))
+
+    def test_opaque_id_header(self):
+        """Test that requests carry the ID of the web request."""
+        connection = elastic.OpaqueIdHttpConnection(
+            headers={u'accept-encoding': u'gzip,deflate'})
+        headers = connection.headers
+        self.assertEqual(
+            headers[elastic.OPAQUE_ID_HEADER], elastic.get_opaque_id())
+        self.assertEqual(headers[u'accept-encoding'], u'gzip,deflate')
+        # The ID is not stored on the shared connection.
+        # pylint: disable=protected-access
+        self.assertNotIn(
+            elastic.OPAQUE_ID_HEADER, connection._base_headers)
+
+
+class ElasticsearchQueryTest(BaseTest):
+    """Test building Elasticsearch queries and indices."""
+    def setUp(self):
+        super(ElasticsearchQueryTest, self).setUp()
+        # The datastore is created here, so the client has to be patched for
+        # setUp too and not only for the test methods.
+        patcher = mock.patch(
+            u'timesketch.lib.datastores.elastic.Elasticsearch',
+            MockElasticsearch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # pylint: disable=protected-access
+        elastic._CLIENT_REGISTRY.clear()
+        elastic._FIELD_MAPPINGS_CACHE.clear()
+        elastic._LABEL_KEYS_MAPPED.clear()
+        self.datastore = ElasticsearchDataStore(host=u'127.0.0.1', port=9200)
+
+    def _create_legacy_index(self, index_name):
+        """Create an index like one from before the Timesketch mapping.
+
+        Args:
+            index_name: Name of the index
+        """
+        self.datastore.client.indices.created[index_name] = {
+            u'mappings': {u'plaso_event': {u'properties': {
+                u'data_type': {
+                    u'type': u'text',
+                    u'fields': {u'keyword': {u'type': u'keyword'}}
+                },
+                u'timesketch_label': {u'type': u'nested'}
+            }}}
+        }
+
+    def test_star_filter(self):
+        """Test that starred events are matched on the label key field."""
+        star_filter = {u'term': {elastic.LABEL_KEYS_FIELD: u'1:__ts_star'}}
+        self.datastore.create_index(index_name=u'test', doc_type=u'test_event')
+        query_dsl = self.datastore.build_query(
+            1, u'', {u'star': True, u'time_start': u'2017-01-01',
+                     u'time_end': u'2017-01-02'}, None, indices=[u'test'])
+        filters = query_dsl[u'query'][u'bool'][u'filter']
+        self.assertIn(star_filter, filters)
+        self.assertEqual(len(filters), 2)
+
+        # Labels in indices that are not migrated are also matched with the
+        # nested query.
+        self._create_legacy_index(u'legacy')
+        query_dsl = self.datastore.build_query(
+            1, u'', {u'star': True}, None, indices=[u'test', u'legacy'])
+        label_filter = query_dsl[u'query'][u'bool'][u'filter'][0]
+        should = label_filter[u'bool'][u'should']
+        self.assertEqual(should[0], star_filter)
+        self.assertEqual(should[1][u'nested'][u'path'], u'timesketch_label')
+
+        self.datastore.backfill_label_keys(u'legacy')
+        query_dsl = self.datastore.build_query(
+            1, u'', {u'star': True}, None, indices=[u'test', u'legacy'])
+        self.assertEqual(
+            query_dsl[u'query'][u'bool'][u'filter'], [star_filter])
+
+    def test_label_keys_mapping(self):
+        """Test that the label field is mapped before the first label."""
+        self._create_legacy_index(u'legacy')
+        indices = self.datastore.client.indices
+        with mock.patch.object(
+                indices, u'put_mapping', wraps=indices.put_mapping) as put:
+            self.datastore.set_labels([
+                {u'_index': u'legacy', u'_type': u'plaso_event', u'_id': u'1'},
+                {u'_index': u'legacy', u'_type': u'plaso_event', u'_id': u'2'}
+            ], 1, 1, u'__ts_star', toggle=True)
+            self.datastore.set_labels([
+                {u'_index': u'legacy', u'_type': u'plaso_event', u'_id': u'3'}
+            ], 1, 1, u'__ts_star', toggle=True)
+        self.assertEqual(put.call_count, 1)
+        properties = indices.created[u'legacy'][u'mappings'][
+            u'plaso_event'][u'properties']
+        self.assertEqual(
+            properties[elastic.LABEL_KEYS_FIELD], {u'type': u'keyword'})
+
+    def test_multiple_time_ranges(self):
+        """Test that events in any of the time ranges are matched."""
+        query_dsl = self.datastore.build_query(
+            1, u'*', {u'time_start': u'2017-01-01', u'time_end': u'2017-01-02',
+                      u'time_ranges': [
+                          {u'start': u'2017-02-01', u'end': u'2017-02-02'}]},
+            None)
+        self.assertEqual(query_dsl[u'query'][u'bool'][u'filter'], [{
+            u'bool': {u'should': [
+                {u'range': {u'datetime': {
+                    u'gte': u'2017-01-01', u'lte': u'2017-01-02'}}},
+                {u'range': {u'datetime': {
+                    u'gte': u'2017-02-01', u'lte': u'2017-02-02'}}}
+            ]}
+        }])
+
+    def test_zoom_filter(self):
+        """Test that the zoom window of a histogram filters the query."""
+        query_dsl = self.datastore.build_query(
+            1, u'test', {u'zoom': {u'start': 0, u'end': 3600000}}, None)
+        self.assertIn({u'range': {u'datetime': {
+            u'gte': 0, u'lte': 3600000, u'format': u'epoch_millis'}}},
+                      query_dsl[u'query'][u'bool'][u'filter'])
+
+    def test_sample(self):
+        """Test that a sampled query keeps events with a random score."""
+        query_dsl = self.datastore.build_query(
+            1, u'test', {u'sample': 0.25}, None)
+        function_score = query_dsl[u'query'][u'function_score']
+        self.assertEqual(function_score[u'random_score'], {u'seed': 1})
+        # The sampled query itself is still not scored.
+        self.assertIn(u'filter', function_score[u'query'][u'bool'])
+        self.assertEqual(query_dsl[u'min_score'], 0.75)
+
+    def test_exclude_with_aggregations(self):
+        """Test that the exclude filter is kept next to other filters."""
+        query_dsl = self.datastore.build_query(
+            1, u'*', {u'exclude': [u'test'], u'time_start': u'2017-01-01',
+                      u'time_end': u'2017-01-02'}, None,
+            aggregations={u'test': {}})
+        self.assertNotIn(u'post_filter', query_dsl)
+        self.assertEqual(
+            len(query_dsl[u'query'][u'bool'][u'filter']), 2)
+
+    def test_keyword_term_filter(self):
+        """Test that only keyword mapped fields get a term filter."""
+        self.datastore.create_index(index_name=u'test', doc_type=u'test_event')
+        query_dsl = self.datastore.build_query(
+            1, u'data_type:"fs:stat"', {}, None, indices=[u'test'])
+        self.assertEqual(query_dsl[u'query'], {u'bool': {u'filter': [
+            {u'term': {u'data_type': u'fs:stat'}}]}})
+
+        # Indices created before the Timesketch mapping have analyzed text
+        # fields, where the term would not match.
+        self._create_legacy_index(u'legacy')
+        for indices in ([u'legacy'], [u'test', u'legacy']):
+            query_dsl = self.datastore.build_query(
+                1, u'data_type:"fs:stat"', {}, None, indices=indices)
+            self.assertEqual(query_dsl[u'query'], {u'bool': {u'filter': [
+                {u'query_string': {u'query': u'data_type:"fs:stat"'}}]}})
+
+    def test_create_index(self):
+        """Test that new indices get the Timesketch mapping and settings."""
+        self.app.config[u'ELASTIC_INDEX_SHARD_SIZE'] = 100
+        self.app.config[u'ELASTIC_INDEX_MAX_SHARDS'] = 3
+        self.app.config[u'ELASTIC_INDEX_CODEC'] = u'best_compression'
+        self.datastore.create_index(
+            index_name=u'test', doc_type=u'test_event', source_size=250)
+        body = self.datastore.client.indices.created[u'test']
+        settings = body[u'settings'][u'index']
+        self.assertEqual(settings[u'number_of_shards'], 3)
+        self.assertEqual(settings[u'codec'], u'best_compression')
+        properties = body[u'mappings'][u'test_event'][u'properties']
+        self.assertEqual(properties[u'datetime'][u'type'], u'date')
+        self.assertEqual(properties[u'timestamp'][u'type'], u'long')
+        self.assertEqual(properties[u'message'][u'type'], u'text')
+        # Field stats aggregate on the keyword subfield.
+        self.assertEqual(
+            elastic.get_aggregation_field(u'message'), u'message.keyword')
+        self.assertEqual(
+            properties[u'message'][u'fields'][u'keyword'][u'type'],
+            u'keyword')
+        self.assertEqual(properties[u'data_type'], {u'type': u'keyword'})
+
+    def test_shards_by_size(self):
+        """Test that the number of shards follows the file size."""
+        self.app.config[u'ELASTIC_INDEX_SHARD_SIZE'] = 100
+        # pylint: disable=protected-access
+        settings = self.datastore._build_index_settings(None)
+        self.assertEqual(settings[u'index'][u'number_of_shards'], 1)
+        settings = self.datastore._build_index_settings(150)
+        self.assertEqual(settings[u'index'][u'number_of_shards'], 2)
+
+    def test_ingest_mode(self):
+        """Test that ingest mode settings are restored after the import."""
+        self.app.config[u'ELASTIC_INDEX_REPLICAS'] = 2
+        indices = self.datastore.client.indices
+        self.datastore.create_index(
+            index_name=u'test', doc_type=u'test_event', ingest_mode=True)
+        self.assertEqual(indices.settings[u'test'][u'refresh_interval'], u'-1')
+        self.assertEqual(indices.settings[u'test'][u'number_of_replicas'], 0)
+
+        self.assertTrue(self.datastore.finalize_index(u'test'))
+        self.assertIsNone(indices.settings[u'test'][u'refresh_interval'])
+        self.assertEqual(indices.settings[u'test'][u'number_of_replicas'], 2)
+        # The merge is not retried when it times out.
+        # pylint: disable=protected-access
+        merge_client = self.datastore._get_merge_client()
+        self.assertEqual(merge_client.kwargs[u'max_retries'], 0)
+        self.assertEqual(merge_client.indices.merged, [u'test'])
+
+        # Existing indices are not touched.
+        self.datastore.create_index(
+            index_name=u'test', doc_type=u'test_event', ingest_mode=True)
+        self.assertFalse(self.datastore.finalize_index(u'test'))
+        self.assertEqual(merge_client.indices.merged, [u'test'])
+
+    def test_ingest_mode_failed_import(self):
+        """Test that settings are restored without a merge after a failure."""
+        indices = self.datastore.client.indices
+        self.datastore.create_index(
+            index_name=u'test', doc_type=u'test_event', ingest_mode=True)
+        self.assertTrue(self.datastore.finalize_index(u'test', merge=False))
+        self.assertIsNone(indices.settings[u'test'][u'refresh_interval'])
+        # pylint: disable=protected-access
+        self.assertEqual(
+            self.datastore._get_merge_client().indices.merged, [])
+
+    def test_index_stats(self):
+        """Test that index stats are parsed from the datastore."""
+        stats = self.datastore.index_stats(u'test')
+        self.assertEqual(stats[u'event_count'], 2)
+        self.assertEqual(
+            stats[u'min_datetime'], datetime.datetime(2017, 1, 1))
+        self.assertEqual(
+            stats[u'max_datetime'], datetime.datetime(2017, 1, 2))
+        self.assertEqual(stats[u'size_in_bytes'], 2048)
+
+    def test_slow_query_log(self):
+        """Test that searches over the threshold are reported."""
+        self.datastore.slow_query_callback = mock.Mock()
+        self.datastore.search(1, u'test', {}, None, [u'test'])
+        self.assertFalse(self.datastore.slow_query_callback.called)
+
+        self.datastore.slow_query_threshold = 0
+        self.datastore.search(1, u'test', {}, None, [u'test'])
+        entry = self.datastore.slow_query_callback.call_args[1]
+        self.assertEqual(entry[u'operation'], u'search')
+        self.assertEqual(entry[u'sketch_id'], 1)
+        self.assertEqual(entry[u'index_count'], 1)
+        self.assertIn(u'test', entry[u'query_dsl'])
+        self.assertEqual(entry[u'opaque_id'], elastic.get_opaque_id())
+
+    def test_get_events(self):
+        """Test that many events are fetched and missing ones left out."""
+        events = self.datastore.get_events([
+            {u'_index': u'test', u'_id': u'1', u'_type': u'test_event'},
+            {u'_index': u'test', u'_id': u'missing'},
+            {u'_index': u'test', u'_id': u'2'}
+        ])
+        self.assertEqual([event[u'_id'] for event in events], [u'1', u'2'])
+        self.assertEqual(self.datastore.get_events([]), [])
+
+    def test_cursor(self):
+        """Test that cursors round trip and paging has a tie breaker."""
+        self.datastore.create_index(index_name=u'test', doc_type=u'test_event')
+        query_dsl = self.datastore.build_query(
+            1, u'test', {u'order': u'desc'}, None, indices=[u'test'])
+        self.assertEqual(query_dsl[u'sort'], [{u'datetime': u'desc'}])
+        query_dsl = self.datastore.build_query(
+            1, u'test', {u'order': u'desc'}, None, indices=[u'test'],
+            tie_breaker=True)
+        self.assertEqual(query_dsl[u'sort'], [
+            {u'datetime': u'desc'}, {elastic.EVENT_ID_FIELD: u'desc'}])
+
+        # Indices without the event ID only sort on time, never on _uid.
+        self._create_legacy_index(u'legacy')
+        query_dsl = self.datastore.build_query(
+            1, u'test', {u'order': u'desc'}, None,
+            indices=[u'test', u'legacy'], tie_breaker=True)
+        self.assertEqual(query_dsl[u'sort'], [{u'datetime': u'desc'}])
+
+        self.datastore.search(
+            1, u'test', {}, None, [u'test'], paginate=True)
+        self.assertEqual(
+            self.datastore.client.last_search[u'body'][u'sort'],
+            [{u'datetime': u'asc'}, {elastic.EVENT_ID_FIELD: u'asc'}])
+
+        sort_values = [1410593223000, u'plaso_event#test']
+        cursor = elastic.encode_cursor(sort_values)
+        self.assertEqual(elastic.decode_cursor(cursor), sort_values)
+        self.assertRaises(ValueError, elastic.decode_cursor, u'invalid')
+        self.assertRaises(
+            ValueError, elastic.decode_cursor, elastic.encode_cursor({}))
+
+    def test_project_fields_missing(self):
+        """Test that events without the projected fields get a _source."""
+        self.datastore.create_index(index_name=u'test', doc_type=u'test_event')
+        query_dsl = {}
+        self.assertEqual(
+            self.datastore._project_fields(  # pylint: disable=protected-access
+                query_dsl, [u'test'], [u'data_type', u'tag']),
+            {u'_source': False})
+
+        hit = {u'_index': u'test', u'_id': u'1', u'_type': u'test_event'}
+        with mock.patch.object(
+                self.datastore.client, u'search',
+                return_value={u'hits': {u'total': 1, u'hits': [hit]}}):
+            result = self.datastore.search(
+                1, u'test', {}, None, [u'test'],
+                return_fields=[u'data_type', u'tag'])
+        self.assertEqual(result[u'hits'][u'hits'][0][u'_source'], {})
+
+    def test_import_event_id(self):
+        """Test that imported events get a unique event ID."""
+        self.datastore.bulk_indexer = mock.Mock()
+        for _ in range(2):
+            self.datastore.import_event(
+                10, u'test', u'test_event', {u'message': u'test'})
+        event_ids = {
+            call[0][0][elastic.EVENT_ID_FIELD]
+            for call in self.datastore.bulk_indexer.add.call_args_list
+        }
+        self.assertEqual(len(event_ids), 2)
+
+    def test_project_fields(self):
+        """Test that doc valued fields are not read from the _source."""
+        self.datastore.create_index(index_name=u'test', doc_type=u'test_event')
+        result = self.datastore.search(
+            1, u'test', {}, None, [u'test'],
+            return_fields=[u'message', u'timestamp_desc', u'tag'])
+        search = self.datastore.client.last_search
+        self.assertEqual(search[u'_source_include'], [u'message'])
+        self.assertEqual(
+            search[u'body'][u'docvalue_fields'], [u'tag', u'timestamp_desc'])
+        self.assertEqual(result[u'hits'][u'hits'][0][u'_source'], {
+            u'message': u'test',
+            u'timestamp_desc': u'Last Written',
+            u'tag': [u'test']
+        })
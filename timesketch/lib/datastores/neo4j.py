@@ -16,6 +16,9 @@
 from neo4jrestclient.client import GraphDatabase
 from neo4jrestclient.constants import DATA_GRAPH
 
+from timesketch.lib.metrics import PHASE_DATASTORE
+from timesketch.lib.metrics import timed_method
+
 
 class Neo4jDataStore(object):
     """Implements the Neo4j datastore.
@@ -57,6 +60,7 @@ class Neo4jDataStore(object):
             formatter = formatter_registry.get(default_output_format)
         return formatter()
 
+    @timed_method(PHASE_DATASTORE)
     def search(self, query, output_format=None, return_rows=False):
         """Search the graph.
 
@@ -0,0 +1,738 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""SQLite datastore.
+
+All events are stored in one SQLite database file, with a FTS5 full text
+index on the event values and an index on the event time. This is meant for
+small, single analyst deployments that do not want to run Elasticsearch.
+Only a subset of the query string syntax is supported (see sqlite_query),
+Elasticsearch DSL queries and aggregations are not.
+"""
+
+import calendar
+from collections import Counter
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+import time
+from uuid import uuid4
+
+from flask import abort
+
+from timesketch.lib import datastore
+from timesketch.lib.datastores.elastic import DEFAULT_RETURN_FIELDS
+from timesketch.lib.datastores.elastic import KEYWORD_FIELDS
+from timesketch.lib.datastores.elastic import decode_cursor
+from timesketch.lib.datastores.elastic import encode_cursor
+from timesketch.lib.datastores.sqlite_query import compile_query_string
+from timesketch.lib.definitions import HTTP_STATUS_CODE_NOT_FOUND
+from timesketch.lib.metrics import PHASE_DATASTORE
+from timesketch.lib.metrics import timed_method
+from timesketch.lib.utils import get_time_ranges
+from timesketch.lib.utils import parse_filter_time
+
+# Setup logging
+sqlite_logger = logging.getLogger(u'timesketch.sqlite')
+sqlite_logger.addHandler(logging.NullHandler())
+
+# Maximum number of events returned by search().
+DEFAULT_LIMIT = 500
+
+# Seconds to wait for a lock held by another connection, e.g. an import.
+DEFAULT_LOCK_TIMEOUT = 30
+
+# Labels are kept in their own table and added to the event as
+# timesketch_label, like the Elasticsearch datastore stores them.
+LABEL_FIELD = u'timesketch_label'
+
+SCHEMA = [
+    u'CREATE TABLE IF NOT EXISTS searchindex ('
+    u'    index_name TEXT PRIMARY KEY,'
+    u'    doc_type TEXT NOT NULL)',
+    u'CREATE TABLE IF NOT EXISTS event ('
+    u'    rowid INTEGER PRIMARY KEY,'
+    u'    index_name TEXT NOT NULL,'
+    u'    event_id TEXT NOT NULL,'
+    u'    doc_type TEXT NOT NULL,'
+    u'    datetime INTEGER NOT NULL,'
+    u'    source TEXT NOT NULL,'
+    u'    UNIQUE (index_name, event_id))',
+    u'CREATE INDEX IF NOT EXISTS event_datetime ON event (datetime, rowid)',
+    # Contentless, the values are already in the source of the event.
+    u'CREATE VIRTUAL TABLE IF NOT EXISTS event_fts USING fts5('
+    u'    body, content=\'\', tokenize=\'unicode61\')',
+    u'CREATE TABLE IF NOT EXISTS label ('
+    u'    event_rowid INTEGER NOT NULL REFERENCES event (rowid),'
+    u'    sketch_id INTEGER NOT NULL,'
+    u'    user_id INTEGER NOT NULL,'
+    u'    name TEXT NOT NULL,'
+    u'    UNIQUE (event_rowid, sketch_id, user_id, name))',
+    u'CREATE INDEX IF NOT EXISTS label_name ON label (sketch_id, name)'
+]
+
+
+# Open connections of each thread, by database path.
+_local = threading.local()
+
+
+def get_connection(path):
+    """Get the connection of the current thread to a database.
+
+    The connection is kept open and reused by every datastore created in the
+    thread, so a request does not have to open the database again.
+
+    Args:
+        path: Path to the SQLite database file
+
+    Returns:
+        Database connection (instance of sqlite3.Connection)
+    """
+    connections = getattr(_local, u'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    connection = connections.get(path)
+    if connection is None:
+        connection = sqlite3.connect(path, timeout=DEFAULT_LOCK_TIMEOUT)
+        connection.execute(u'PRAGMA synchronous=NORMAL')
+        connections[path] = connection
+    return connection
+
+
+def close_connection(path):
+    """Close the connection of the current thread to a database, if any.
+
+    Args:
+        path: Path to the SQLite database file
+    """
+    connection = getattr(_local, u'connections', {}).pop(path, None)
+    if connection is not None:
+        connection.close()
+
+
+def create_schema(path):
+    """Create the tables of the datastore if they don't exist.
+
+    This is done once when the app is created, not for every datastore.
+
+    Args:
+        path: Path to the SQLite database file
+    """
+    connection = get_connection(path)
+    # Readers are not blocked by an import in another process. The journal
+    # mode is stored in the database file.
+    connection.execute(u'PRAGMA journal_mode=WAL')
+    with connection:
+        for statement in SCHEMA:
+            connection.execute(statement)
+
+
+def _to_epoch_millis(value):
+    """Convert a naive datetime in UTC to epoch milliseconds."""
+    return calendar.timegm(value.utctimetuple()) * 1000 + (
+        value.microsecond // 1000)
+
+
+def _event_time(event):
+    """Get the time of an event in epoch milliseconds.
+
+    Args:
+        event: Event dictionary
+
+    Returns:
+        Epoch milliseconds, from the timestamp in microseconds or else the
+        datetime string. Events without a valid time get 0.
+    """
+    try:
+        return int(event[u'timestamp']) // 1000
+    except (KeyError, TypeError, ValueError):
+        pass
+    event_time = parse_filter_time(event.get(u'datetime'))
+    if event_time is None:
+        return 0
+    return _to_epoch_millis(event_time)
+
+
+def _event_text(event):
+    """Get the text to index for full text search.
+
+    Args:
+        event: Event dictionary
+
+    Returns:
+        All values of the event, separated by newlines.
+    """
+    values = []
+    for value in event.values():
+        if isinstance(value, (list, tuple)):
+            values.extend(value)
+        else:
+            values.append(value)
+    return u'\n'.join(
+        value if isinstance(value, unicode) else unicode(value)
+        for value in values if value is not None)
+
+
+def _decode(value):
+    """Decode byte strings from imported files to unicode."""
+    if isinstance(value, str):
+        return value.decode(u'utf-8', u'replace')
+    return value
+
+
+class SqliteDataStore(datastore.DataStore):
+    """Implements the datastore on SQLite."""
+    def __init__(self, path):
+        """Use the connection of the current thread to the database.
+
+        The tables are created by create_schema() when the app is created.
+
+        Args:
+            path: Path to the SQLite database file
+        """
+        super(SqliteDataStore, self).__init__()
+        self.path = path
+        self.connection = get_connection(path)
+        self.import_counter = Counter()
+        self.import_buffer = []
+        # Inserts can not fail half way and there is no separate ingest
+        # mode, these are here for the same interface as Elasticsearch.
+        self.dead_letter_path = None
+        self.ingest_indices = set()
+        # There is no query cache, a local search is cheap enough.
+        self.query_cache = None
+
+    def _build_where(self, sketch_id, query_string, query_filter, indices):
+        """Build the SQL conditions for a query string and filter.
+
+        Args:
+            sketch_id: Integer of sketch primary key
+            query_string: Query string
+            query_filter: Dictionary containing filters to apply
+            indices: List of indices to query
+
+        Returns:
+            Tuple of SQL expression and list of parameters.
+
+        Raises:
+            ValueError: If the query string or filter is not supported.
+        """
+        if query_filter.get(u'sample'):
+            raise ValueError(
+                u'Sampling is not supported by the SQLite datastore.')
+        indices = list(indices)
+        conditions = [u'event.index_name IN ({0:s})'.format(
+            u', '.join(u'?' for _ in indices))]
+        parameters = list(indices)
+
+        events = query_filter.get(u'events')
+        if events:
+            conditions.append(
+                u'(event.index_name, event.event_id) IN ({0:s})'.format(
+                    u', '.join(u'(?, ?)' for _ in events)))
+            for event in events:
+                parameters.extend([event[u'index'], event[u'event_id']])
+        elif query_filter.get(u'star'):
+            conditions.append(
+                u'event.rowid IN (SELECT event_rowid FROM label '
+                u'WHERE sketch_id = ? AND name = ?)')
+            parameters.extend([sketch_id, u'__ts_star'])
+        else:
+            sql, sql_parameters = compile_query_string(
+                query_string, KEYWORD_FIELDS)
+            conditions.append(sql)
+            parameters.extend(sql_parameters)
+
+        time_ranges = []
+        for time_start, time_end in get_time_ranges(query_filter):
+            bounds = []
+            time_start = parse_filter_time(time_start)
+            if time_start is not None:
+                bounds.append(u'event.datetime >= ?')
+                parameters.append(_to_epoch_millis(time_start))
+            time_end = parse_filter_time(time_end, round_up=True)
+            if time_end is not None:
+                bounds.append(u'event.datetime <= ?')
+                parameters.append(_to_epoch_millis(time_end))
+            time_ranges.append(u' AND '.join(bounds) or u'1')
+        if time_ranges:
+            conditions.append(u' OR '.join(
+                u'({0:s})'.format(time_range) for time_range in time_ranges))
+
+        exclude = query_filter.get(u'exclude')
+        if exclude:
+            conditions.append(
+                u'COALESCE(json_extract(event.source, \'$.data_type\'), \'\')'
+                u' NOT IN ({0:s})'.format(u', '.join(u'?' for _ in exclude)))
+            parameters.extend(exclude)
+
+        return u' AND '.join(
+            u'({0:s})'.format(condition) for condition in conditions
+        ), parameters
+
+    def _get_labels(self, rowids):
+        """Get the labels of events.
+
+        Args:
+            rowids: List of event row ids
+
+        Returns:
+            Dictionary with row id as key and list of labels as value.
+        """
+        labels = {}
+        if not rowids:
+            return labels
+        rows = self.connection.execute(
+            u'SELECT event_rowid, sketch_id, user_id, name FROM label '
+            u'WHERE event_rowid IN ({0:s})'.format(
+                u', '.join(u'?' for _ in rowids)), rowids)
+        for rowid, sketch_id, user_id, name in rows:
+            labels.setdefault(rowid, []).append({
+                u'name': name,
+                u'user_id': user_id,
+                u'sketch_id': sketch_id
+            })
+        return labels
+
+    def _to_hits(self, rows, return_fields):
+        """Convert event rows to Elasticsearch style search hits.
+
+        Args:
+            rows: List of (rowid, index_name, event_id, doc_type, datetime,
+                source) tuples
+            return_fields: List of fields to return, or None for all fields
+
+        Returns:
+            List of hits with _index, _id, _type, sort and _source.
+        """
+        labels = {}
+        if return_fields is None or LABEL_FIELD in return_fields:
+            labels = self._get_labels([row[0] for row in rows])
+        hits = []
+        for rowid, index_name, event_id, doc_type, event_time, source in rows:
+            source = json.loads(source)
+            source[LABEL_FIELD] = labels.get(rowid, [])
+            if return_fields is not None:
+                source = {
+                    field: source[field] for field in return_fields
+                    if field in source
+                }
+            hits.append({
+                u'_index': index_name,
+                u'_id': event_id,
+                u'_type': doc_type,
+                u'_score': None,
+                u'sort': [event_time, rowid],
+                u'_source': source
+            })
+        return hits
+
+    @timed_method(PHASE_DATASTORE)
+    def search(
+            self, sketch_id, query_string, query_filter, query_dsl, indices,
+            aggregations=None, return_results=True, return_fields=None,
+            enable_scroll=False, cursor=None, paginate=False):
+        """Search the events.
+
+        The result has the same structure as an Elasticsearch search result,
+        without aggregations.
+
+        Args:
+            sketch_id: Integer of sketch primary key
+            query_string: Query string
+            query_filter: Dictionary containing filters to apply
+            query_dsl: Elasticsearch DSL query, not supported
+            indices: List of indices to query
+            aggregations: Elasticsearch aggregations, not supported and
+                ignored
+            return_results: Boolean indicating if results should be returned
+            return_fields: List of fields to return
+            enable_scroll: Ignored, use search_stream() to get all events
+            cursor: Optional cursor from the next_cursor of the previous page
+            paginate: Boolean indicating if a next_cursor should be returned
+                for a full page. Implied by a cursor.
+
+        Returns:
+            Set of event documents in JSON format
+
+        Raises:
+            ValueError: If the query or the cursor is not supported.
+        """
+        start_time = time.time()
+        if query_dsl:
+            raise ValueError(
+                u'Elasticsearch DSL is not supported by the SQLite datastore.')
+        if aggregations:
+            sqlite_logger.debug(
+                u'Aggregations are not supported, ignoring: %s',
+                u', '.join(aggregations))
+
+        limit = query_filter.get(u'limit', DEFAULT_LIMIT)
+        if not return_results:
+            limit = 0
+        if not return_fields:
+            return_fields = DEFAULT_RETURN_FIELDS
+        if not indices:
+            return {u'hits': {u'hits': [], u'total': 0}, u'took': 0}
+
+        where, parameters = self._build_where(
+            sketch_id, query_string, query_filter, indices)
+        total = self.connection.execute(
+            u'SELECT COUNT(*) FROM event WHERE {0:s}'.format(where),
+            parameters).fetchone()[0]
+
+        hits = []
+        if limit:
+            hits = self._search_page(
+                where, parameters, query_filter.get(u'order', u'asc'),
+                limit, return_fields, cursor)
+
+        result = {
+            u'hits': {u'hits': hits, u'total': total},
+            u'took': int((time.time() - start_time) * 1000)
+        }
+        if (paginate or cursor) and limit and len(hits) == limit:
+            result[u'next_cursor'] = encode_cursor(hits[-1][u'sort'])
+        return result
+
+    def _search_page(
+            self, where, parameters, order, limit, return_fields,
+            cursor=None):
+        """Get a page of events sorted on time.
+
+        Args:
+            where: SQL conditions from _build_where()
+            parameters: List of parameters for the conditions
+            order: Sort order, asc or desc
+            limit: Maximum number of events to get
+            return_fields: List of fields to return
+            cursor: Optional cursor to get the events after
+
+        Returns:
+            List of hits.
+
+        Raises:
+            ValueError: If the cursor is not valid.
+        """
+        if order not in (u'asc', u'desc'):
+            raise ValueError(u'Invalid sort order: {0!r}'.format(order))
+        parameters = list(parameters)
+        if cursor:
+            sort_values = decode_cursor(cursor)
+            if len(sort_values) != 2:
+                raise ValueError(u'Invalid cursor')
+            where = (
+                u'{0:s} AND (event.datetime, event.rowid) {1:s} (?, ?)'.format(
+                    where, u'>' if order == u'asc' else u'<'))
+            parameters.extend(sort_values)
+        rows = self.connection.execute(
+            u'SELECT rowid, index_name, event_id, doc_type, datetime, source '
+            u'FROM event WHERE {0:s} '
+            u'ORDER BY datetime {1:s}, rowid {1:s} LIMIT ?'.format(
+                where, order.upper()),
+            parameters + [limit]).fetchall()
+        return self._to_hits(rows, return_fields)
+
+    def search_stream(
+            self, sketch_id, query_string, query_filter, query_dsl, indices,
+            return_fields=None, page_size=1000, scroll_timeout=None):
+        """Search the events and yield every matching event.
+
+        Args:
+            sketch_id: Integer of sketch primary key
+            query_string: Query string
+            query_filter: Dictionary containing filters to apply
+            query_dsl: Elasticsearch DSL query, not supported
+            indices: List of indices to query
+            return_fields: List of fields to return
+            page_size: Number of events to fetch per query
+            scroll_timeout: Ignored
+
+        Yields:
+            Event documents in JSON format
+        """
+        if query_dsl:
+            raise ValueError(
+                u'Elasticsearch DSL is not supported by the SQLite datastore.')
+        if not indices:
+            return
+        where, parameters = self._build_where(
+            sketch_id, query_string, query_filter, indices)
+        order = query_filter.get(u'order', u'asc')
+        cursor = None
+        while True:
+            hits = self._search_page(
+                where, parameters, order, page_size, return_fields, cursor)
+            for hit in hits:
+                yield hit
+            if len(hits) < page_size:
+                return
+            cursor = encode_cursor(hits[-1][u'sort'])
+
+    def _get_rows(self, event_keys):
+        """Get events by index name and event id.
+
+        Args:
+            event_keys: List of (index name, event id) tuples
+
+        Returns:
+            Dictionary with (index name, event id) as key and the event row
+            as value.
+        """
+        if not event_keys:
+            return {}
+        parameters = [value for event_key in event_keys for value in event_key]
+        rows = self.connection.execute(
+            u'SELECT rowid, index_name, event_id, doc_type, datetime, source '
+            u'FROM event WHERE (index_name, event_id) IN ({0:s})'.format(
+                u', '.join(u'(?, ?)' for _ in event_keys)), parameters)
+        return {(row[1], row[2]): row for row in rows}
+
+    @timed_method(PHASE_DATASTORE)
+    def get_event(self, searchindex_id, event_id):
+        """Get one event from the datastore.
+
+        Args:
+            searchindex_id: String of index name
+            event_id: String of event id
+
+        Returns:
+            Event document in JSON format
+        """
+        row = self._get_rows([(searchindex_id, event_id)]).get(
+            (searchindex_id, event_id))
+        if not row:
+            abort(HTTP_STATUS_CODE_NOT_FOUND)
+        event = self._to_hits([row], return_fields=None)[0]
+        del event[u'_source'][LABEL_FIELD]
+        return event
+
+    @timed_method(PHASE_DATASTORE)
+    def get_events(self, events):
+        """Get many events from the datastore with one query.
+
+        Args:
+            events: List of dictionaries with _index and _id keys
+
+        Returns:
+            List of event documents in JSON format, in the same order.
+            Events that do not exist are left out.
+        """
+        event_keys = [(event[u'_index'], event[u'_id']) for event in events]
+        rows = self._get_rows(event_keys)
+        found = [rows[event_key] for event_key in event_keys
+                 if event_key in rows]
+        hits = self._to_hits(found, return_fields=None)
+        for hit in hits:
+            del hit[u'_source'][LABEL_FIELD]
+        return hits
+
+    @timed_method(PHASE_DATASTORE)
+    def count(self, indices):
+        """Count number of events.
+
+        Args:
+            indices: List of indices.
+
+        Returns:
+            Number of events.
+        """
+        indices = list(indices)
+        if not indices:
+            return 0
+        return self.connection.execute(
+            u'SELECT COUNT(*) FROM event WHERE index_name IN ({0:s})'.format(
+                u', '.join(u'?' for _ in indices)), indices).fetchone()[0]
+
+    @timed_method(PHASE_DATASTORE)
+    def set_label(
+            self, searchindex_id, event_id, event_type, sketch_id, user_id,
+            label, toggle=False):
+        """Set label on event in the datastore.
+
+        Args:
+            searchindex_id: String of index name
+            event_id: String of event id
+            event_type: Ignored, events are found by index and id
+            sketch_id: Integer of sketch primary key
+            user_id: Integer of user primary key
+            label: String with the name of the label
+            toggle: Optional boolean value if the label should be toggled
+            (add/remove). The default is False.
+        """
+        self.set_labels(
+            [{u'_index': searchindex_id, u'_id': event_id}], sketch_id,
+            user_id, label, toggle=toggle)
+
+    @timed_method(PHASE_DATASTORE)
+    def set_labels(self, events, sketch_id, user_id, label, toggle=False):
+        """Set label on many events in one transaction.
+
+        Args:
+            events: List of dictionaries with _index and _id for the events
+                to label
+            sketch_id: Integer of sketch primary key
+            user_id: Integer of user primary key
+            label: String with the name of the label
+            toggle: Optional boolean value if the label should be toggled
+            (add/remove). The default is False.
+
+        Returns:
+            Number of events that could not be labeled.
+        """
+        event_keys = [(event[u'_index'], event[u'_id']) for event in events]
+        rows = self._get_rows(event_keys)
+        label = unicode(label)
+        with self.connection:
+            for event_key in set(event_keys):
+                if event_key not in rows:
+                    continue
+                label_row = (rows[event_key][0], sketch_id, user_id, label)
+                if toggle:
+                    deleted = self.connection.execute(
+                        u'DELETE FROM label WHERE event_rowid = ? AND '
+                        u'sketch_id = ? AND user_id = ? AND name = ?',
+                        label_row).rowcount
+                    if deleted:
+                        continue
+                self.connection.execute(
+                    u'INSERT OR IGNORE INTO label '
+                    u'(event_rowid, sketch_id, user_id, name) '
+                    u'VALUES (?, ?, ?, ?)', label_row)
+        failed = len(set(event_keys) - set(rows))
+        if failed:
+            sqlite_logger.error(
+                u'Unable to set label on %d events that do not exist', failed)
+        return failed
+
+    def create_index(
+            self, index_name=None, doc_type=u'generic_event',
+            source_size=None, ingest_mode=False):
+        """Register an index for events.
+
+        Args:
+            index_name: Name of the index. Default is a generated UUID.
+            doc_type: Name of the document type. Default id generic_event.
+            source_size: Ignored
+            ingest_mode: Ignored, events are always bulk loaded
+
+        Returns:
+            Index name in string format.
+            Document type in string format.
+        """
+        index_name = _decode(index_name or uuid4().hex)
+        doc_type = _decode(doc_type)
+        with self.connection:
+            self.connection.execute(
+                u'INSERT OR IGNORE INTO searchindex (index_name, doc_type) '
+                u'VALUES (?, ?)', (index_name, doc_type))
+        return index_name, doc_type
+
+    def finalize_index(self, index_name, merge=True):
+        """Merge the full text index after an import.
+
+        Args:
+            index_name: Name of the index
+            merge: Optional boolean indicating if the full text index should
+                be merged. The default is True.
+
+        Returns:
+            Boolean indicating if the index was finalized.
+        """
+        if not merge:
+            return True
+        with self.connection:
+            self.connection.execute(
+                u'INSERT INTO event_fts (event_fts) VALUES (\'optimize\')')
+        return True
+
+    def index_stats(self, index_name):
+        """Get the number of events, time span and size of an index.
+
+        Args:
+            index_name: Name of the index
+
+        Returns:
+            Dictionary with event_count, min_datetime and max_datetime (as
+            datetime.datetime in UTC or None for an empty index) and
+            size_in_bytes, the size of the stored events.
+        """
+        event_count, min_time, max_time, size = self.connection.execute(
+            u'SELECT COUNT(*), MIN(datetime), MAX(datetime), '
+            u'SUM(LENGTH(source)) FROM event WHERE index_name = ?',
+            (index_name,)).fetchone()
+
+        def _to_datetime(value):
+            """Convert epoch milliseconds to a datetime."""
+            if value is None:
+                return None
+            return datetime.datetime.utcfromtimestamp(value / 1000.0)
+
+        return {
+            u'event_count': event_count,
+            u'min_datetime': _to_datetime(min_time),
+            u'max_datetime': _to_datetime(max_time),
+            u'size_in_bytes': size or 0
+        }
+
+    def import_event(self, flush_interval, index_name, event_type, event=None):
+        """Add event to the datastore.
+
+        Events are inserted in batches of flush_interval events, each in one
+        transaction. Call this method without an event when all events have
+        been added to insert the remaining events.
+
+        Args:
+            flush_interval: Number of events to queue up before inserting
+            index_name: Name of the index
+            event_type: Type of event (e.g. plaso_event)
+            event: Event dictionary
+
+        Returns:
+            Number of events added so far.
+        """
+        if event:
+            # Make sure we have decoded strings in the event dict.
+            event = {_decode(k): _decode(v) for k, v in event.items()}
+            self.import_buffer.append(event)
+            self.import_counter[u'events'] += 1
+
+        if len(self.import_buffer) >= flush_interval or (
+                not event and self.import_buffer):
+            self._insert_events(index_name, _decode(event_type))
+        return self.import_counter[u'events']
+
+    def _insert_events(self, index_name, event_type):
+        """Insert the buffered events in one transaction.
+
+        Args:
+            index_name: Name of the index
+            event_type: Type of event (e.g. plaso_event)
+        """
+        events = self.import_buffer
+        self.import_buffer = []
+        with self.connection:
+            for event in events:
+                cursor = self.connection.execute(
+                    u'INSERT INTO event '
+                    u'(index_name, event_id, doc_type, datetime, source) '
+                    u'VALUES (?, ?, ?, ?, ?)', (
+                        index_name, uuid4().hex, event_type,
+                        _event_time(event),
+                        json.dumps(event, ensure_ascii=False)))
+                self.connection.execute(
+                    u'INSERT INTO event_fts (rowid, body) VALUES (?, ?)',
+                    (cursor.lastrowid, _event_text(event)))
+        self.import_counter[u'indexed'] += len(events)
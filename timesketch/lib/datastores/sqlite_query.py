@@ -0,0 +1,297 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compile Elasticsearch query strings to SQLite.
+
+The SQLite datastore supports this subset of the query string syntax:
+
+* Words and "quoted phrases", matched with the full text index.
+* Prefix searches like foo*.
+* field:value and field:"value", matched against the value of the field.
+  Values can have * and ? wildcards.
+* _exists_:field for events that have a field.
+* AND, OR, NOT, &&, ||, !, + and - and grouping with parentheses.
+
+Like Elasticsearch, terms without an operator are optional (OR), unless
+another term is required.
+"""
+
+import re
+
+TOKEN_RE = re.compile(
+    r'\s*(?P<modifier>[+\-!](?=\S))?'
+    r'(?:(?P<paren>[()])|'
+    r'(?:(?P<field>[A-Za-z_][\w.]*):)?'
+    r'(?:"(?P<phrase>(?:[^"\\]|\\.)*)"|(?P<word>[^\s()"]+)))',
+    re.UNICODE)
+
+OPERATORS = {
+    u'AND': u'AND', u'&&': u'AND', u'OR': u'OR', u'||': u'OR',
+    u'NOT': u'NOT'
+}
+
+# How a clause occurs in a group, as in a Lucene boolean query.
+MUST = u'must'
+SHOULD = u'should'
+MUST_NOT = u'must_not'
+
+# SQL for a clause that matches all events.
+MATCH_ALL = (u'1', [])
+
+# SQL to match events with the full text index.
+FTS_SQL = (
+    u'event.rowid IN (SELECT rowid FROM event_fts WHERE event_fts MATCH ?)')
+
+
+def _tokenize(query_string):
+    """Split a query string into tokens.
+
+    Args:
+        query_string: Query string
+
+    Returns:
+        List of dictionaries with the named groups of TOKEN_RE.
+
+    Raises:
+        ValueError: If the query string can not be tokenized.
+    """
+    tokens = []
+    position = 0
+    query_string = query_string.rstrip()
+    while position < len(query_string):
+        match = TOKEN_RE.match(query_string, position)
+        if not match:
+            raise ValueError(
+                u'Unable to parse query string at: {0:s}'.format(
+                    query_string[position:]))
+        tokens.append(match.groupdict())
+        position = match.end()
+    return tokens
+
+
+def _unescape(value):
+    """Remove backslash escapes from a query string value."""
+    return re.sub(r'\\(.)', r'\1', value)
+
+
+def _fts_query(token):
+    """Build a FTS5 query for a word or phrase.
+
+    Args:
+        token: Token dictionary without field
+
+    Returns:
+        FTS5 query string.
+
+    Raises:
+        ValueError: If the word has wildcards other than a trailing *.
+    """
+    if token[u'phrase'] is not None:
+        return u'"{0:s}"'.format(
+            _unescape(token[u'phrase']).replace(u'"', u'""'))
+
+    word = _unescape(token[u'word'])
+    prefix = word.endswith(u'*')
+    word = word.rstrip(u'*')
+    if u'*' in word or u'?' in word:
+        raise ValueError(
+            u'Wildcards are only supported at the end of a word: '
+            u'{0:s}'.format(token[u'word']))
+    fts_query = u'"{0:s}"'.format(word.replace(u'"', u'""'))
+    if prefix:
+        fts_query += u'*'
+    return fts_query
+
+
+def _like_pattern(value):
+    """Convert a value with query string wildcards to a LIKE pattern."""
+    pattern = value.replace(u'\\', u'\\\\').replace(
+        u'%', u'\\%').replace(u'_', u'\\_')
+    return pattern.replace(u'*', u'%').replace(u'?', u'_')
+
+
+def _compile_term(token, keyword_fields):
+    """Compile a single term.
+
+    Args:
+        token: Token dictionary
+        keyword_fields: Set of field names that are matched exactly
+
+    Returns:
+        Tuple of SQL expression and list of parameters.
+
+    Raises:
+        ValueError: If the term uses unsupported syntax.
+    """
+    word = token[u'word']
+    if word is not None and word[:1] in (u'[', u'{'):
+        raise ValueError(u'Range queries are not supported.')
+
+    field = token[u'field']
+    if not field:
+        if word == u'*':
+            return MATCH_ALL
+        return FTS_SQL, [_fts_query(token)]
+
+    if field == u'_exists_':
+        return u'json_extract(event.source, ?) IS NOT NULL', [
+            u'$."{0:s}"'.format(_unescape(word or token[u'phrase']))]
+
+    path = u'$."{0:s}"'.format(field)
+    if token[u'phrase'] is not None:
+        value = _unescape(token[u'phrase'])
+        pattern = _like_pattern(value)
+    else:
+        value = _unescape(word)
+        if value == u'*':
+            return u'json_extract(event.source, ?) IS NOT NULL', [path]
+        pattern = _like_pattern(value)
+        if u'*' in value or u'?' in value:
+            return u"json_extract(event.source, ?) LIKE ? ESCAPE '\\'", [
+                path, pattern]
+
+    if field in keyword_fields:
+        return u'json_extract(event.source, ?) = ?', [path, value]
+    # Analyzed fields match if the value is anywhere in the field.
+    return u"json_extract(event.source, ?) LIKE ? ESCAPE '\\'", [
+        path, u'%{0:s}%'.format(pattern)]
+
+
+def _join(clauses, operator):
+    """Join compiled clauses with AND or OR.
+
+    Args:
+        clauses: List of (SQL, parameters) tuples
+        operator: SQL operator to join the clauses with
+
+    Returns:
+        Tuple of SQL expression and list of parameters.
+    """
+    if operator == u' AND ':
+        clauses = [clause for clause in clauses if clause != MATCH_ALL]
+    elif MATCH_ALL in clauses:
+        return MATCH_ALL
+    if not clauses:
+        return MATCH_ALL
+    sql = operator.join(u'({0:s})'.format(sql) for sql, _ in clauses)
+    parameters = [
+        parameter for _, sql_parameters in clauses
+        for parameter in sql_parameters]
+    return sql, parameters
+
+
+def _compile_group(clauses):
+    """Compile a group of clauses like a Lucene boolean query.
+
+    Args:
+        clauses: List of (occur, (SQL, parameters)) tuples
+
+    Returns:
+        Tuple of SQL expression and list of parameters.
+    """
+    must = [clause for occur, clause in clauses if occur == MUST]
+    should = [clause for occur, clause in clauses if occur == SHOULD]
+    must_not = [clause for occur, clause in clauses if occur == MUST_NOT]
+
+    # Optional clauses only change the score when there are required ones.
+    if must:
+        required = _join(must, u' AND ')
+    else:
+        required = _join(should, u' OR ')
+    excluded = [
+        (u'NOT ({0:s})'.format(sql), parameters)
+        for sql, parameters in must_not]
+    return _join([required] + excluded, u' AND ')
+
+
+def _parse_group(tokens, position, nested, keyword_fields):
+    """Parse tokens up to the end of a group.
+
+    Args:
+        tokens: List of tokens
+        position: Index of the first token of the group
+        nested: Boolean indicating if the group is in parentheses
+        keyword_fields: Set of field names that are matched exactly
+
+    Returns:
+        Tuple of the compiled group and the index after the group.
+
+    Raises:
+        ValueError: If the parentheses are not balanced.
+    """
+    clauses = []
+    conjunction = None
+    negate = False
+    while position < len(tokens):
+        token = tokens[position]
+        position += 1
+
+        if token[u'paren'] == u')':
+            if not nested:
+                raise ValueError(u'Unbalanced parentheses in query string.')
+            return _compile_group(clauses), position
+
+        operator = None
+        if not (token[u'paren'] or token[u'modifier'] or token[u'field'] or
+                token[u'phrase'] is not None):
+            operator = OPERATORS.get(token[u'word'])
+        if operator == u'NOT':
+            negate = True
+            continue
+        if operator:
+            conjunction = operator
+            if operator == u'AND' and clauses and clauses[-1][0] == SHOULD:
+                clauses[-1] = (MUST, clauses[-1][1])
+            continue
+
+        if token[u'paren'] == u'(':
+            clause, position = _parse_group(
+                tokens, position, True, keyword_fields)
+        else:
+            clause = _compile_term(token, keyword_fields)
+
+        if negate or token[u'modifier'] in (u'-', u'!'):
+            occur = MUST_NOT
+        elif token[u'modifier'] == u'+' or conjunction == u'AND':
+            occur = MUST
+        else:
+            occur = SHOULD
+        clauses.append((occur, clause))
+        conjunction = None
+        negate = False
+
+    if nested:
+        raise ValueError(u'Unbalanced parentheses in query string.')
+    return _compile_group(clauses), position
+
+
+def compile_query_string(query_string, keyword_fields=frozenset()):
+    """Compile a query string to a SQL expression on the event table.
+
+    Args:
+        query_string: Query string in the supported subset of the
+            Elasticsearch query string syntax
+        keyword_fields: Set of field names that are matched exactly. Other
+            fields match if they contain the value.
+
+    Returns:
+        Tuple of SQL expression and list of parameters.
+
+    Raises:
+        ValueError: If the query string uses unsupported syntax.
+    """
+    tokens = _tokenize(query_string or u'')
+    if not tokens:
+        return MATCH_ALL
+    clause, _ = _parse_group(tokens, 0, False, keyword_fields)
+    return clause
@@ -0,0 +1,98 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the SQLite query string compiler."""
+
+from timesketch.lib.datastores.sqlite_query import FTS_SQL
+from timesketch.lib.datastores.sqlite_query import MATCH_ALL
+from timesketch.lib.datastores.sqlite_query import compile_query_string
+from timesketch.lib.testlib import BaseTest
+
+KEYWORD_FIELDS = frozenset([u'data_type'])
+
+FIELD_LIKE_SQL = u'json_extract(event.source, ?) LIKE ? ESCAPE \'\\\''
+
+
+class TestSqliteQuery(BaseTest):
+    """Tests for the functionality of the query string compiler."""
+
+    def _compile(self, query_string):
+        """Compile a query string with the test keyword fields."""
+        return compile_query_string(query_string, KEYWORD_FIELDS)
+
+    def test_match_all(self):
+        """Test queries that match all events."""
+        self.assertEqual(self._compile(u''), MATCH_ALL)
+        self.assertEqual(self._compile(u'*'), MATCH_ALL)
+        self.assertEqual(self._compile(u'* OR foo'), MATCH_ALL)
+        self.assertEqual(
+            self._compile(u'* AND foo'), self._compile(u'foo'))
+
+    def test_full_text(self):
+        """Test words and phrases use the full text index."""
+        self.assertEqual(
+            self._compile(u'foo'), (u'(({0:s}))'.format(FTS_SQL), [u'"foo"']))
+        self.assertEqual(self._compile(u'"foo bar"')[1], [u'"foo bar"'])
+        self.assertEqual(self._compile(u'foo*')[1], [u'"foo"*'])
+        self.assertEqual(self._compile(u'"a \\"b\\""')[1], [u'"a ""b"""'])
+
+    def test_fields(self):
+        """Test field queries."""
+        self.assertEqual(
+            self._compile(u'data_type:"fs:stat"'),
+            (u'((json_extract(event.source, ?) = ?))',
+             [u'$."data_type"', u'fs:stat']))
+        self.assertEqual(
+            self._compile(u'data_type:fs\\:stat')[1],
+            [u'$."data_type"', u'fs:stat'])
+        self.assertEqual(
+            self._compile(u'message:foo'),
+            (u'(({0:s}))'.format(FIELD_LIKE_SQL), [u'$."message"', u'%foo%']))
+        self.assertEqual(
+            self._compile(u'message:f?o*_')[1], [u'$."message"', u'f_o%\\_'])
+        self.assertEqual(
+            self._compile(u'_exists_:tag'),
+            (u'((json_extract(event.source, ?) IS NOT NULL))', [u'$."tag"']))
+
+    def test_operators(self):
+        """Test boolean operators and grouping."""
+        term = u'({0:s})'.format(FTS_SQL)
+        self.assertEqual(
+            self._compile(u'foo bar')[0], u'({0:s} OR {0:s})'.format(term))
+        self.assertEqual(
+            self._compile(u'foo || bar'), self._compile(u'foo bar'))
+        self.assertEqual(
+            self._compile(u'foo AND bar')[0],
+            u'({0:s} AND {0:s})'.format(term))
+        self.assertEqual(
+            self._compile(u'foo && bar'), self._compile(u'foo AND bar'))
+        self.assertEqual(
+            self._compile(u'foo -bar')[0],
+            u'({0:s}) AND (NOT {0:s})'.format(term))
+        self.assertEqual(
+            self._compile(u'NOT bar'), self._compile(u'!bar'))
+        # Optional terms are ignored when there is a required term.
+        self.assertEqual(self._compile(u'+foo bar'), self._compile(u'foo'))
+        self.assertEqual(
+            self._compile(u'foo AND (bar OR baz)'),
+            (u'({0:s} AND (({0:s} OR {0:s})))'.format(term),
+             [u'"foo"', u'"bar"', u'"baz"']))
+        self.assertEqual(
+            self._compile(u'foo -(bar baz)')[1],
+            [u'"foo"', u'"bar"', u'"baz"'])
+
+    def test_unsupported(self):
+        """Test that unsupported syntax raises ValueError."""
+        for query_string in [u'(foo', u'foo)', u'f*o', u'count:[1 TO 5]']:
+            with self.assertRaises(ValueError):
+                self._compile(query_string)
@@ -0,0 +1,200 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the SQLite datastore."""
+
+import os
+import shutil
+import tempfile
+import threading
+
+from timesketch.lib.datastores.sqlite import SqliteDataStore
+from timesketch.lib.datastores.sqlite import close_connection
+from timesketch.lib.datastores.sqlite import create_schema
+from timesketch.lib.testlib import BaseTest
+
+TEST_EVENTS = [
+    {
+        u'message': u'User logged in from workstation',
+        u'timestamp': 1483228800000000,
+        u'datetime': u'2017-01-01T00:00:00',
+        u'timestamp_desc': u'Event Recorded',
+        u'data_type': u'windows:evtx:record',
+        u'hostname': u'host1'
+    },
+    {
+        u'message': u'File downloaded from evil.com',
+        u'timestamp': 1483315200000000,
+        u'datetime': u'2017-01-02T00:00:00',
+        u'timestamp_desc': u'Content Modification Time',
+        u'data_type': u'fs:stat',
+        u'hostname': u'host2'
+    },
+    {
+        u'message': u'User logged out',
+        u'datetime': u'2017-01-03T00:00:00',
+        u'timestamp_desc': u'Event Recorded',
+        u'data_type': u'windows:evtx:record',
+        u'hostname': u'host1'
+    }
+]
+
+
+class SqliteDataStoreTest(BaseTest):
+    """Test the SQLite datastore."""
+    def setUp(self):
+        super(SqliteDataStoreTest, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, u'timesketch.db')
+        create_schema(self.path)
+        self.datastore = SqliteDataStore(self.path)
+        self.index_name, self.doc_type = self.datastore.create_index(
+            u'test_index', u'generic_event')
+        for event in TEST_EVENTS:
+            self.datastore.import_event(2, self.index_name, self.doc_type,
+                                        event=dict(event))
+        self.datastore.import_event(2, self.index_name, self.doc_type)
+        self.datastore.finalize_index(self.index_name)
+
+    def tearDown(self):
+        super(SqliteDataStoreTest, self).tearDown()
+        close_connection(self.path)
+        shutil.rmtree(self.temp_dir)
+
+    def _search(self, query_string, **query_filter):
+        """Search the test index and return the messages of the events."""
+        result = self.datastore.search(
+            1, query_string, query_filter, None, [self.index_name])
+        return [hit[u'_source'][u'message'] for hit in result[u'hits'][
+            u'hits']]
+
+    def test_import(self):
+        """Test importing events."""
+        self.assertEqual(self.datastore.import_counter[u'events'], 3)
+        self.assertEqual(self.datastore.import_counter[u'indexed'], 3)
+        self.assertEqual(self.datastore.count([self.index_name]), 3)
+        stats = self.datastore.index_stats(self.index_name)
+        self.assertEqual(stats[u'event_count'], 3)
+        self.assertEqual(
+            stats[u'min_datetime'].isoformat(), u'2017-01-01T00:00:00')
+        self.assertEqual(
+            stats[u'max_datetime'].isoformat(), u'2017-01-03T00:00:00')
+
+    def test_connection(self):
+        """Test that datastores in a thread share the connection."""
+        datastore = SqliteDataStore(self.path)
+        self.assertIs(datastore.connection, self.datastore.connection)
+        self.assertEqual(datastore.count([self.index_name]), 3)
+
+        connections = []
+        thread = threading.Thread(target=lambda: connections.append(
+            SqliteDataStore(self.path).connection))
+        thread.start()
+        thread.join()
+        self.assertIsNot(connections[0], self.datastore.connection)
+
+    def test_search(self):
+        """Test full text, field and boolean queries."""
+        self.assertEqual(len(self._search(u'*')), 3)
+        self.assertEqual(
+            self._search(u'logged'),
+            [u'User logged in from workstation', u'User logged out'])
+        self.assertEqual(self._search(u'"logged out"'), [u'User logged out'])
+        self.assertEqual(
+            self._search(u'down*'), [u'File downloaded from evil.com'])
+        self.assertEqual(
+            self._search(u'data_type:"fs:stat"'),
+            [u'File downloaded from evil.com'])
+        self.assertEqual(self._search(u'data_type:fs'), [])
+        self.assertEqual(
+            self._search(u'hostname:host1 AND NOT out'),
+            [u'User logged in from workstation'])
+        self.assertEqual(
+            self._search(u'evil.com OR out'),
+            [u'File downloaded from evil.com', u'User logged out'])
+
+    def test_search_filter(self):
+        """Test the time range, exclude, order and limit filters."""
+        self.assertEqual(
+            self._search(u'*', time_start=u'2017-01-02', time_end=u'2017-01-02'),
+            [u'File downloaded from evil.com'])
+        self.assertEqual(
+            self._search(u'*', exclude=[u'windows:evtx:record']),
+            [u'File downloaded from evil.com'])
+        self.assertEqual(
+            self._search(u'user', order=u'desc', limit=1),
+            [u'User logged out'])
+
+    def test_search_cursor(self):
+        """Test paging through the results with a cursor."""
+        query_filter = {u'limit': 2}
+        result = self.datastore.search(
+            1, u'*', query_filter, None, [self.index_name])
+        self.assertNotIn(u'next_cursor', result)
+        result = self.datastore.search(
+            1, u'*', query_filter, None, [self.index_name], paginate=True)
+        self.assertEqual(result[u'hits'][u'total'], 3)
+        self.assertEqual(len(result[u'hits'][u'hits']), 2)
+        result = self.datastore.search(
+            1, u'*', query_filter, None, [self.index_name],
+            cursor=result[u'next_cursor'])
+        self.assertEqual(
+            [hit[u'_source'][u'message'] for hit in result[u'hits'][u'hits']],
+            [u'User logged out'])
+        self.assertNotIn(u'next_cursor', result)
+
+        events = list(self.datastore.search_stream(
+            1, u'*', {}, None, [self.index_name], page_size=2))
+        self.assertEqual(len(events), 3)
+
+    def test_labels(self):
+        """Test adding, toggling and searching labels."""
+        event = self.datastore.search(
+            1, u'evil.com', {}, None, [self.index_name])[u'hits'][u'hits'][0]
+        self.datastore.set_label(
+            self.index_name, event[u'_id'], self.doc_type, 1, 1, u'__ts_star',
+            toggle=True)
+        self.assertEqual(
+            self._search(u'', star=True), [u'File downloaded from evil.com'])
+        # Labels are per sketch.
+        result = self.datastore.search(
+            2, u'', {u'star': True}, None, [self.index_name])
+        self.assertEqual(result[u'hits'][u'total'], 0)
+
+        failed = self.datastore.set_labels(
+            [{u'_index': self.index_name, u'_id': event[u'_id']},
+             {u'_index': self.index_name, u'_id': u'missing'}],
+            1, 1, u'__ts_star', toggle=True)
+        self.assertEqual(failed, 1)
+        self.assertEqual(self._search(u'', star=True), [])
+
+    def test_get_events(self):
+        """Test getting events by id."""
+        hits = self.datastore.search(
+            1, u'*', {}, None, [self.index_name])[u'hits'][u'hits']
+        event = self.datastore.get_event(self.index_name, hits[0][u'_id'])
+        self.assertEqual(event[u'_source'][u'hostname'], u'host1')
+
+        events = self.datastore.get_events([
+            {u'_index': self.index_name, u'_id': hits[2][u'_id']},
+            {u'_index': self.index_name, u'_id': u'missing'},
+            {u'_index': self.index_name, u'_id': hits[1][u'_id']}])
+        self.assertEqual(
+            [event[u'_id'] for event in events],
+            [hits[2][u'_id'], hits[1][u'_id']])
+
+    def test_unsupported(self):
+        """Test that DSL queries are rejected."""
+        with self.assertRaises(ValueError):
+            self.datastore.search(
+                1, u'', {}, {u'query': {u'match_all': {}}}, [self.index_name])
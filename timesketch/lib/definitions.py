@@ -21,3 +21,15 @@ HTTP_STATUS_CODE_BAD_REQUEST = 400
 HTTP_STATUS_CODE_UNAUTHORIZED = 401
 HTTP_STATUS_CODE_FORBIDDEN = 403
 HTTP_STATUS_CODE_NOT_FOUND = 404
+
+# Search index statuses while a timeline is imported. The index is queued
+# (processing), events are loaded (indexing) and the index is merged for
+# searching (optimizing). Such indices are not ready to be searched.
+SEARCHINDEX_PROCESSING_STATUSES = (u'processing', u'indexing', u'optimizing')
+
+# Search index status when the import of a timeline failed. Only part of the
+# events may be in the index, so it is not searched or counted.
+SEARCHINDEX_FAILED_STATUS = u'fail'
+
+# Maximum number of events to get in one batch request.
+MAX_EVENT_BATCH_SIZE = 1000
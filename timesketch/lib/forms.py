@@ -154,6 +154,16 @@ class ExploreForm(BaseForm):
     query = StringField(u'Query')
     filter = StringField(u'Filter')
     dsl = StringField(u'DSL')
+    include = SelectMultipleField(
+        u'Include',
+        choices=[
+            (u'heatmap', u'Heatmap'),
+            (u'histogram', u'Histogram'),
+            (u'timeline_counts', u'Number of hits per timeline'),
+            (u'count', u'Number of events in sketch')
+        ])
+    cursor = StringField(u'Cursor')
+    paginate = BooleanField(u'Paginate')
 
 
 class GraphExploreForm(BaseForm):
@@ -165,6 +175,12 @@ class GraphExploreForm(BaseForm):
 class AggregationForm(ExploreForm):
     """Form used to search the datastore."""
     aggtype = StringField(u'Aggregation type')
+    zoom_start = IntegerField(u'Zoom window start')
+    zoom_end = IntegerField(u'Zoom window end')
+    per_timeline = BooleanField(u'Split by timeline')
+    field = StringField(u'Field')
+    size = IntegerField(u'Number of terms')
+    sample_size = IntegerField(u'Events per shard to sample')
 
 
 class StatusForm(BaseForm):
@@ -192,6 +208,11 @@ class EventAnnotationForm(BaseForm):
     events = StringField(u'Events', validators=[DataRequired()])
 
 
+class EventBatchForm(BaseForm):
+    """Form to get many events at once."""
+    events = StringField(u'Events', validators=[DataRequired()])
+
+
 class UploadFileForm(BaseForm):
     """Form to handle file uploads."""
     file = FileField(
@@ -0,0 +1,466 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per request timing and metrics in the Prometheus text format.
+
+Each request is split in phases: database queries (timed with SQLAlchemy
+engine events), datastore calls, result processing and serialization. The
+phases are added to the response as a Server-Timing header, and counted per
+endpoint in histograms that are exported on /metrics.
+
+Metrics are kept in memory per process. With several worker processes a
+scrape only sees the worker that answered it.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import functools
+import threading
+import time
+
+from flask import abort
+from flask import current_app
+from flask import g
+from flask import has_request_context
+from flask import request
+from flask import Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from timesketch.lib.definitions import HTTP_STATUS_CODE_NOT_FOUND
+
+# Phases of a request.
+PHASE_DB = u'db'
+PHASE_DATASTORE = u'datastore'
+PHASE_PROCESS = u'process'
+PHASE_SERIALIZE = u'serialize'
+
+PHASE_DESCRIPTIONS = {
+    PHASE_DB: u'Database',
+    PHASE_DATASTORE: u'Datastore',
+    PHASE_PROCESS: u'Result processing',
+    PHASE_SERIALIZE: u'Serialization'
+}
+
+# Latency histogram buckets in seconds.
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Label for requests that did not match a route, so that random URLs do not
+# create new time series.
+UNMATCHED_ENDPOINT = u'unmatched'
+
+CONTENT_TYPE = u'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    """Escape a label value for the Prometheus text format."""
+    return unicode(value).replace(u'\\', u'\\\\').replace(
+        u'\n', u'\\n').replace(u'"', u'\\"')
+
+
+def _format_labels(label_names, label_values, extra=None):
+    """Format labels as {name="value",...}.
+
+    Args:
+        label_names: Tuple of label names
+        label_values: Tuple of label values
+        extra: Optional (name, value) tuple to add, e.g. the le label
+
+    Returns:
+        Labels in the Prometheus text format, empty if there are none.
+    """
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return u''
+    return u'{{{0:s}}}'.format(u','.join(
+        u'{0:s}="{1:s}"'.format(name, _escape(value))
+        for name, value in pairs))
+
+
+def _format_value(value):
+    """Format a sample value."""
+    if value == float(u'inf'):
+        return u'+Inf'
+    return repr(float(value))
+
+
+class CounterMetric(object):
+    """Counter with labels."""
+    kind = u'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        """Initialize the counter.
+
+        Args:
+            name: Metric name
+            documentation: Help text
+            label_names: Tuple of label names
+        """
+        super(CounterMetric, self).__init__()
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, label_values=(), amount=1):
+        """Increment the counter.
+
+        Args:
+            label_values: Tuple of label values, in the order of label_names
+            amount: Amount to add
+        """
+        with self._lock:
+            self._values[tuple(label_values)] += amount
+
+    def samples(self):
+        """Get the samples of the counter.
+
+        Returns:
+            List of lines in the Prometheus text format.
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            u'{0:s}{1:s} {2:s}'.format(
+                self.name, _format_labels(self.label_names, label_values),
+                _format_value(value))
+            for label_values, value in values]
+
+
+class HistogramMetric(object):
+    """Histogram with labels."""
+    kind = u'histogram'
+
+    def __init__(
+            self, name, documentation, label_names=(),
+            buckets=DEFAULT_BUCKETS):
+        """Initialize the histogram.
+
+        Args:
+            name: Metric name
+            documentation: Help text
+            label_names: Tuple of label names
+            buckets: Sorted tuple of upper bounds of the buckets
+        """
+        super(HistogramMetric, self).__init__()
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets) + (float(u'inf'),)
+        # Label values as key, list of bucket counts, sum and count as value.
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_values=()):
+        """Record an observation.
+
+        Args:
+            value: Observed value, e.g. a latency in seconds
+            label_values: Tuple of label values, in the order of label_names
+        """
+        label_values = tuple(label_values)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [
+                    [0] * len(self.buckets), 0.0, 0]
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        """Get the samples of the histogram.
+
+        Returns:
+            List of lines in the Prometheus text format.
+        """
+        with self._lock:
+            values = sorted(
+                (label_values, (list(series[0]), series[1], series[2]))
+                for label_values, series in self._values.items())
+        lines = []
+        for label_values, (bucket_counts, total, count) in values:
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(u'{0:s}_bucket{1:s} {2:s}'.format(
+                    self.name, _format_labels(
+                        self.label_names, label_values,
+                        (u'le', _format_value(upper_bound))),
+                    _format_value(cumulative)))
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(u'{0:s}_sum{1:s} {2:s}'.format(
+                self.name, labels, _format_value(total)))
+            lines.append(u'{0:s}_count{1:s} {2:s}'.format(
+                self.name, labels, _format_value(count)))
+        return lines
+
+
+class MetricsRegistry(object):
+    """Collection of metrics that are exported together."""
+
+    def __init__(self):
+        """Initialize the registry."""
+        super(MetricsRegistry, self).__init__()
+        self.metrics = []
+
+    def register(self, metric):
+        """Add a metric to the registry.
+
+        Args:
+            metric: Instance of CounterMetric or HistogramMetric
+
+        Returns:
+            The metric.
+        """
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Render all metrics in the Prometheus text format.
+
+        Returns:
+            Metrics as a string.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(u'# HELP {0:s} {1:s}'.format(
+                metric.name, metric.documentation))
+            lines.append(u'# TYPE {0:s} {1:s}'.format(
+                metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return u'\n'.join(lines) + u'\n'
+
+
+REGISTRY = MetricsRegistry()
+
+REQUESTS = REGISTRY.register(CounterMetric(
+    u'timesketch_http_requests_total',
+    u'Number of HTTP requests.',
+    (u'endpoint', u'method', u'status')))
+REQUEST_DURATION = REGISTRY.register(HistogramMetric(
+    u'timesketch_http_request_duration_seconds',
+    u'Time to handle a HTTP request, up to the start of the response.',
+    (u'endpoint', u'method')))
+PHASE_DURATION = REGISTRY.register(HistogramMetric(
+    u'timesketch_http_request_phase_duration_seconds',
+    u'Time spent in each phase of a HTTP request.',
+    (u'endpoint', u'phase')))
+DB_QUERIES = REGISTRY.register(CounterMetric(
+    u'timesketch_db_queries_total',
+    u'Number of database queries.',
+    (u'endpoint',)))
+
+
+class RequestTimer(object):
+    """Time spent in each phase of a request.
+
+    Attributes:
+        start_time: Time the request started
+        phases: Dictionary with phase as key and seconds as value
+        query_count: Number of database queries
+    """
+    def __init__(self):
+        """Initialize the timer."""
+        super(RequestTimer, self).__init__()
+        self.start_time = time.time()
+        self.phases = defaultdict(float)
+        self.query_count = 0
+        self._active = set()
+
+    @contextmanager
+    def phase(self, name):
+        """Add the time spent in the block to a phase.
+
+        Nested blocks of the same phase, e.g. a datastore method calling
+        another one, are only counted once.
+
+        Args:
+            name: Name of the phase
+        """
+        if name in self._active:
+            yield
+            return
+        self._active.add(name)
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.time() - start_time
+            self._active.discard(name)
+
+    def server_timing(self):
+        """Format the phases as a Server-Timing header value.
+
+        Returns:
+            Header value with the milliseconds per phase and the total.
+        """
+        metrics = []
+        for name in sorted(self.phases):
+            description = PHASE_DESCRIPTIONS.get(name, name)
+            if name == PHASE_DB:
+                description = u'{0:s} ({1:d} queries)'.format(
+                    description, self.query_count)
+            metrics.append(u'{0:s};dur={1:.1f};desc="{2:s}"'.format(
+                name, self.phases[name] * 1000, description))
+        metrics.append(u'total;dur={0:.1f}'.format(
+            (time.time() - self.start_time) * 1000))
+        return u', '.join(metrics)
+
+
+def get_request_timer():
+    """Get the timer of the current request.
+
+    Returns:
+        Instance of RequestTimer, or None outside of a timed request.
+    """
+    if not has_request_context():
+        return None
+    return getattr(g, u'request_timer', None)
+
+
+@contextmanager
+def timed(phase):
+    """Add the time spent in the block to a phase of the current request.
+
+    Outside of a request this does nothing, so it is safe to use in code
+    that also runs in tsctl or in Celery tasks.
+
+    Args:
+        phase: Name of the phase, e.g. PHASE_DATASTORE
+    """
+    timer = get_request_timer()
+    if timer is None:
+        yield
+        return
+    with timer.phase(phase):
+        yield
+
+
+def timed_method(phase):
+    """Decorator that adds the time spent in a function to a phase.
+
+    Args:
+        phase: Name of the phase, e.g. PHASE_DATASTORE
+
+    Returns:
+        Decorator for the function.
+    """
+    def decorator(function):
+        """Wrap the function."""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            """Call the function in the phase."""
+            with timed(phase):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# pylint: disable=unused-argument
+def _before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany):
+    """Record the start of a database query."""
+    conn.info.setdefault(u'query_start_time', []).append(time.time())
+
+
+# pylint: disable=unused-argument
+def _after_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany):
+    """Add the time of a database query to the current request."""
+    start_times = conn.info.get(u'query_start_time')
+    if not start_times:
+        return
+    elapsed = time.time() - start_times.pop()
+    timer = get_request_timer()
+    if timer is not None:
+        timer.phases[PHASE_DB] += elapsed
+        timer.query_count += 1
+
+
+def _endpoint():
+    """Get the endpoint label of the current request."""
+    if request.url_rule is None:
+        return UNMATCHED_ENDPOINT
+    return request.url_rule.rule
+
+
+def _start_request():
+    """Start timing a request."""
+    g.request_timer = RequestTimer()
+
+
+def _finish_request(response):
+    """Record the metrics of a request and add the Server-Timing header.
+
+    Args:
+        response: Response object (instance of flask.wrappers.Response)
+
+    Returns:
+        The response.
+    """
+    timer = getattr(g, u'request_timer', None)
+    if timer is None:
+        return response
+    g.request_timer = None
+
+    endpoint = _endpoint()
+    if endpoint != u'/metrics':
+        REQUESTS.inc((endpoint, request.method, response.status_code))
+        REQUEST_DURATION.observe(
+            time.time() - timer.start_time, (endpoint, request.method))
+        for phase, seconds in timer.phases.items():
+            PHASE_DURATION.observe(seconds, (endpoint, phase))
+        DB_QUERIES.inc((endpoint,), timer.query_count)
+
+    if current_app.config.get(u'SERVER_TIMING_HEADER', True):
+        response.headers[u'Server-Timing'] = timer.server_timing()
+    return response
+
+
+def metrics_view():
+    """Export the metrics in the Prometheus text format.
+
+    Returns:
+        Response with the metrics, or 404 if metrics are disabled.
+    """
+    if not current_app.config.get(u'METRICS_ENABLED', False):
+        abort(HTTP_STATUS_CODE_NOT_FOUND)
+    allowed = current_app.config.get(u'METRICS_ALLOWED_IPS')
+    if allowed and request.remote_addr not in allowed:
+        abort(HTTP_STATUS_CODE_NOT_FOUND)
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+def init_metrics(app):
+    """Set up request timing and the /metrics endpoint for an app.
+
+    Args:
+        app: Application object (instance of flask.Flask)
+    """
+    # Engine events are global, make sure queries are only counted once.
+    if not event.contains(Engine, u'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, u'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, u'after_cursor_execute', _after_cursor_execute)
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule(u'/metrics', u'metrics', metrics_view)
@@ -0,0 +1,81 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for request timing and metrics."""
+
+from timesketch.lib.definitions import HTTP_STATUS_CODE_NOT_FOUND
+from timesketch.lib.definitions import HTTP_STATUS_CODE_OK
+from timesketch.lib.metrics import CounterMetric
+from timesketch.lib.metrics import HistogramMetric
+from timesketch.lib.metrics import MetricsRegistry
+from timesketch.lib.metrics import PHASE_DATASTORE
+from timesketch.lib.metrics import RequestTimer
+from timesketch.lib.testlib import BaseTest
+
+
+class MetricsTest(BaseTest):
+    """Test the metrics registry and request timing."""
+
+    def test_render(self):
+        """Test rendering metrics in the Prometheus text format."""
+        registry = MetricsRegistry()
+        counter = registry.register(
+            CounterMetric(u'test_total', u'Test.', (u'endpoint',)))
+        histogram = registry.register(
+            HistogramMetric(u'test_seconds', u'Test.', buckets=(0.1, 1.0)))
+        counter.inc((u'/a"b',))
+        counter.inc((u'/a"b',), 2)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        lines = registry.render().splitlines()
+        self.assertIn(u'# TYPE test_total counter', lines)
+        self.assertIn(u'test_total{endpoint="/a\\"b"} 3.0', lines)
+        self.assertIn(u'test_seconds_bucket{le="0.1"} 0.0', lines)
+        self.assertIn(u'test_seconds_bucket{le="1.0"} 1.0', lines)
+        self.assertIn(u'test_seconds_bucket{le="+Inf"} 2.0', lines)
+        self.assertIn(u'test_seconds_sum 5.5', lines)
+        self.assertIn(u'test_seconds_count 2.0', lines)
+
+    def test_nested_phase(self):
+        """Test that nested blocks of the same phase are counted once."""
+        timer = RequestTimer()
+        with timer.phase(PHASE_DATASTORE):
+            with timer.phase(PHASE_DATASTORE):
+                pass
+            inner = timer.phases[PHASE_DATASTORE]
+        self.assertEqual(inner, 0)
+        self.assertIn(u'datastore;dur=', timer.server_timing())
+
+    def test_server_timing_header(self):
+        """Test that API responses have a Server-Timing header."""
+        self.login()
+        response = self.client.get(u'/api/v1/sketches/1/')
+        self.assert200(response)
+        server_timing = response.headers[u'Server-Timing']
+        self.assertIn(u'db;dur=', server_timing)
+        self.assertIn(u'total;dur=', server_timing)
+
+    def test_metrics_endpoint(self):
+        """Test that metrics are only exported when enabled."""
+        response = self.client.get(u'/metrics')
+        self.assertEqual(response.status_code, HTTP_STATUS_CODE_NOT_FOUND)
+
+        self.app.config[u'METRICS_ENABLED'] = True
+        self.login()
+        self.client.get(u'/api/v1/sketches/1/')
+        response = self.client.get(u'/metrics')
+        self.assertEqual(response.status_code, HTTP_STATUS_CODE_OK)
+        self.assertIn(
+            b'timesketch_http_requests_total{endpoint="/api/v1/sketches/'
+            b'<int:sketch_id>/",method="GET",status="200"}', response.data)
@@ -29,6 +29,8 @@ except ImportError:
 from timesketch import create_app
 from timesketch import create_celery_app
 from timesketch.lib.datastores.elastic import ElasticsearchDataStore
+from timesketch.lib.datastores.sqlite import SqliteDataStore
+from timesketch.lib.definitions import SEARCHINDEX_FAILED_STATUS
 from timesketch.lib.utils import read_and_validate_csv
 from timesketch.models import db_session
 from timesketch.models.sketch import SearchIndex
@@ -50,6 +52,33 @@ def get_data_location():
     return data_location
 
 
+def _set_searchindex_stats(datastore, index_name):
+    """Record the number of events, time span and size of a search index.
+
+    Args:
+        datastore: Datastore the events were imported to
+            (instance of ElasticsearchDataStore)
+        index_name: Name of the datastore index.
+    """
+    search_index = SearchIndex.query.filter_by(index_name=index_name).first()
+    if search_index:
+        search_index.set_stats(datastore.index_stats(index_name))
+        db_session.commit()
+
+
+def _set_searchindex_status(index_name, status):
+    """Set the status of the search index for a timeline being imported.
+
+    Args:
+        index_name: Name of the datastore index.
+        status: Name of the status, see SEARCHINDEX_PROCESSING_STATUSES and
+            SEARCHINDEX_FAILED_STATUS.
+    """
+    search_index = SearchIndex.query.filter_by(index_name=index_name).first()
+    if search_index:
+        search_index.set_status(status)
+
+
 @celery.task(track_started=True)
 def run_plaso(source_file_path, timeline_name, index_name, username=None):
     """Create a Celery task for processing Plaso storage file.
@@ -84,6 +113,11 @@ def run_plaso(source_file_path, timeline_name, index_name, username=None):
     # Start process the Plaso storage file.
     counter = frontend.ExportEvents(storage_reader, output_module)
 
+    es = ElasticsearchDataStore(
+        host=current_app.config[u'ELASTIC_HOST'],
+        port=current_app.config[u'ELASTIC_PORT'])
+    _set_searchindex_stats(es, index_name)
+
     return dict(counter)
 
 
@@ -111,24 +145,60 @@ def run_csv(source_file_path, timeline_name, index_name, username=None):
     logging.info(u'Document type: %s', event_type)
     logging.info(u'Owner: %s', username)
 
-    es = ElasticsearchDataStore(
-        host=current_app.config[u'ELASTIC_HOST'],
-        port=current_app.config[u'ELASTIC_PORT'])
+    if current_app.config.get(u'DATASTORE') == u'sqlite':
+        es = SqliteDataStore(current_app.config[u'SQLITE_DATASTORE_PATH'])
+    else:
+        es = ElasticsearchDataStore(
+            host=current_app.config[u'ELASTIC_HOST'],
+            port=current_app.config[u'ELASTIC_PORT'])
 
-    es.create_index(index_name=index_name, doc_type=event_type)
-    for event in read_and_validate_csv(source_file_path):
-        es.import_event(
-            flush_interval, index_name, event_type, event)
+    with app.app_context():
+        _set_searchindex_status(index_name, u'indexing')
+
+    es.create_index(
+        index_name=index_name, doc_type=event_type,
+        source_size=os.path.getsize(source_file_path), ingest_mode=True)
+    imported = False
+    try:
+        try:
+            for event in read_and_validate_csv(source_file_path):
+                es.import_event(
+                    flush_interval, index_name, event_type, event)
+        finally:
+            # Import the remaining events and wait for indexing to finish.
+            # This also stops the bulk indexer threads if reading the file
+            # failed.
+            total_events = es.import_event(
+                flush_interval, index_name, event_type)
+        imported = True
+    finally:
+        if not imported:
+            # Don't leave the index without refreshes and replicas.
+            es.finalize_index(index_name, merge=False)
+            with app.app_context():
+                _set_searchindex_status(
+                    index_name, SEARCHINDEX_FAILED_STATUS)
+
+    failed_events = es.import_counter[u'failed']
+    if failed_events:
+        logging.error(
+            u'%d events failed to index, see %s', failed_events,
+            es.dead_letter_path)
 
-    # Import the remaining events
-    total_events = es.import_event(flush_interval, index_name, event_type)
+    with app.app_context():
+        _set_searchindex_status(index_name, u'optimizing')
+    es.finalize_index(index_name)
 
     # We are done so let's remove the processing status flag
     with app.app_context():
+        _set_searchindex_stats(es, index_name)
         search_index = SearchIndex.query.filter_by(
             index_name=index_name).first()
         search_index.status.remove(search_index.status[0])
         db_session.add(search_index)
         db_session.commit()
 
-    return {u'Events processed': total_events}
+    return {
+        u'Events processed': total_events,
+        u'Events failed': failed_events
+    }
@@ -0,0 +1,51 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the Celery tasks."""
+
+import os
+
+from celery import Celery
+import mock
+
+from timesketch.lib.definitions import SEARCHINDEX_FAILED_STATUS
+from timesketch.lib.testlib import BaseTest
+
+# The tasks module creates its Celery app from the configuration file when it
+# is imported, use one without configuration in the tests.
+with mock.patch(u'timesketch.create_celery_app', Celery):
+    from timesketch.lib import tasks
+
+
+class RunCsvTest(BaseTest):
+    """Tests for the run_csv task."""
+
+    def test_run_csv_failure(self):
+        """Test that an index is marked as failed if the import fails."""
+        self.searchindex.set_status(u'processing')
+        datastore = mock.Mock()
+        with mock.patch.object(tasks, u'create_app', return_value=self.app), \
+                mock.patch.object(
+                    tasks, u'ElasticsearchDataStore', return_value=datastore), \
+                mock.patch.object(
+                    tasks, u'read_and_validate_csv',
+                    side_effect=RuntimeError(u'Missing fields in CSV header')):
+            with self.assertRaises(RuntimeError):
+                tasks.run_csv.run(os.devnull, u'test', u'test')
+
+        # The events read are flushed and the index settings are restored.
+        datastore.import_event.assert_called_once_with(
+            1000, u'test', u'generic_event')
+        datastore.finalize_index.assert_called_once_with(u'test', merge=False)
+        self.assertEqual(
+            self.searchindex.get_status.status, SEARCHINDEX_FAILED_STATUS)
@@ -13,9 +13,13 @@
 # limitations under the License.
 """This module contains common test utilities for Timesketch."""
 
+from collections import Counter
+from contextlib import contextmanager
 import json
 
 from flask_testing import TestCase
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 from timesketch import create_app
 from timesketch.lib import datastore
@@ -106,20 +110,23 @@ class MockDataStore(datastore.DataStore):
         u'timed_out': False
     }
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, slow_query_callback=None):
         """Initialize the datastore.
 
         Args:
             host: Hostname or IP address to the datastore
             port: The port used by the datastore
+            slow_query_callback: Function to call for slow queries
         """
         self.host = host
         self.port = port
+        self.slow_query_callback = slow_query_callback
 
     def search(
             self, unused_sketch_id, unused_query, unused_query_filter,
             unused_query_dsl, unused_indices, aggregations, return_results,
-            return_fields=None, enable_scroll=False):
+            return_fields=None, enable_scroll=False, cursor=None,
+            paginate=False):
         """Mock a search query.
 
         Returns:
@@ -127,6 +134,39 @@ class MockDataStore(datastore.DataStore):
         """
         return self.search_result_dict
 
+    def search_stream(
+            self, unused_sketch_id, unused_query, unused_query_filter,
+            unused_query_dsl, unused_indices, return_fields=None,
+            page_size=1000, scroll_timeout=u'1m'):
+        """Mock a streaming search query.
+
+        Yields:
+            Event dictionaries.
+        """
+        for event in self.search_result_dict[u'hits'][u'hits']:
+            yield event
+
+    def count(self, unused_indices):
+        """Mock counting events.
+
+        Returns:
+            Number of events in the search result.
+        """
+        return len(self.search_result_dict[u'hits'][u'hits'])
+
+    def index_stats(self, unused_index_name):
+        """Mock getting the stats of an index.
+
+        Returns:
+            A dictionary with the number of events in the search result.
+        """
+        return {
+            u'event_count': len(self.search_result_dict[u'hits'][u'hits']),
+            u'min_datetime': None,
+            u'max_datetime': None,
+            u'size_in_bytes': None
+        }
+
     def get_event(self, unused_searchindex_id, unused_event_id):
         """Mock returning a single event from the datastore.
 
@@ -135,12 +175,27 @@ class MockDataStore(datastore.DataStore):
         """
         return self.event_dict
 
+    def get_events(self, events):
+        """Mock returning many events from the datastore.
+
+        Returns:
+            A list of dictionaries with event data.
+        """
+        return [
+            dict(self.event_dict, _index=event[u'_index'], _id=event[u'_id'])
+            for event in events
+        ]
+
     def set_label(
             self, searchindex_id, event_id, event_type, sketch_id, user_id,
             label, toggle=False):
         """Mock adding a label to an event."""
         return
 
+    def set_labels(self, events, sketch_id, user_id, label, toggle=False):
+        """Mock adding a label to many events."""
+        return 0
+
 
 class MockGraphDatabase(object):
     """A mock implementation of a Datastore."""
@@ -212,6 +267,74 @@ class MockGraphDatabase(object):
         return self.MockQuerySequence()
 
 
+class QueryCounter(object):
+    """Record the SQL statements that are executed in a block.
+
+    Used as a context manager:
+
+        with QueryCounter() as counter:
+            ...
+        counter.count
+
+    Attributes:
+        statements: List of SQL statements, in the order they were executed
+    """
+    def __init__(self):
+        """Initialize the counter."""
+        super(QueryCounter, self).__init__()
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(Engine, u'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(Engine, u'before_cursor_execute', self._record)
+
+    # pylint: disable=unused-argument
+    def _record(self, conn, cursor, statement, parameters, context,
+                executemany):
+        """Record a statement, called by SQLAlchemy."""
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        """Number of executed statements."""
+        return len(self.statements)
+
+    def repeated_statements(self):
+        """Get statements that were executed more than once.
+
+        The same statement executed with different parameters, e.g. a lazy
+        load of a relationship for every item in a loop, is the typical
+        sign of an N+1 query problem.
+
+        Returns:
+            List of (statement, count) tuples, most repeated first.
+        """
+        return [
+            (statement, count) for statement, count
+            in Counter(self.statements).most_common() if count > 1]
+
+    def report(self):
+        """Format the statements for a test failure message.
+
+        Returns:
+            The statements, followed by the N+1 suspects.
+        """
+        lines = [u'{0:d} queries executed:'.format(self.count)]
+        lines.extend(
+            u'  {0:d}. {1:s}'.format(number, u' '.join(statement.split()))
+            for number, statement in enumerate(self.statements, 1))
+        repeated = self.repeated_statements()
+        if repeated:
+            lines.append(u'Repeated statements (N+1 suspects):')
+            lines.extend(
+                u'  {0:d}x {1:s}'.format(count, u' '.join(statement.split()))
+                for statement, count in repeated)
+        return u'\n'.join(lines)
+
+
 class BaseTest(TestCase):
     """Base class for tests."""
 
@@ -440,6 +563,35 @@ class BaseTest(TestCase):
             u'/login/', data=dict(username=u'test1', password=u'test'),
             follow_redirects=True)
 
+    @contextmanager
+    def assertMaxQueries(self, max_queries, max_repeats=None):
+        """Assert that a block executes at most a number of SQL statements.
+
+        Use it to set a query budget for a request:
+
+            with self.assertMaxQueries(5):
+                self.client.post(u'/api/v1/sketches/1/explore/', ...)
+
+        Args:
+            max_queries: Maximum number of statements
+            max_repeats: Optional maximum number of times the same statement
+                may be executed, to catch N+1 queries
+
+        Yields:
+            The query counter (instance of QueryCounter)
+        """
+        with QueryCounter() as counter:
+            yield counter
+        if counter.count > max_queries:
+            self.fail(u'Expected at most {0:d} queries. {1:s}'.format(
+                max_queries, counter.report()))
+        if max_repeats is not None:
+            for _, count in counter.repeated_statements():
+                if count > max_repeats:
+                    self.fail(
+                        u'Statement executed more than {0:d} times. '
+                        u'{1:s}'.format(max_repeats, counter.report()))
+
     def test_unauthenticated(self):
         """
         Generic test for all resources. It tests that no
@@ -15,10 +15,15 @@
 
 import colorsys
 import csv
+import datetime
 import random
 import time
 
 from dateutil import parser
+from dateutil import tz
+
+# Number of events a sample aims for when no sample rate is given.
+DEFAULT_SAMPLE_EVENTS = 100000
 
 
 def random_color():
@@ -83,3 +88,114 @@ def get_validated_indices(indices, sketch_indices):
     if exclude:
         indices = [index for index in indices if index not in exclude]
     return indices
+
+
+def parse_filter_time(value, round_up=False):
+    """Parse a time_start or time_end value from a query filter.
+
+    Args:
+        value: Date string (e.g. 2017-01-01 or an ISO 8601 timestamp) or
+            epoch milliseconds, like Elasticsearch accepts in a range query.
+        round_up: Boolean indicating if a date without a time should be the
+            end of that day, like Elasticsearch does for the upper bound.
+
+    Returns:
+        Naive datetime in UTC, or None if the value is empty or can not be
+        parsed (e.g. date math like now-1d).
+    """
+    if not value:
+        return None
+    if isinstance(value, (int, long, float)) or (
+            isinstance(value, basestring) and value.isdigit()):
+        return datetime.datetime.utcfromtimestamp(int(value) / 1000.0)
+    try:
+        parsed = parser.parse(value)
+    except (ValueError, OverflowError, TypeError):
+        return None
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(tz.tzutc()).replace(tzinfo=None)
+    if round_up and u':' not in value:
+        parsed += datetime.timedelta(days=1, microseconds=-1)
+    return parsed
+
+
+def get_time_ranges(query_filter):
+    """Get the time ranges of a query filter.
+
+    A filter has one range in time_start and time_end, and any number of
+    ranges in time_ranges as dictionaries with start and end.
+
+    Args:
+        query_filter: Dictionary containing filters to apply
+
+    Returns:
+        List of (start, end) tuples as given in the filter.
+    """
+    time_ranges = []
+    if query_filter.get(u'time_start'):
+        time_ranges.append(
+            (query_filter[u'time_start'], query_filter.get(u'time_end')))
+    for time_range in query_filter.get(u'time_ranges') or []:
+        start = time_range.get(u'start')
+        end = time_range.get(u'end')
+        if start or end:
+            time_ranges.append((start, end))
+    return time_ranges
+
+
+def get_filter_time_range(query_filter, query_dsl=None):
+    """Get the time span covered by the time ranges of a query filter.
+
+    The time ranges in the filter are ignored when the query is given as
+    Elasticsearch DSL, so no time span is returned then either.
+
+    Args:
+        query_filter: Dictionary containing filters to apply
+        query_dsl: Elasticsearch DSL query, if any
+
+    Returns:
+        Tuple of start and end as naive datetimes in UTC, either is None if
+        it is open or can not be parsed.
+    """
+    time_ranges = get_time_ranges(query_filter)
+    if query_dsl or not time_ranges:
+        return None, None
+    starts = [parse_filter_time(start) for start, _ in time_ranges]
+    ends = [parse_filter_time(end, round_up=True) for _, end in time_ranges]
+    time_start = None if None in starts else min(starts)
+    time_end = None if None in ends else max(ends)
+    return time_start, time_end
+
+
+def get_sample_rate(query_filter, event_count=None):
+    """Get the fraction of events to sample from a query filter.
+
+    The sample key of the filter is either the fraction of events to keep,
+    or true to sample about DEFAULT_SAMPLE_EVENTS events.
+
+    Args:
+        query_filter: Dictionary containing filters to apply
+        event_count: Number of events in the queried indices, used when the
+            filter does not give a fraction
+
+    Returns:
+        Sample rate as a float between 0 and 1, or None if all events are
+        used.
+
+    Raises:
+        ValueError: If the sample in the filter is not valid.
+    """
+    sample = query_filter.get(u'sample')
+    if not sample:
+        return None
+    if sample is True:
+        if not event_count:
+            return None
+        sample_rate = float(DEFAULT_SAMPLE_EVENTS) / event_count
+    elif isinstance(sample, (int, float)) and 0 < sample <= 1:
+        sample_rate = float(sample)
+    else:
+        raise ValueError(u'Invalid sample: {0!r}'.format(sample))
+    if sample_rate >= 1:
+        return None
+    return sample_rate
@@ -13,9 +13,12 @@
 # limitations under the License.
 """Tests for utils."""
 
+import datetime
 import re
 
 from timesketch.lib.testlib import BaseTest
+from timesketch.lib.utils import get_filter_time_range
+from timesketch.lib.utils import get_sample_rate
 from timesketch.lib.utils import get_validated_indices
 from timesketch.lib.utils import random_color
 
@@ -38,3 +41,42 @@ class TestUtils(BaseTest):
                 valid_indices, sketch_indices))
         self.assertFalse(
             u'fail' in get_validated_indices(invalid_indices, sketch_indices))
+
+    def test_get_filter_time_range(self):
+        """Test parsing the time range of a filter."""
+        query_filter = {
+            u'time_start': u'2017-01-01T10:00:00+02:00',
+            u'time_end': u'2017-01-02'
+        }
+        self.assertEqual(get_filter_time_range(query_filter), (
+            datetime.datetime(2017, 1, 1, 8),
+            datetime.datetime(2017, 1, 2, 23, 59, 59, 999999)))
+        self.assertEqual(
+            get_filter_time_range(query_filter, query_dsl=u'{}'),
+            (None, None))
+        self.assertEqual(
+            get_filter_time_range({u'time_start': u'now-1d'}), (None, None))
+        self.assertEqual(
+            get_filter_time_range({u'time_start': u'1483228800000'})[0],
+            datetime.datetime(2017, 1, 1))
+        self.assertEqual(
+            get_filter_time_range({u'time_ranges': [
+                {u'start': u'2017-03-01', u'end': u'2017-03-02T12:00:00'},
+                {u'start': u'2017-01-01', u'end': u'2017-01-02T12:00:00'}
+            ]}),
+            (datetime.datetime(2017, 1, 1),
+             datetime.datetime(2017, 3, 2, 12)))
+
+    def test_get_sample_rate(self):
+        """Test getting the sample rate of a filter."""
+        self.assertIsNone(get_sample_rate({}))
+        self.assertEqual(get_sample_rate({u'sample': 0.25}), 0.25)
+        self.assertIsNone(get_sample_rate({u'sample': 1}))
+        self.assertEqual(
+            get_sample_rate({u'sample': True}, event_count=1000000), 0.1)
+        # Small sketches are not sampled.
+        self.assertIsNone(get_sample_rate({u'sample': True}, event_count=10))
+        self.assertIsNone(get_sample_rate({u'sample': True}))
+        for sample in (2, -0.5, u'half'):
+            with self.assertRaises(ValueError):
+                get_sample_rate({u'sample': sample})
@@ -84,8 +84,8 @@ class AclBaseQuery(BaseQuery):
                 abort(HTTP_STATUS_CODE_NOT_FOUND)
         except AttributeError:
             pass
-        if result_obj.is_public:
-            return result_obj
+        # Public objects are readable by everyone, has_permission() checks
+        # this first.
         if not result_obj.has_permission(user=current_user, permission=u'read'):
             abort(HTTP_STATUS_CODE_FORBIDDEN)
         return result_obj
@@ -158,15 +158,15 @@ class AccessControlMixin(object):
         ace = self.AccessControlEntry.query.filter_by(
             user=user, group=None, permission=permission, parent=self).all()
 
-        # If user doesn't have a direct ACE, check group permission.
+        # If user doesn't have a direct ACE, check group permission for all
+        # groups of the user in one query.
         if (user and check_group) and not ace:
-            group_intersection = set(user.groups) & set(self.groups)
-            for group in group_intersection:
-                # Get group ACE with the requested permission.
-                ace = self.AccessControlEntry.query.filter_by(
-                    group=group, permission=permission, parent=self).all()
-                if ace:
-                    return ace
+            group_ids = [group.id for group in user.groups]
+            if group_ids:
+                ace = self.AccessControlEntry.query.filter(
+                    self.AccessControlEntry.group_id.in_(group_ids),
+                    self.AccessControlEntry.permission == permission,
+                    self.AccessControlEntry.parent == self).all()
         return ace
 
     @property
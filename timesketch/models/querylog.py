@@ -0,0 +1,105 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module implements the model for the slow query log."""
+
+from sqlalchemy import Column
+from sqlalchemy import ForeignKey
+from sqlalchemy import Integer
+from sqlalchemy import Unicode
+from sqlalchemy import UnicodeText
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import relationship
+
+from timesketch.models import BaseModel
+from timesketch.models import session_maker
+from timesketch.models.sketch import Sketch
+from timesketch.models.user import User
+
+# Number of entries kept in the slow query log.
+DEFAULT_MAX_ENTRIES = 1000
+
+
+class SlowQuery(BaseModel):
+    """Implements the SlowQuery model.
+
+    A datastore call that took longer than the slow query threshold. The
+    opaque ID is sent to Elasticsearch with the call, so the entry can be
+    matched with running requests in the Elasticsearch tasks API.
+    """
+    operation = Column(Unicode(255))
+    query_dsl = Column(UnicodeText())
+    index_count = Column(Integer)
+    # Milliseconds as reported by Elasticsearch, and as measured by the
+    # client including network and queueing time.
+    took = Column(Integer)
+    duration = Column(Integer)
+    opaque_id = Column(Unicode(255))
+    sketch_id = Column(Integer, ForeignKey(u'sketch.id'))
+    user_id = Column(Integer, ForeignKey(u'user.id'))
+    sketch = relationship(Sketch)
+    user = relationship(User)
+
+    def __init__(
+            self, operation, duration, took=None, query_dsl=None,
+            index_count=None, opaque_id=None, sketch_id=None, user_id=None):
+        """Initialize the SlowQuery object.
+
+        Args:
+            operation: Name of the datastore call, e.g. search or count
+            duration: Time of the call in milliseconds
+            took: Time reported by the datastore in milliseconds
+            query_dsl: The query as JSON string
+            index_count: Number of queried indices
+            opaque_id: ID sent with the datastore request
+            sketch_id: Integer primary key of the sketch
+            user_id: Integer primary key of the user
+        """
+        super(SlowQuery, self).__init__()
+        self.operation = operation
+        self.duration = duration
+        self.took = took
+        self.query_dsl = query_dsl
+        self.index_count = index_count
+        self.opaque_id = opaque_id
+        self.sketch_id = sketch_id
+        self.user_id = user_id
+
+    @classmethod
+    def record(cls, max_entries=DEFAULT_MAX_ENTRIES, **kwargs):
+        """Add an entry to the log and delete the oldest entries.
+
+        The entry is written in its own session, so that pending changes in
+        the session of the request are neither committed nor expired.
+
+        Args:
+            max_entries: Number of entries to keep
+            kwargs: Arguments for SlowQuery()
+
+        Raises:
+            SQLAlchemyError: If the entry could not be written.
+        """
+        session = session_maker()
+        try:
+            entry = cls(**kwargs)
+            session.add(entry)
+            session.flush()
+            session.query(cls).filter(
+                cls.id <= entry.id - max_entries).delete(
+                    synchronize_session=False)
+            session.commit()
+        except SQLAlchemyError:
+            session.rollback()
+            raise
+        finally:
+            session.close()
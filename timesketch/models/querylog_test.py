@@ -0,0 +1,31 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the slow query log model."""
+
+from timesketch.lib.testlib import ModelBaseTest
+from timesketch.models.querylog import SlowQuery
+
+
+class SlowQueryModelTest(ModelBaseTest):
+    """Tests the slow query model."""
+    def test_record(self):
+        """Test that only the newest entries are kept."""
+        for duration in range(5):
+            SlowQuery.record(
+                max_entries=3, operation=u'search', duration=duration,
+                sketch_id=self.sketch1.id, user_id=self.user1.id)
+        entries = SlowQuery.query.order_by(SlowQuery.id).all()
+        self.assertEqual([entry.duration for entry in entries], [2, 3, 4])
+        self.assertEqual(entries[0].sketch, self.sketch1)
+        self.assertEqual(entries[0].user, self.user1)
@@ -15,14 +15,21 @@
 
 import json
 
+from sqlalchemy import BigInteger
 from sqlalchemy import Column
+from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
 from sqlalchemy import Integer
 from sqlalchemy import Unicode
 from sqlalchemy import UnicodeText
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy.orm import backref
 from sqlalchemy.orm import relationship
 
+from timesketch.lib.definitions import SEARCHINDEX_FAILED_STATUS
 from timesketch.models import BaseModel
+from timesketch.models import db_session
 from timesketch.models.acl import AccessControlMixin
 from timesketch.models.annotations import LabelMixin
 from timesketch.models.annotations import CommentMixin
@@ -133,9 +140,18 @@ class SearchIndex(AccessControlMixin, LabelMixin, StatusMixin, CommentMixin,
     name = Column(Unicode(255))
     description = Column(UnicodeText())
     index_name = Column(Unicode(255))
+    # Stats recorded when events are imported, so that they can be shown
+    # without querying the datastore. None if not recorded yet.
+    event_count = Column(BigInteger)
+    min_datetime = Column(DateTime())
+    max_datetime = Column(DateTime())
+    size_in_bytes = Column(BigInteger)
     user_id = Column(Integer, ForeignKey(u'user.id'))
+    # Handlers look up the index of every timeline in a sketch, load it in
+    # the same query as the timelines instead of one query per timeline.
     timelines = relationship(
-        u'Timeline', backref=u'searchindex', lazy=u'dynamic')
+        u'Timeline', backref=backref(u'searchindex', lazy=u'joined'),
+        lazy=u'dynamic')
     events = relationship(
         u'Event', backref=u'searchindex', lazy=u'dynamic')
 
@@ -154,6 +170,119 @@ class SearchIndex(AccessControlMixin, LabelMixin, StatusMixin, CommentMixin,
         self.index_name = index_name
         self.user = user
 
+    @classmethod
+    def filter_by_time_range(cls, index_names, time_start=None, time_end=None):
+        """Remove indices that have no events in a time range.
+
+        This uses the time span recorded with set_stats(). Indices without
+        a recorded time span are kept.
+
+        Args:
+            index_names: List of index names
+            time_start: Start of the time range as datetime, or None
+            time_end: End of the time range as datetime, or None
+
+        Returns:
+            List of index names, in the same order.
+        """
+        if not index_names or (time_start is None and time_end is None):
+            return index_names
+        conditions = []
+        if time_start is not None:
+            conditions.append(cls.max_datetime < time_start)
+        if time_end is not None:
+            conditions.append(cls.min_datetime > time_end)
+        query = cls.query.with_entities(cls.index_name).filter(
+            cls.index_name.in_(list(index_names)), or_(*conditions))
+        outside = {index_name for index_name, in query}
+        return [name for name in index_names if name not in outside]
+
+    @classmethod
+    def filter_failed(cls, index_names):
+        """Remove indices whose import failed.
+
+        Args:
+            index_names: List of index names
+
+        Returns:
+            List of index names, in the same order.
+        """
+        if not index_names:
+            return index_names
+        query = cls.query.with_entities(cls.index_name).filter(
+            cls.index_name.in_(list(index_names)),
+            cls.status.any(cls.Status.status == SEARCHINDEX_FAILED_STATUS))
+        failed = {index_name for index_name, in query}
+        return [name for name in index_names if name not in failed]
+
+    @classmethod
+    def count_events(cls, index_names):
+        """Get the total number of events in indices.
+
+        This uses the number of events recorded with set_stats(). Indices
+        without a recorded number of events are not counted.
+
+        Args:
+            index_names: List of index names
+
+        Returns:
+            Number of events as integer.
+        """
+        if not index_names:
+            return 0
+        count = cls.query.with_entities(func.sum(cls.event_count)).filter(
+            cls.index_name.in_(list(index_names))).scalar()
+        return int(count or 0)
+
+    @classmethod
+    def time_span(cls, index_names, time_start=None, time_end=None):
+        """Get the time span of the events in indices.
+
+        This uses the time span recorded with set_stats(), limited to the
+        time range if one is given.
+
+        Args:
+            index_names: List of index names
+            time_start: Start of the time range as datetime, or None
+            time_end: End of the time range as datetime, or None
+
+        Returns:
+            Tuple of the first and last datetime, or None if there are no
+            indices or an index has no recorded time span.
+        """
+        if not index_names:
+            return None
+        spans = cls.query.with_entities(
+            cls.min_datetime, cls.max_datetime).filter(
+                cls.index_name.in_(list(index_names))).all()
+        if len(spans) < len(set(index_names)):
+            return None
+        if any(start is None or end is None for start, end in spans):
+            return None
+        start = min(start for start, _ in spans)
+        end = max(end for _, end in spans)
+        if time_start is not None:
+            start = max(start, time_start)
+        if time_end is not None:
+            end = min(end, time_end)
+        return start, end
+
+    def set_stats(self, stats):
+        """Record the number of events, time span and size of the index.
+
+        The caller commits the session, so the stats of many indices can be
+        saved with one commit.
+
+        Args:
+            stats: Dictionary with event_count, min_datetime, max_datetime and
+                size_in_bytes, e.g. from ElasticsearchDataStore.index_stats()
+        """
+        self.event_count = stats.get(u'event_count')
+        self.min_datetime = stats.get(u'min_datetime')
+        self.max_datetime = stats.get(u'max_datetime')
+        self.size_in_bytes = stats.get(u'size_in_bytes')
+        db_session.add(self)
+
 
 class View(AccessControlMixin, LabelMixin, StatusMixin, CommentMixin,
            BaseModel):
@@ -13,6 +13,7 @@
 # limitations under the License.
 """Tests for the sketch models."""
 
+import datetime
 import json
 
 from timesketch.models.sketch import Sketch
@@ -53,6 +54,63 @@ class SketchModelTest(ModelBaseTest):
         self._test_db_object(
             expected_result=expected_result, model_cls=SearchIndex)
 
+    def test_searchindex_filter_by_time_range(self):
+        """Test that indices outside of a time range are removed."""
+        self.searchindex.set_stats({
+            u'event_count': 1,
+            u'min_datetime': datetime.datetime(2017, 1, 1),
+            u'max_datetime': datetime.datetime(2017, 1, 31)
+        })
+        self._commit_to_database(self.searchindex)
+        index_names = [u'test', u'unknown']
+        self.assertEqual(
+            SearchIndex.filter_by_time_range(
+                index_names, datetime.datetime(2017, 1, 15),
+                datetime.datetime(2017, 2, 15)),
+            index_names)
+        self.assertEqual(
+            SearchIndex.filter_by_time_range(
+                index_names, datetime.datetime(2017, 2, 1), None),
+            [u'unknown'])
+        self.assertEqual(
+            SearchIndex.filter_by_time_range(
+                index_names, None, datetime.datetime(2016, 12, 31)),
+            [u'unknown'])
+
+    def test_searchindex_filter_failed(self):
+        """Test that indices that failed to import are removed."""
+        index_names = [u'test', u'unknown']
+        self.assertEqual(SearchIndex.filter_failed(index_names), index_names)
+        self.searchindex.set_status(u'fail')
+        self.assertEqual(SearchIndex.filter_failed(index_names), [u'unknown'])
+
+    def test_searchindex_count_events(self):
+        """Test the number of events in indices."""
+        self.searchindex.set_stats({u'event_count': 10})
+        self._commit_to_database(self.searchindex)
+        self.assertEqual(
+            SearchIndex.count_events([u'test', u'unknown']), 10)
+        self.assertEqual(SearchIndex.count_events([u'unknown']), 0)
+
+    def test_searchindex_time_span(self):
+        """Test the time span of the events in indices."""
+        self.assertIsNone(SearchIndex.time_span([u'test']))
+        self.searchindex.set_stats({
+            u'event_count': 1,
+            u'min_datetime': datetime.datetime(2017, 1, 1),
+            u'max_datetime': datetime.datetime(2017, 1, 31)
+        })
+        self._commit_to_database(self.searchindex)
+        self.assertEqual(
+            SearchIndex.time_span([u'test']),
+            (datetime.datetime(2017, 1, 1), datetime.datetime(2017, 1, 31)))
+        self.assertEqual(
+            SearchIndex.time_span(
+                [u'test'], datetime.datetime(2017, 1, 15), None),
+            (datetime.datetime(2017, 1, 15), datetime.datetime(2017, 1, 31)))
+        self.assertIsNone(SearchIndex.time_span([u'test', u'unknown']))
+        self.assertIsNone(SearchIndex.time_span([]))
+
     def test_timeline_model(self):
         """
         Test that the test timeline has the expected data stored in the
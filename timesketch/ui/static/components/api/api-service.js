@@ -235,6 +235,20 @@ limitations under the License.
             return $http.get(resource_url, params)
         };
 
+        this.getEvents = function(sketch_id, events) {
+            /**
+             * Get many Timesketch events with one request.
+             * @param sketch_id - The id for the sketch.
+             * @param events - List of events with _index and _id.
+             * @returns A $http promise with two methods, success and error.
+             */
+            var resource_url = SKETCH_BASE_URL + sketch_id + '/event/batch/';
+            var params = {
+                events: events
+            };
+            return $http.post(resource_url, params);
+        };
+
         this.saveEventAnnotation = function(sketch_id, annotation_type, annotation, events) {
             /**
              * Save a Timesketch event annotation.
@@ -281,25 +295,36 @@ limitations under the License.
             return $http.get(resource_url)
         };
 
-        this.search = function(sketch_id, query, filter, queryDsl) {
+        this.search = function(sketch_id, query, filter, queryDsl, include, cursor) {
             /**
              * Execute query and filter on the datastore.
              * @param sketch_id - The id for the sketch.
              * @param query - A query string.
              * @param filter - A JSON string with filters and a list of indices.
              * @param queryDsl - A JSON string with Elasticsearch DLS.
+             * @param include - (optional) List of extra results to return in
+             *     meta: heatmap, histogram, timeline_counts and count.
+             * @param cursor - (optional) The meta.next_cursor of the previous
+             *     page, to get the events after it. Use true to get the first
+             *     page with a meta.next_cursor.
              * @returns A $http promise with two methods, success and error.
              */
             var resource_url = SKETCH_BASE_URL + sketch_id + '/explore/';
             var params = {
                 query: query,
                 filter: filter,
-                dsl: queryDsl
+                dsl: queryDsl,
+                include: include || []
             };
+            if (cursor === true) {
+                params.paginate = true;
+            } else if (cursor) {
+                params.cursor = cursor;
+            }
             return $http.post(resource_url, params)
         };
 
-        this.aggregation = function(sketch_id, query, filter, queryDsl, aggtype) {
+        this.aggregation = function(sketch_id, query, filter, queryDsl, aggtype, zoom, perTimeline) {
             /**
              * Execute query and filter on the datastore.
              * @param sketch_id - The id for the sketch.
@@ -307,6 +332,9 @@ limitations under the License.
              * @param filter - A JSON string with filters and a list of indices.
              * @param queryDsl - A JSON string with Elasticsearch DLS.
              * @param aggtype - Type of aggregation.
+             * @param zoom - (optional) Object with start and end of the
+             *     histogram zoom window in epoch milliseconds.
+             * @param perTimeline - (optional) Split the result by timeline.
              * @returns A $http promise with two methods, success and error.
              */
             var resource_url = SKETCH_BASE_URL + sketch_id + '/aggregation/';
@@ -316,6 +344,13 @@ limitations under the License.
                 dsl: queryDsl,
                 aggtype: aggtype
             };
+            if (zoom) {
+                params.zoom_start = zoom.start;
+                params.zoom_end = zoom.end;
+            }
+            if (perTimeline) {
+                params.per_timeline = true;
+            }
             return $http.post(resource_url, params)
         };
 
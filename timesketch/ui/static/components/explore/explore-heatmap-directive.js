@@ -17,14 +17,14 @@
 (function() {
     var module = angular.module('timesketch.explore.heatmap.directive', []);
 
-    module.directive('tsHeatmap', function ($window, timesketchApi) {
+    module.directive('tsHeatmap', function ($window) {
         /**
          * Heatmap chart for number of events per hour/weekday.
          * @param sketchId - Sketch ID.
          * @param filter - Filter object.
          * @param query - Query string.
          * @param queryDsl - Query DSL JSON string.
-         * @param meta - Events metadata object.
+         * @param meta - Events metadata object, with the heatmap.
          * @param showCharts - Boolean indicating if chars should be visible.
          */
         return {
@@ -39,12 +39,10 @@
             },
             require: '^tsSearch',
             link: function(scope, element, attrs, ctrl) {
+                // The heatmap is returned in meta by the search.
                 scope.$watchGroup(['meta', 'showCharts'], function (newval, oldval) {
-                    if(scope.showCharts) {
-                        timesketchApi.aggregation(scope.sketchId, scope.query, scope.filter, scope.queryDsl, 'heatmap')
-                            .success(function(data) {
-                                scope.render_heatmap(data['objects'])
-                            });
+                    if(scope.showCharts && scope.meta && scope.meta.heatmap) {
+                        scope.render_heatmap(scope.meta.heatmap)
                     }
                 }, true);
 
@@ -55,11 +53,8 @@
                 scope.$watch(function() {
                     return angular.element($window)[0].innerWidth;
                 }, function() {
-                    if(scope.meta && scope.showCharts) {
-                        timesketchApi.aggregation(scope.sketchId, scope.query, scope.filter, scope.queryDsl, 'heatmap')
-                            .success(function(data) {
-                                scope.render_heatmap(data['objects'])
-                            });
+                    if(scope.showCharts && scope.meta && scope.meta.heatmap) {
+                        scope.render_heatmap(scope.meta.heatmap)
                     }
                 });
 
@@ -24,7 +24,7 @@
          * @param filter - Filter object.
          * @param query - Query string.
          * @param queryDsl - Query DSL JSON string.
-         * @param meta - Events metadata object.
+         * @param meta - Events metadata object, with the histogram.
          */
         return {
             restrict: 'E',
@@ -43,15 +43,33 @@
                 // Default chart type
                 scope.chartType = "bar";
 
-                scope.$watchGroup(['meta', 'showCharts', 'chartType'], function (newval, oldval) {
-                    if(scope.showCharts) {
-                        timesketchApi.aggregation(scope.sketchId, scope.query, scope.filter, scope.queryDsl, 'histogram')
+                // Zoom window, null to show all events.
+                scope.zoom = null;
+
+                scope.$watchGroup(['meta', 'showCharts', 'chartType', 'zoom'], function (newval, oldval) {
+                    if(!scope.showCharts || !scope.meta) {
+                        return;
+                    }
+                    // The histogram of all events is returned in meta by the
+                    // search, only a zoom window needs a request.
+                    if(scope.zoom) {
+                        timesketchApi.aggregation(scope.sketchId, scope.query, scope.filter, scope.queryDsl, 'histogram', scope.zoom)
                             .success(function(data) {
+                                scope.interval_ms = data.meta ? data.meta.interval_ms : null;
+                                scope.sampled = data.meta ? data.meta.sampled : false;
                                 render_histogram(data['objects'])
                             });
+                    } else if(scope.meta.histogram) {
+                        scope.interval_ms = scope.meta.histogram_interval_ms;
+                        scope.sampled = scope.meta.sampled;
+                        render_histogram(scope.meta.histogram)
                     }
                 }, true);
 
+                scope.resetZoom = function () {
+                    scope.zoom = null;
+                };
+
                 scope.toggleChartType = function () {
                   if (scope.chartType == 'bar') {
                       scope.chartType = 'line';
@@ -76,6 +94,20 @@
                         chart_values.push(d.doc_count);
                     });
 
+                    // Zoom in to the clicked bucket.
+                    var zoom_to_bucket = function (event, elements) {
+                        if (!elements.length || !scope.interval_ms) {
+                            return;
+                        }
+                        var bucket = aggregation[elements[0]._index];
+                        scope.$apply(function () {
+                            scope.zoom = {
+                                start: bucket.key,
+                                end: bucket.key + scope.interval_ms
+                            };
+                        });
+                    };
+
                     // Get our canvas and initiate the chart.
                     var ctx = document.getElementById("histogram");
                     scope.histogram = new Chart(ctx, {
@@ -90,6 +122,7 @@
                             }]
                         },
                         options: {
+                            onClick: zoom_to_bucket,
                             legend: {
                                 display: false
                             },
@@ -77,6 +77,15 @@ limitations under the License.
                         }
                 });
 
+                // Search again to get the charts if they were hidden during
+                // the last search.
+                var ctrl = this;
+                $scope.$watch('showCharts', function(showCharts) {
+                    if (showCharts && $scope.meta && !$scope.meta.heatmap) {
+                        ctrl.search($scope.query, $scope.filter, $scope.queryDsl);
+                    }
+                });
+
                 $scope.$on('datetime-clicked', function (event, clickObj) {
                     $scope.showFilters = true;
                     $scope.filter.time_start= clickObj.datetimeclicked;
@@ -119,7 +128,15 @@ limitations under the License.
                     $scope.filter = filter;
                     $scope.queryDsl = queryDsl;
 
-                    timesketchApi.search($scope.sketchId, query, filter, queryDsl)
+                    // The charts and the event count of the sketch are
+                    // returned in meta with the events, so that they don't
+                    // need requests of their own.
+                    var include = ['count'];
+                    if ($scope.showCharts) {
+                        include.push('heatmap', 'histogram');
+                    }
+
+                    timesketchApi.search($scope.sketchId, query, filter, queryDsl, include)
                         .success(function(data) {
                             $scope.events = data.objects;
                             $scope.meta = data.meta;
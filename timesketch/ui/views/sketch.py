@@ -23,6 +23,8 @@ from flask import current_app
 from flask import redirect
 from flask import render_template
 from flask import request
+from flask import Response
+from flask import stream_with_context
 from flask import url_for
 from flask_login import current_user
 from flask_login import login_required
@@ -47,13 +49,27 @@ from timesketch.models.sketch import View
 from timesketch.models.user import Group
 from timesketch.models.user import User
 from timesketch.lib.datastores.elastic import ElasticsearchDataStore
+from timesketch.lib.datastores.sqlite import SqliteDataStore
+from timesketch.lib.definitions import HTTP_STATUS_CODE_BAD_REQUEST
 from timesketch.lib.definitions import HTTP_STATUS_CODE_FORBIDDEN
 from timesketch.lib.definitions import HTTP_STATUS_CODE_NOT_FOUND
+from timesketch.lib.utils import get_filter_time_range
 
 
 # Register flask blueprint
 sketch_views = Blueprint(u'sketch_views', __name__)
 
+# Supported export formats and their mimetype.
+EXPORT_FORMATS = {
+    u'csv': u'text/csv',
+    u'jsonl': u'application/x-ndjson'
+}
+
+# Fields to include in exported events.
+EXPORT_FIELDS = [
+    u'timestamp', u'message', u'timestamp_desc', u'datetime',
+    u'timesketch_label', u'tag']
+
 
 @sketch_views.route(u'/sketch/<int:sketch_id>/', methods=[u'GET', u'POST'])
 @login_required
@@ -243,43 +259,101 @@ def explore(sketch_id, view_id=None, searchtemplate_id=None):
     u'/sketch/<int:sketch_id>/explore/export/', methods=[u'GET'])
 @login_required
 def export(sketch_id):
-    """Generates CSV from search result.
+    """Generates CSV or JSONL from search result.
+
+    All events matching the current user view are exported, also when the
+    view only shows a sample of them. The result is streamed to the client
+    while paging through the datastore, so the export is not limited in size
+    and does not need to fit in memory.
+
+    The columns are taken from the fields request argument (comma separated),
+    then from the fields in the view filter, with EXPORT_FIELDS as default.
 
     Args:
         sketch_id: Primary key for a sketch.
     Returns:
-        CSV string with header.
+        Streaming response with CSV (with header) or JSONL.
     """
     sketch = Sketch.query.get_with_acl(sketch_id)
     view = sketch.get_user_view(current_user)
     query_filter = json.loads(view.query_filter)
+    query_filter.pop(u'sample', None)
     query_dsl = json.loads(view.query_dsl)
     indices = query_filter.get(u'indices', [])
+    if isinstance(indices, list):
+        time_start, time_end = get_filter_time_range(query_filter, query_dsl)
+        indices = SearchIndex.filter_by_time_range(
+            indices, time_start, time_end)
+    export_format = request.args.get(u'format', u'csv')
+    if export_format not in EXPORT_FORMATS:
+        abort(HTTP_STATUS_CODE_BAD_REQUEST)
+
+    export_fields = query_filter.get(u'fields') or EXPORT_FIELDS
+    if request.args.get(u'fields'):
+        export_fields = [
+            field.strip() for field in request.args[u'fields'].split(u',')
+            if field.strip()]
+
+    if current_app.config.get(u'DATASTORE') == u'sqlite':
+        datastore = SqliteDataStore(
+            current_app.config[u'SQLITE_DATASTORE_PATH'])
+    else:
+        datastore = ElasticsearchDataStore(
+            host=current_app.config[u'ELASTIC_HOST'],
+            port=current_app.config[u'ELASTIC_PORT'])
 
-    # Export more than the 500 first results.
-    max_events_to_fetch = 10000
-    query_filter[u'limit'] = max_events_to_fetch
+    events = datastore.search_stream(
+        sketch_id, view.query_string, query_filter, query_dsl, indices,
+        return_fields=export_fields)
+
+    if export_format == u'jsonl':
+        rows = _export_jsonl(events)
+    else:
+        rows = _export_csv(events, export_fields)
 
-    datastore = ElasticsearchDataStore(
-        host=current_app.config[u'ELASTIC_HOST'],
-        port=current_app.config[u'ELASTIC_PORT'])
+    filename = u'sketch_{0:d}_export.{1:s}'.format(sketch.id, export_format)
+    return Response(
+        stream_with_context(rows), mimetype=EXPORT_FORMATS[export_format],
+        headers={
+            u'Content-Disposition': u'attachment; filename={0:s}'.format(
+                filename)})
 
-    result = datastore.search(
-        sketch_id, view.query_string, query_filter, query_dsl, indices,
-        aggregations=None, return_results=True)
 
-    csv_out = StringIO()
+def _export_csv(events, fields):
+    """Serialize events to CSV, one row at a time.
+
+    Args:
+        events: Iterable of datastore events.
+        fields: List of fields to use as columns.
+
+    Yields:
+        CSV encoded lines, starting with the header.
+    """
+    buffer_out = StringIO()
     csv_writer = csv.DictWriter(
-        csv_out, fieldnames=[
-            u'timestamp', u'message', u'timestamp_desc', u'datetime',
-            u'timesketch_label', u'tag'])
+        buffer_out, fieldnames=fields, extrasaction=u'ignore')
     csv_writer.writeheader()
-    for _event in result[u'hits'][u'hits']:
+    for _event in events:
         csv_writer.writerow(
             dict((k, v.encode(u'utf-8') if isinstance(v, basestring) else v)
                  for k, v in _event[u'_source'].iteritems()))
+        yield buffer_out.getvalue()
+        buffer_out.seek(0)
+        buffer_out.truncate()
+    yield buffer_out.getvalue()
+
 
-    return csv_out.getvalue()
+def _export_jsonl(events):
+    """Serialize events to JSON lines, one event per line.
+
+    Args:
+        events: Iterable of datastore events.
+
+    Yields:
+        JSON encoded events separated by newlines.
+    """
+    for _event in events:
+        yield json.dumps(_event[u'_source']) + u'\n'
 
 
 @sketch_views.route(
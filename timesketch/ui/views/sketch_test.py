@@ -13,7 +13,12 @@
 # limitations under the License.
 """Tests for the sketch views."""
 
+import json
+import mock
+
+from timesketch.lib.definitions import HTTP_STATUS_CODE_BAD_REQUEST
 from timesketch.lib.testlib import BaseTest
+from timesketch.lib.testlib import MockDataStore
 
 
 class SketchViewTest(BaseTest):
@@ -65,3 +70,73 @@ class ViewTest(BaseTest):
         response = self.client.get(self.resource_url)
         self.assert200(response)
         self.assert_template_used(u'sketch/views.html')
+
+
+class ExportViewTest(BaseTest):
+    """Test the export view."""
+    resource_url = u'/sketch/1/explore/export/'
+
+    def setUp(self):
+        super(ExportViewTest, self).setUp()
+        view = self._create_view(name=u'', sketch=self.sketch1, user=self.user1)
+        view.query_filter = json.dumps({u'indices': [u'test']})
+        view.query_dsl = json.dumps(None)
+        self._commit_to_database(view)
+
+    @mock.patch(
+        u'timesketch.ui.views.sketch.ElasticsearchDataStore', MockDataStore)
+    def test_export_csv(self):
+        """Test CSV export."""
+        self.login()
+        response = self.client.get(self.resource_url)
+        self.assert200(response)
+        lines = response.data.splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith(u'timestamp,message'))
+        self.assertIn(u'Test event', lines[1])
+
+    @mock.patch(
+        u'timesketch.ui.views.sketch.ElasticsearchDataStore', MockDataStore)
+    def test_export_jsonl(self):
+        """Test JSONL export."""
+        self.login()
+        response = self.client.get(self.resource_url + u'?format=jsonl')
+        self.assert200(response)
+        lines = response.data.splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])[u'message'], u'Test event')
+
+    @mock.patch(
+        u'timesketch.ui.views.sketch.ElasticsearchDataStore', MockDataStore)
+    def test_export_fields(self):
+        """Test CSV export with selected columns."""
+        self.login()
+        response = self.client.get(
+            self.resource_url + u'?fields=message,timestamp_desc')
+        self.assert200(response)
+        lines = response.data.splitlines()
+        self.assertEqual(lines[0], u'message,timestamp_desc')
+        self.assertEqual(lines[1], u'Test event,Content Modification Time')
+
+    @mock.patch(
+        u'timesketch.ui.views.sketch.ElasticsearchDataStore', MockDataStore)
+    def test_export_not_sampled(self):
+        """Test that a sampled view exports all events."""
+        view = self.sketch1.get_user_view(self.user1)
+        view.query_filter = json.dumps({u'indices': [u'test'], u'sample': 0.1})
+        self._commit_to_database(view)
+        self.login()
+        with mock.patch.object(
+                MockDataStore, u'search_stream',
+                return_value=iter([])) as search_stream:
+            response = self.client.get(self.resource_url)
+            self.assert200(response)
+            self.assertEqual(len(response.data.splitlines()), 1)
+        query_filter = search_stream.call_args[0][2]
+        self.assertNotIn(u'sample', query_filter)
+
+    def test_export_invalid_format(self):
+        """Test export with an unsupported format."""
+        self.login()
+        response = self.client.get(self.resource_url + u'?format=xml')
+        self.assertEqual(response.status_code, HTTP_STATUS_CODE_BAD_REQUEST)